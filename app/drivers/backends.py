@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+
+import numpy as np
+from ultralytics import YOLO
+
+PYTORCH = "pytorch"
+ONNX = "onnx"
+OPENVINO = "openvino"
+OPENVINO_INT8 = "openvino_int8"
+BACKENDS = (PYTORCH, ONNX, OPENVINO, OPENVINO_INT8)
+
+# backend -> tham số export của ultralytics
+_EXPORT_ARGS = {
+    ONNX: {"format": "onnx", "simplify": True},
+    OPENVINO: {"format": "openvino"},
+    OPENVINO_INT8: {"format": "openvino", "int8": True},
+}
+
+_MANIFEST = "manifest.json"
+
+
+class LatencyTracker:
+    """Thống kê độ trễ inference theo từng backend (cửa sổ trượt)."""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, backend: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(backend, deque(maxlen=self.window)).append(seconds)
+            self._counts[backend] = self._counts.get(backend, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = {}
+            for backend, samples in self._samples.items():
+                ordered = sorted(samples)
+                n = len(ordered)
+                out[backend] = {
+                    "count": self._counts[backend],
+                    "last_ms": round(samples[-1] * 1000, 2),
+                    "avg_ms": round(sum(ordered) / n * 1000, 2),
+                    "p50_ms": round(ordered[n // 2] * 1000, 2),
+                    "p95_ms": round(ordered[min(n - 1, int(n * 0.95))] * 1000, 2),
+                }
+            return out
+
+
+def _weights_digest(model_path: str) -> str:
+    h = hashlib.sha1()
+    with open(model_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()[:12]
+
+
+def _load_manifest(cache_dir: str) -> dict:
+    try:
+        with open(os.path.join(cache_dir, _MANIFEST), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(cache_dir: str, manifest: dict):
+    tmp = os.path.join(cache_dir, _MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(cache_dir, _MANIFEST))
+
+
+def resolve_model_path(
+    model_path: str,
+    backend: str,
+    cache_dir: str,
+    imgsz: int = 640,
+    dynamic: bool = False,
+    int8_data: Optional[str] = None,
+) -> str:
+    """
+    Trả về đường dẫn model cho backend. Với backend khác `pytorch`, model được export
+    một lần từ file `.pt` và lưu cache theo (hash weights, backend, imgsz, dynamic).
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend inference không hợp lệ: {backend} (hỗ trợ: {', '.join(BACKENDS)})")
+    if backend == PYTORCH:
+        return model_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    key = f"{stem}-{_weights_digest(model_path)}-{backend}-{imgsz}{'-dyn' if dynamic else ''}"
+    manifest = _load_manifest(cache_dir)
+    cached = manifest.get(key)
+    if cached and os.path.exists(os.path.join(cache_dir, cached)):
+        print(f">>> [BACKEND] Dùng model {backend} đã cache: {cached}", flush=True)
+        return os.path.join(cache_dir, cached)
+
+    print(f">>> [BACKEND] Đang export model sang {backend} (imgsz={imgsz})...", flush=True)
+    export_args = dict(_EXPORT_ARGS[backend], imgsz=imgsz, dynamic=dynamic)
+    if backend == OPENVINO_INT8 and int8_data:
+        export_args["data"] = int8_data
+    exported = YOLO(model_path).export(**export_args)
+
+    # Chuyển artifact vào thư mục cache với tên cố định theo key
+    ext = os.path.splitext(exported)[1] if os.path.isfile(exported) else ""
+    target_name = f"{key}{ext}"
+    target = os.path.join(cache_dir, target_name)
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    shutil.move(exported, target)
+
+    manifest[key] = target_name
+    _save_manifest(cache_dir, manifest)
+    print(f">>> [BACKEND] Đã cache model {backend}: {target}", flush=True)
+    return target
+
+
+def load_model(model_path: str, backend: str, cache_dir: str, imgsz: int = 640, dynamic: bool = False, int8_data: Optional[str] = None) -> YOLO:
+    path = resolve_model_path(model_path, backend, cache_dir, imgsz=imgsz, dynamic=dynamic, int8_data=int8_data)
+    return YOLO(path, task="detect")
+
+
+def warmup(model: YOLO, imgsz: int = 640, runs: int = 3, batch_size: int = 1) -> List[float]:
+    """Chạy inference trên ảnh rỗng để khởi tạo graph/kernel trước khi có counter đầu tiên."""
+    latencies = []
+    dummy = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+    source = dummy if batch_size <= 1 else [dummy] * batch_size
+    for _ in range(max(0, runs)):
+        started = time.perf_counter()
+        model.predict(source=source, imgsz=imgsz, conf=0.25, verbose=False)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def benchmark_backends(model_path: str, cache_dir: str, backends=BACKENDS, imgsz: int = 640, runs: int = 20, int8_data: Optional[str] = None) -> dict:
+    """Đo độ trễ từng backend trên máy hiện tại để chọn backend nhanh nhất."""
+    tracker = LatencyTracker(window=runs)
+    for backend in backends:
+        try:
+            model = load_model(model_path, backend, cache_dir, imgsz=imgsz, int8_data=int8_data)
+            warmup(model, imgsz=imgsz, runs=2)
+            for latency in warmup(model, imgsz=imgsz, runs=runs):
+                tracker.record(backend, latency)
+        except Exception as e:
+            print(f">>> [BACKEND ERROR] Không benchmark được {backend}: {e}", flush=True)
+    return tracker.stats()
+
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    from app.config import MODEL_PATH, MODEL_CACHE_DIR, INFERENCE_IMGSZ, MODEL_INT8_DATA
+
+    results = benchmark_backends(MODEL_PATH, MODEL_CACHE_DIR, imgsz=INFERENCE_IMGSZ, int8_data=MODEL_INT8_DATA)
+    for backend, s in sorted(results.items(), key=lambda kv: kv[1]["avg_ms"]):
+        print(f"{backend:>14}: avg={s['avg_ms']}ms p50={s['p50_ms']}ms p95={s['p95_ms']}ms")
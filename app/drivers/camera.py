@@ -1,67 +1,557 @@
 import os
 import cv2
 import time
+import asyncio
 import threading
-from ultralytics import YOLO
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from app.drivers.backends import PYTORCH, LatencyTracker, load_model, warmup
+from app.drivers.frame_buffer import FrameRingBuffer, FrameRef
+from app.drivers.preprocess import FramePreprocessor
+from app.drivers.result_cache import ResultReuse
 
-class CameraSystem:
-    def __init__(self, url, model_path):
-        print(f"--- Đang nạp Model YOLO từ: {model_path} ---", flush=True)
-        self.model = YOLO(model_path)
-        self.cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
-        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-        self.latest_frame = None
-        self.lock = threading.Lock()
+DEFAULT_CAMERA = "*"
+
+# Thread pool vẽ khung + encode JPEG, chỉ dùng cho các frame trở thành defect record
+_encode_pool: Optional[ThreadPoolExecutor] = None
+_encode_settings = {"quality": 80, "max_width": 1280, "thumb_width": 160}
+
+def configure_annotation(workers: int = 2, quality: int = 80, max_width: int = 1280, thumb_width: int = 160):
+    global _encode_pool
+    if _encode_pool is None:
+        _encode_pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="annotate")
+    _encode_settings["quality"] = int(quality)
+    _encode_settings["max_width"] = int(max_width)
+    _encode_settings["thumb_width"] = int(thumb_width)
+
+def _is_ng_class(name: str) -> bool:
+    name = name.lower()
+    return "ng" in name or "defect" in name
+
+def _clamp_quality(quality: int) -> int:
+    return max(1, min(100, int(quality)))
+
+def _resize_to_width(frame, width: int):
+    scale = width / frame.shape[1]
+    return cv2.resize(frame, (width, max(1, int(frame.shape[0] * scale))), interpolation=cv2.INTER_AREA), scale
+
+def annotate_and_encode(frame, boxes, names, quality: int = 80, max_width: int = 1280, thumb_width: int = 0) -> Optional[dict]:
+    """Vẽ khung nhận diện lên frame (theo `boxes` thô), encode JPEG và thumbnail (nếu `thumb_width` > 0)."""
+    if frame is None:
+        return None
+    scale = 1.0
+    if max_width and frame.shape[1] > max_width:
+        canvas, scale = _resize_to_width(frame, max_width)
+    else:
+        canvas = frame.copy()
+
+    for x1, y1, x2, y2, conf, cls_idx in boxes:
+        name = names.get(int(cls_idx), str(int(cls_idx)))
+        color = (0, 0, 255) if _is_ng_class(name) else (0, 200, 0)
+        p1 = (int(x1 * scale), int(y1 * scale))
+        p2 = (int(x2 * scale), int(y2 * scale))
+        cv2.rectangle(canvas, p1, p2, color, 2)
+        cv2.putText(canvas, f"{name} {conf:.2f}", (p1[0], max(p1[1] - 4, 10)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1, cv2.LINE_AA)
+
+    success, buffer = cv2.imencode(".jpg", canvas, [int(cv2.IMWRITE_JPEG_QUALITY), _clamp_quality(quality)])
+    if not success:
+        return None
+
+    thumbnail = None
+    if thumb_width and thumb_width < canvas.shape[1]:
+        thumb, _ = _resize_to_width(canvas, thumb_width)
+        ok, thumb_buffer = cv2.imencode(".jpg", thumb, [int(cv2.IMWRITE_JPEG_QUALITY), 60])
+        thumbnail = thumb_buffer.tobytes() if ok else None
+    return {"image": buffer.tobytes(), "thumbnail": thumbnail}
+
+async def render_detection_images(ai_data: dict) -> Optional[dict]:
+    """Annotate + encode JPEG/thumbnail kết quả detect trên thread pool (không chặn event loop)."""
+    if ai_data.get("frame") is None:
+        return None
+    if _encode_pool is None:
+        configure_annotation()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _encode_pool, annotate_and_encode,
+        ai_data["frame"], ai_data.get("boxes", []), ai_data.get("names", {}),
+        _encode_settings["quality"], _encode_settings["max_width"], _encode_settings["thumb_width"]
+    )
+
+CONTINUOUS = "continuous"
+ON_DEMAND = "on_demand"
+
+class CameraStream:
+    """
+    Một luồng RTSP với thread đọc frame riêng (dùng chung cho các máy cùng camera).
+    - `continuous`: decode mọi frame vào ring buffer.
+    - `on_demand`: chỉ `grab()` để giữ luồng realtime, `retrieve()` (decode) khi có job detect cần frame.
+    - `idle_url`: sau `idle_after` giây không có yêu cầu detect, chuyển sang sub-stream để giảm tải.
+    - Đọc lỗi liên tiếp `max_failures` lần hoặc bị `CameraSupervisor` báo stall thì kết nối lại
+      với backoff lũy thừa trong khoảng `backoff`.
+    """
+
+    def __init__(
+        self,
+        url,
+        buffer_depth: int = 8,
+        match_tolerance: float = 0.1,
+        pulse_offset: float = 0.0,
+        wait_timeout: float = 0.2,
+        decode_mode: str = CONTINUOUS,
+        idle_url: Optional[str] = None,
+        idle_after: float = 60.0,
+        max_failures: int = 50,
+        backoff: tuple = (1.0, 30.0),
+        open_timeout_ms: int = 5000,
+        read_timeout_ms: int = 5000,
+    ):
+        if decode_mode not in (CONTINUOUS, ON_DEMAND):
+            raise ValueError(f"Chế độ decode không hợp lệ: {decode_mode}")
+        self.url = url
+        self.pulse_offset = pulse_offset
+        self.wait_timeout = wait_timeout
+        self.decode_mode = decode_mode
+        self.idle_url = idle_url
+        self.idle_after = idle_after
+        self.max_failures = max_failures
+        self.backoff_min, self.backoff_max = backoff
+        self.open_timeout_ms = open_timeout_ms
+        self.read_timeout_ms = read_timeout_ms
+        self.frames = FrameRingBuffer(buffer_depth, match_tolerance)
+
+        self._shape = None
+        self._on_idle = False
+        self._last_demand = time.time()
+        self._requests: List[float] = []
+        self._req_lock = threading.Lock()
+        self._counters = {"grabbed": 0, "decoded": 0, "read_failures": 0, "reconnects": 0, "source_switches": 0}
+
+        # Giám sát kết nối
+        self._stop_event = threading.Event()
+        self._reconnect_requested = threading.Event()
+        self._reconnecting = False
+        self._consecutive_failures = 0
+        self._backoff = self.backoff_min
+        self.last_ok = time.time()
+        self._fps = 0.0
+        self._decode_ms = 0.0
+
+        self.cap = self._open(url)
         self.running = True
 
         self.reader_thread = threading.Thread(target=self._camera_reader, daemon=True)
         self.reader_thread.start()
 
+    def _open(self, url):
+        params = [cv2.CAP_PROP_OPEN_TIMEOUT_MSEC, self.open_timeout_ms, cv2.CAP_PROP_READ_TIMEOUT_MSEC, self.read_timeout_ms]
+        try:
+            cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG, params)
+        except (TypeError, AttributeError):
+            # OpenCV < 4.6 không hỗ trợ timeout khi mở luồng
+            cap = cv2.VideoCapture(url, cv2.CAP_FFMPEG)
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+
+    def _check_idle(self):
+        if not self.idle_url:
+            return
+        idle = time.time() - self._last_demand > self.idle_after
+        if idle == self._on_idle:
+            return
+        self.cap.release()
+        self.cap = self._open(self.idle_url if idle else self.url)
+        self._on_idle = idle
+        self._shape = None
+        # Frame của luồng cũ không được dùng để detect
+        self.frames.clear()
+        self._counters["source_switches"] += 1
+        print(f">>> [CAMERA] {self.url}: chuyển sang {'sub-stream (idle)' if idle else 'main stream'}", flush=True)
+
+    def request_reconnect(self):
+        """Gọi từ `CameraSupervisor` khi luồng bị stall."""
+        self._reconnect_requested.set()
+
+    @property
+    def reconnect_pending(self) -> bool:
+        """Đang chờ hoặc đang kết nối lại (supervisor không yêu cầu thêm)."""
+        return self._reconnecting or self._reconnect_requested.is_set()
+
+    def _reconnect(self):
+        self._reconnecting = True
+        try:
+            self.cap.release()
+            print(f">>> [CAMERA] {self.url}: mất luồng, kết nối lại sau {self._backoff:.1f}s", flush=True)
+            if self._stop_event.wait(self._backoff):
+                return
+            self._backoff = min(self._backoff * 2, self.backoff_max)
+            self.cap = self._open(self.idle_url if self._on_idle else self.url)
+            self._shape = None
+            self._consecutive_failures = 0
+            self._counters["reconnects"] += 1
+            # Tính lại mốc stall từ lúc kết nối lại để supervisor không báo lặp
+            self.last_ok = time.time()
+            # Chỉ xóa yêu cầu sau khi đã mở lại: yêu cầu trong lúc chờ backoff thuộc về lần kết nối này
+            self._reconnect_requested.clear()
+        finally:
+            self._reconnecting = False
+
+    def _on_read(self, ok: bool):
+        now = time.time()
+        if not ok:
+            self._consecutive_failures += 1
+            self._counters["read_failures"] += 1
+            return
+        if self._consecutive_failures or self._backoff != self.backoff_min:
+            self._consecutive_failures = 0
+            self._backoff = self.backoff_min
+        interval = now - self.last_ok
+        if interval > 0:
+            self._fps = 0.9 * self._fps + 0.1 * (1.0 / interval) if self._fps else 1.0 / interval
+        self.last_ok = now
+
+    def _decode_into_buffer(self, decode, timestamp: Optional[float] = None) -> bool:
+        """`decode(dst)` là `cap.read`/`cap.retrieve`; decode thẳng vào slot của ring buffer."""
+        started = time.perf_counter()
+        if self._shape is None:
+            # Frame đầu tiên: chưa biết độ phân giải để cấp phát slot
+            ret, frame = decode(None)
+            if not ret or frame is None:
+                return False
+            self._shape = frame.shape
+            idx, slot = self.frames.write_slot(self._shape)
+            slot[...] = frame
+            frame = None
+        else:
+            idx, slot = self.frames.write_slot(self._shape)
+            ret, frame = decode(slot)
+            if not ret or frame is None:
+                return False
+            self._shape = frame.shape
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._decode_ms = 0.9 * self._decode_ms + 0.1 * elapsed_ms if self._decode_ms else elapsed_ms
+        self._counters["decoded"] += 1
+        self.frames.commit(idx, timestamp if timestamp is not None else time.time(), frame)
+        return True
+
+    def _take_due_requests(self, timestamp: float) -> bool:
+        with self._req_lock:
+            if not self._requests or min(self._requests) > timestamp:
+                return False
+            self._requests = [t for t in self._requests if t > timestamp]
+            return True
+
     def _camera_reader(self):
+        read = lambda dst: self.cap.read() if dst is None else self.cap.read(dst)
+        retrieve = lambda dst: self.cap.retrieve() if dst is None else self.cap.retrieve(dst)
         while self.running:
-            ret, frame = self.cap.read()
-            if ret and frame is not None:
-                with self.lock:
-                    self.latest_frame = frame
-            time.sleep(0.01)
-
-    def capture_and_detect(self):
-        with self.lock:
-            if self.latest_frame is None:
-                return None
-            frame = self.latest_frame.copy()
-
-        # 1. AI Inference
-        results = self.model.predict(source=frame, imgsz=640, conf=0.25, verbose=False)
-        
+            if self._reconnect_requested.is_set() or self._consecutive_failures >= self.max_failures:
+                self._reconnect()
+                continue
+            self._check_idle()
+            if self.decode_mode == CONTINUOUS:
+                ok = self._decode_into_buffer(read)
+                self._on_read(ok)
+                if not ok:
+                    time.sleep(0.01)
+                continue
+
+            # on_demand: grab rẻ để luồng luôn ở frame mới nhất, chỉ decode khi có job cần
+            ok = self.cap.grab()
+            self._on_read(ok)
+            if not ok:
+                time.sleep(0.01)
+                continue
+            grabbed_at = time.time()
+            self._counters["grabbed"] += 1
+            if self._take_due_requests(grabbed_at) or self._shape is None:
+                self._decode_into_buffer(retrieve, grabbed_at)
+
+    def acquire_frame(self, pulse_time: Optional[float] = None) -> Optional[FrameRef]:
+        """Ghim frame gần `pulse_time + pulse_offset` nhất (mặc định: frame mới nhất)."""
+        self._last_demand = time.time()
+        if pulse_time is None and self.decode_mode == CONTINUOUS:
+            return self.frames.acquire()
+        target = (pulse_time if pulse_time is not None else time.time()) + self.pulse_offset
+        if self.decode_mode == ON_DEMAND:
+            with self._req_lock:
+                self._requests.append(target)
+        return self.frames.acquire(target, wait_timeout=self.wait_timeout)
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.decode_mode,
+            "source": "idle" if self._on_idle else "main",
+            "fps": round(self._fps, 1),
+            "decode_ms": round(self._decode_ms, 1),
+            "since_last_read_ms": round((time.time() - self.last_ok) * 1000, 1),
+            **self._counters,
+            **self.frames.stats(),
+        }
+
+    def stop(self):
+        self.running = False
+        self._stop_event.set()
+        self.cap.release()
+
+class CameraSupervisor:
+    """Thread giám sát các luồng camera: không đọc được frame quá `stall_timeout` giây thì yêu cầu kết nối lại."""
+
+    def __init__(self, streams: List[CameraStream], stall_timeout: float = 5.0, interval: float = 1.0):
+        self.streams = streams
+        self.stall_timeout = stall_timeout
+        self.interval = interval
+        self.stalls = 0
+        self._stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="camera-supervisor", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            now = time.time()
+            for stream in self.streams:
+                age = now - stream.last_ok
+                if age > self.stall_timeout and not stream.reconnect_pending:
+                    self.stalls += 1
+                    print(f">>> [CAMERA SUPERVISOR] {stream.url}: không có frame trong {age:.1f}s, yêu cầu kết nối lại", flush=True)
+                    stream.request_reconnect()
+
+    def stop(self):
+        self._stop_event.set()
+
+class CameraSystem:
+    """
+    Registry camera theo `machinecode` dùng chung một model YOLO.
+    `cameras`: {machinecode: rtsp_url}, key "*" là camera mặc định cho các máy chưa khai báo.
+    `backend`: pytorch / onnx / openvino / openvino_int8 (xem `backends.py`).
+    `idle_urls`: {rtsp_url: sub_stream_url} dùng khi camera rảnh.
+    `preprocess`: {machinecode: {"roi": [x, y, w, h], "imgsz": 480, "letterbox": True}}.
+    `stale_policy`: frame cũ hơn thời điểm pulse quá `max_frame_age` giây sẽ bị bỏ qua ("skip")
+    hoặc vẫn detect nhưng gắn cờ `stale` ("flag").
+    `result_cache_size` / `sample_every` / `diff_threshold`: tái sử dụng kết quả (xem `result_cache.py`).
+    """
+
+    def __init__(
+        self,
+        cameras: Dict[str, str],
+        model_path,
+        backend: str = PYTORCH,
+        cache_dir: Optional[str] = None,
+        imgsz: int = 640,
+        warmup_runs: int = 0,
+        batch_size: int = 1,
+        int8_data: Optional[str] = None,
+        stream_options: Optional[dict] = None,
+        idle_urls: Optional[Dict[str, str]] = None,
+        preprocess: Optional[Dict[str, dict]] = None,
+        stall_timeout: float = 5.0,
+        max_frame_age: float = 1.0,
+        stale_policy: str = "skip",
+        result_cache_size: int = 64,
+        sample_every: int = 1,
+        diff_threshold: float = 0.0,
+    ):
+        print(f"--- Đang nạp Model YOLO từ: {model_path} (backend={backend}) ---", flush=True)
+        self.backend = backend
+        self.imgsz = imgsz
+        # Model export tĩnh (batch=1) chỉ chạy được đúng imgsz lúc export
+        self._flexible_imgsz = backend == PYTORCH or batch_size > 1
+        self.model = load_model(
+            model_path, backend, cache_dir or os.path.dirname(model_path),
+            imgsz=imgsz, dynamic=batch_size > 1, int8_data=int8_data
+        )
+        # YOLO predictor không thread-safe khi nhiều inference worker dùng chung model
+        self.model_lock = threading.Lock()
+        self.latency = LatencyTracker()
+
+        if warmup_runs > 0:
+            latencies = warmup(self.model, imgsz=imgsz, runs=warmup_runs, batch_size=batch_size)
+            print(f">>> [CAMERA] Warmup {backend}: {[round(l * 1000, 1) for l in latencies]} ms", flush=True)
+
+        self.camera_map: Dict[str, str] = {}
+        self.streams: Dict[str, CameraStream] = {}
+        for machinecode, url in cameras.items():
+            if not url:
+                continue
+            key = machinecode.strip().lower() if machinecode != DEFAULT_CAMERA else DEFAULT_CAMERA
+            self.camera_map[key] = url
+            if url not in self.streams:
+                idle_url = (idle_urls or {}).get(url)
+                self.streams[url] = CameraStream(url, idle_url=idle_url, **(stream_options or {}))
+        print(f">>> [CAMERA] Đã mở {len(self.streams)} luồng cho {len(self.camera_map)} máy", flush=True)
+
+        self.max_frame_age = max_frame_age
+        self.stale_policy = stale_policy
+        self.stale_counts = {"skipped": 0, "flagged": 0}
+        self.supervisor = CameraSupervisor(list(self.streams.values()), stall_timeout=stall_timeout)
+        self.reuse = ResultReuse(result_cache_size, sample_every, diff_threshold)
+
+        self.preprocessors: Dict[str, FramePreprocessor] = {}
+        for machinecode, settings in (preprocess or {}).items():
+            self.set_preprocess(machinecode, settings)
+
+    def get_stream(self, machinecode: Optional[str]) -> Optional[CameraStream]:
+        key = machinecode.strip().lower() if machinecode else DEFAULT_CAMERA
+        url = self.camera_map.get(key) or self.camera_map.get(DEFAULT_CAMERA)
+        return self.streams.get(url) if url else None
+
+    def set_preprocess(self, machinecode: str, settings: Optional[dict]):
+        """Cấu hình ROI/resize/letterbox cho một máy (`settings` rỗng = dùng nguyên frame)."""
+        key = machinecode.strip().lower()
+        prep = FramePreprocessor.from_settings(settings)
+        if prep and prep.imgsz and prep.imgsz != self.imgsz and not self._flexible_imgsz:
+            print(f">>> [CAMERA] {machinecode}: backend {self.backend} cố định imgsz={self.imgsz}, bỏ qua imgsz={prep.imgsz}", flush=True)
+            prep = FramePreprocessor(prep.roi, self.imgsz, prep.letterbox)
+        if prep:
+            self.preprocessors[key] = prep
+        else:
+            self.preprocessors.pop(key, None)
+
+    def get_preprocessor(self, machinecode: Optional[str]) -> Optional[FramePreprocessor]:
+        return self.preprocessors.get(machinecode.strip().lower()) if machinecode else None
+
+    def detect_batch(self, machinecodes: List[str], pulse_times: Optional[List[float]] = None, keep_frame=None) -> List[Optional[dict]]:
+        """
+        Detect cho nhiều máy trong một lần `model.predict` (mỗi nhóm imgsz một lần).
+        - Mỗi máy dùng frame gần thời điểm pulse (`pulse_times`) nhất trong ring buffer.
+        - Frame được cắt ROI/thu nhỏ theo cấu hình của máy trước khi inference,
+          box trả về đã được map lại tọa độ frame gốc.
+        - Các máy trỏ cùng một frame với cùng cấu hình tiền xử lý chỉ được inference một lần.
+        - Frame chỉ được copy ra khỏi ring buffer khi `keep_frame(result)` trả về True
+          (mặc định luôn giữ) để phục vụ annotate ảnh defect.
+        - Pulse trỏ tới frame đã detect (hoặc bị bỏ qua bởi chế độ lấy mẫu) nhận lại kết quả
+          cũ, đánh dấu `reused` và không kèm frame.
+        Kết quả trả về theo đúng thứ tự của `machinecodes`.
+        """
+        entries, entry_index, job_index = [], {}, []
+        for i, machinecode in enumerate(machinecodes):
+            stream = self.get_stream(machinecode)
+            ref = stream.acquire_frame(pulse_times[i] if pulse_times else None) if stream else None
+            if ref is None:
+                job_index.append(None)
+                continue
+            reference = (pulse_times[i] + stream.pulse_offset) if pulse_times else time.time()
+            stale = reference - ref.timestamp > self.max_frame_age
+            if stale and self.stale_policy == "skip":
+                # Luồng camera bị treo/mất: không tốn inference cho ảnh cũ
+                self.stale_counts["skipped"] += 1
+                print(f">>> [CAMERA] Bỏ qua detect cho {machinecode}: frame cũ {reference - ref.timestamp:.1f}s", flush=True)
+                ref.release()
+                job_index.append(None)
+                continue
+            prep = self.get_preprocessor(machinecode)
+            key = (stream.url, ref.seq, id(prep) if prep else None)
+            if key in entry_index:
+                ref.release()
+                machines = entries[entry_index[key]]["machines"]
+                if any(m.strip() == machinecode.strip() for m, _ in machines):
+                    # Cùng máy, cùng frame trong một lô: kết quả dùng lại như khi nằm ở hai lô khác nhau
+                    job_index.append(("same_frame", entry_index[key]))
+                else:
+                    machines.append((machinecode, None))
+                    job_index.append(entry_index[key])
+                continue
+            # Pulse trỏ tới frame đã detect: dùng lại kết quả, không inference lại
+            cached = self.reuse.lookup(key)
+            if cached is not None:
+                ref.release()
+                job_index.append(cached)
+                continue
+            image, transform = prep.apply(ref.frame) if prep else (ref.frame, None)
+            reused, thumb = self.reuse.sample(machinecode, image)
+            if reused is not None:
+                ref.release()
+                job_index.append(reused)
+                continue
+            imgsz = prep.imgsz if prep and prep.imgsz else self.imgsz
+            entry_index[key] = len(entries)
+            entries.append({"ref": ref, "key": key, "image": image, "transform": transform, "imgsz": imgsz,
+                            "stale": stale, "machines": [(machinecode, thumb)]})
+            job_index.append(entry_index[key])
+
+        summaries = [None] * len(entries)
+        try:
+            # 1. AI Inference (batch theo imgsz) trực tiếp trên slot của ring buffer
+            groups: Dict[int, List[int]] = {}
+            for idx, entry in enumerate(entries):
+                groups.setdefault(entry["imgsz"], []).append(idx)
+            for imgsz, indices in groups.items():
+                with self.model_lock:
+                    started = time.perf_counter()
+                    results = self.model.predict(source=[entries[i]["image"] for i in indices], imgsz=imgsz, conf=0.25, verbose=False)
+                    self.latency.record(self.backend, time.perf_counter() - started)
+
+                for idx, result in zip(indices, results):
+                    entry, ref = entries[idx], entries[idx]["ref"]
+                    summary = self._summarize(result)
+                    summary["boxes"] = FramePreprocessor.map_boxes(summary["boxes"], entry["transform"])
+                    summary["frame_seq"] = ref.seq
+                    summary["frame_time"] = ref.timestamp
+                    if entry["stale"]:
+                        summary["stale"] = True
+                        self.stale_counts["flagged"] += 1
+                    for machinecode, thumb in entry["machines"]:
+                        self.reuse.store(entry["key"], machinecode, summary, thumb)
+                    if keep_frame is None or keep_frame(summary):
+                        summary["frame"] = ref.frame.copy()
+                    summaries[idx] = summary
+        finally:
+            for entry in entries:
+                entry["ref"].release()
+
+        outputs = []
+        for machinecode, idx in zip(machinecodes, job_index):
+            if isinstance(idx, dict):
+                outputs.append(idx)
+                continue
+            if isinstance(idx, tuple):
+                _, idx = idx
+                outputs.append(self.reuse.same_frame(summaries[idx]) if summaries[idx] is not None else None)
+                continue
+            if idx is None or summaries[idx] is None:
+                outputs.append(None)
+                continue
+            res = summaries[idx]
+            print(f">>> [CAMERA] Detect thành công cho {machinecode}: {res['count']} objects (NG Pill: {res['ng_pill']})", flush=True)
+            outputs.append(res)
+        return outputs
+
+    def _summarize(self, result):
+        """Chỉ trả về số lượng và box thô; việc vẽ/encode ảnh để dành cho frame bị lỗi."""
         # 2. Phân loại và đếm
-        classes = results[0].boxes.cls.tolist() if hasattr(results[0].boxes, 'cls') else []
+        boxes = result.boxes
+        classes = boxes.cls.tolist() if hasattr(boxes, 'cls') else []
         count = len(classes)
-        
+
         # Đếm ng_pill dựa trên class name
         ng_pill = 0
         names = self.model.names
         for cls_idx in classes:
-            name = names.get(cls_idx, "").lower()
-            if "ng" in name or "defect" in name:
+            if _is_ng_class(names.get(int(cls_idx), "")):
                 ng_pill += 1
-                
-        print(f">>> [CAMERA] Detect thành công: {count} objects (NG Pill: {ng_pill})", flush=True)
-        
-        # 3. Vẽ kết quả lên ảnh
-        annotated_frame = results[0].plot()
-
-        # 4. Encode ảnh sang dạng Binary (JPEG)
-        success, buffer = cv2.imencode(".jpg", annotated_frame)
-        
-        if success:
-            return {
-                "count": count,
-                "ng_pill": ng_pill,
-                "image_bytes": buffer.tobytes()
-            }
-        return None
+
+        raw_boxes = []
+        if count:
+            for xyxy, conf, cls_idx in zip(boxes.xyxy.tolist(), boxes.conf.tolist(), classes):
+                raw_boxes.append([*xyxy, conf, int(cls_idx)])
+
+        return {
+            "count": count,
+            "ng_pill": ng_pill,
+            "boxes": raw_boxes,
+            "names": names
+        }
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "latency": self.latency.stats(),
+            "stale_frames": dict(self.stale_counts),
+            "reuse": self.reuse.stats(),
+            "stalls": self.supervisor.stalls,
+            "streams": {url: stream.stats() for url, stream in self.streams.items()},
+        }
 
     def stop(self):
-        self.running = False
-        self.cap.release()
+        self.supervisor.stop()
+        for stream in self.streams.values():
+            stream.stop()
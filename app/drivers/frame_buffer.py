@@ -0,0 +1,156 @@
+import time
+import threading
+from typing import List, Optional
+
+import numpy as np
+
+
+class FrameRef:
+    """Tham chiếu (không copy) tới một slot trong ring buffer; slot bị ghim cho tới khi `release()`."""
+    __slots__ = ("buffer", "index", "seq", "timestamp", "frame")
+
+    def __init__(self, buffer, index, seq, timestamp, frame):
+        self.buffer = buffer
+        self.index = index
+        self.seq = seq
+        self.timestamp = timestamp
+        self.frame = frame
+
+    def release(self):
+        if self.buffer is not None:
+            self.buffer.release(self.index)
+            self.buffer = None
+
+
+class FrameRingBuffer:
+    """
+    Ring buffer N frame cấp phát sẵn, kèm thời điểm capture và số thứ tự (seq).
+    - Reader ghi thẳng vào slot (`cap.read(slot)`), không cấp phát mới mỗi frame.
+    - Detect lấy frame gần thời điểm pulse nhất và ghim slot trong lúc inference,
+      reader sẽ bỏ qua các slot đang bị ghim.
+    """
+
+    def __init__(self, depth: int = 8, match_tolerance: float = 0.1):
+        self.depth = max(2, int(depth))
+        self.match_tolerance = match_tolerance
+        self._slots: List[Optional[np.ndarray]] = [None] * self.depth
+        self._ts = [0.0] * self.depth
+        self._seq = [-1] * self.depth
+        self._pins = [0] * self.depth
+        self._next = 0
+        self._last_seq = -1
+        self._cond = threading.Condition()
+        self._scratch: Optional[np.ndarray] = None
+
+        self._stats = {"captured": 0, "skipped_pinned": 0, "hits": 0, "misses": 0, "empty": 0}
+        self._age_total = 0.0
+        self._age_max = 0.0
+        self._offset_total = 0.0
+
+    # --- Phía reader ---
+
+    def write_slot(self, shape) -> tuple:
+        """Chọn slot kế tiếp không bị ghim để reader ghi frame vào. Trả về (index, array)."""
+        with self._cond:
+            for _ in range(self.depth):
+                idx = self._next
+                self._next = (self._next + 1) % self.depth
+                if self._pins[idx] == 0:
+                    break
+            else:
+                # Tất cả slot đang được inference dùng: đọc vào vùng nháp để giữ luồng realtime
+                self._stats["skipped_pinned"] += 1
+                if self._scratch is None or self._scratch.shape != tuple(shape):
+                    self._scratch = np.empty(shape, dtype=np.uint8)
+                return -1, self._scratch
+            self._seq[idx] = -1
+            slot = self._slots[idx]
+            if slot is None or slot.shape != tuple(shape):
+                slot = self._slots[idx] = np.empty(shape, dtype=np.uint8)
+            return idx, slot
+
+    def commit(self, idx: int, timestamp: float, frame: Optional[np.ndarray] = None):
+        """Đánh dấu slot đã có frame hợp lệ. `frame` khác slot (đổi độ phân giải) sẽ thay slot."""
+        if idx < 0:
+            return
+        with self._cond:
+            if frame is not None and frame is not self._slots[idx]:
+                self._slots[idx] = frame
+            self._last_seq += 1
+            self._seq[idx] = self._last_seq
+            self._ts[idx] = timestamp
+            self._stats["captured"] += 1
+            self._cond.notify_all()
+
+    def clear(self):
+        """Vô hiệu hóa toàn bộ frame hiện có (ví dụ khi đổi luồng camera)."""
+        with self._cond:
+            self._seq = [-1] * self.depth
+
+    # --- Phía detect ---
+
+    def _newest_ts(self) -> float:
+        return max((ts for ts, seq in zip(self._ts, self._seq) if seq >= 0), default=0.0)
+
+    def acquire(self, target_ts: Optional[float] = None, wait_timeout: float = 0.0) -> Optional[FrameRef]:
+        """
+        Ghim và trả về frame có thời điểm capture gần `target_ts` nhất (mặc định: frame mới nhất).
+        Nếu chưa có frame nào chụp sau `target_ts`, chờ tối đa `wait_timeout` giây.
+        """
+        with self._cond:
+            if target_ts is not None and wait_timeout > 0:
+                deadline = time.time() + wait_timeout
+                while self._newest_ts() < target_ts:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+            best, best_dist = -1, None
+            for idx in range(self.depth):
+                if self._seq[idx] < 0:
+                    continue
+                if target_ts is None:
+                    dist = -self._seq[idx]
+                else:
+                    dist = abs(self._ts[idx] - target_ts)
+                if best_dist is None or dist < best_dist:
+                    best, best_dist = idx, dist
+
+            if best < 0:
+                self._stats["empty"] += 1
+                return None
+
+            self._pins[best] += 1
+            ts = self._ts[best]
+            age = max(0.0, time.time() - ts)
+            self._age_total += age
+            self._age_max = max(self._age_max, age)
+            if target_ts is not None:
+                offset = abs(ts - target_ts)
+                self._offset_total += offset
+                self._stats["hits" if offset <= self.match_tolerance else "misses"] += 1
+            else:
+                self._stats["hits"] += 1
+            return FrameRef(self, best, self._seq[best], ts, self._slots[best])
+
+    def release(self, idx: int):
+        with self._cond:
+            if self._pins[idx] > 0:
+                self._pins[idx] -= 1
+
+    def stats(self) -> dict:
+        with self._cond:
+            acquired = self._stats["hits"] + self._stats["misses"]
+            newest = self._newest_ts()
+            return {
+                "depth": self.depth,
+                "filled": sum(1 for seq in self._seq if seq >= 0),
+                "pinned": sum(1 for p in self._pins if p > 0),
+                **self._stats,
+                "hit_rate": round(self._stats["hits"] / acquired, 3) if acquired else 0.0,
+                "avg_offset_ms": round(self._offset_total / acquired * 1000, 1) if acquired else 0.0,
+                "avg_age_ms": round(self._age_total / acquired * 1000, 1) if acquired else 0.0,
+                "max_age_ms": round(self._age_max * 1000, 1),
+                "newest_age_ms": round((time.time() - newest) * 1000, 1) if newest else None,
+            }
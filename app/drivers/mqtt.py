@@ -1,104 +1,329 @@
 import paho.mqtt.client as mqtt
-import json
+import time
+import asyncio
+import traceback
+from app.utils.codec import TopicCodecs
+from app.drivers.outbox import OutboundQueue
 
-class BaseMQTTService:
-    def __init__(self, broker_host, broker_port, topic, username=None, password=None, prefix="MQTT"):
+# --- Topic dùng chung giữa Edge và HMI/IoT ---
+TOPIC_COUNTER = "topic/sensor/counter"
+TOPIC_HMI_DEFECT = "topic/defect/hmi"
+TOPIC_CHANGEOVER = "topic/changover/hmi"
+TOPIC_DOWNTIME_INPUT = "topic/downtimeinput"
+TOPIC_GET_DEFECT_MASTER = "topic/get/defectmaster"
+TOPIC_PRODUCTION_RECORD = "topic/get/productionrecord"
+TOPIC_GET_PRODUCT_MASTER = "topic/get/productcode"
+TOPIC_GET_DOWNTIME = "topic/get/downtime"
+TOPIC_GET_DOWNTIME_MASTER = "topic/get/downtimecode"
+TOPIC_DOWNTIME_UPDATE = "topic/pub/downtimereason"
+
+# Network I/O của paho: thread riêng (`loop_start`) hoặc chạy thẳng trên event loop asyncio
+IO_THREAD = "thread"
+IO_ASYNCIO = "asyncio"
+
+class _Route:
+    """Handler của một topic kèm hàng đợi giới hạn và các worker xử lý trên event loop."""
+
+    def __init__(self, topic, handler, prefix, concurrency, queue_size, with_timestamp):
+        self.topic = topic
+        self.handler = handler
+        self.prefix = prefix
+        self.concurrency = max(1, int(concurrency))
+        self.queue = asyncio.Queue(maxsize=max(1, int(queue_size)))
+        self.with_timestamp = with_timestamp
+        self.workers = []
+        self.inflight = 0
+        self.counters = {"received": 0, "processed": 0, "errors": 0, "dropped": 0}
+        self.last_error = None
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "queued": self.queue.qsize(),
+            "inflight": self.inflight,
+            "concurrency": self.concurrency,
+            "last_error": self.last_error,
+        }
+
+class MQTTRouter:
+    """
+    Một kết nối MQTT dùng chung cho toàn bộ Edge: subscribe tất cả topic đã đăng ký
+    và chuyển từng message tới handler tương ứng (hỗ trợ wildcard `+`/`#`).
+    - Handler là coroutine `handler(data)` (hoặc `handler(data, received_at)`), chạy trên event loop
+      qua hàng đợi giới hạn của từng topic với tối đa `concurrency` message xử lý đồng thời.
+      Hàng đợi đầy thì bỏ message cũ nhất; lỗi của handler được log và đếm trong `stats()`.
+    - `io_mode="asyncio"`: socket của paho được theo dõi bằng `add_reader/add_writer` của event loop,
+      message đi thẳng vào hàng đợi mà không qua thread trung gian.
+      `io_mode="thread"`: paho chạy network thread riêng (`loop_start`), mỗi message một lần `call_soon_threadsafe`.
+    Khi kết nối lại, toàn bộ subscription được khôi phục trong một lệnh SUBSCRIBE.
+    Payload được encode/decode theo codec của từng topic (`codecs`, mặc định JSON, xem `app/utils/codec.py`).
+    `outbox` (dict tham số của `OutboundQueue`): publish qua hàng đợi store-and-forward, message của
+    topic thuộc `coalesce_topics` thay thế message cũ chưa gửi của cùng máy.
+    """
+
+    def __init__(
+        self, broker_host, broker_port, username=None, password=None, prefix="MQTT", client_id="",
+        loop=None, io_mode=IO_ASYNCIO, concurrency=4, queue_size=1000, keepalive=60, backoff=(1, 30),
+        codecs=None, outbox=None, coalesce_topics=(), max_inflight=100
+    ):
         self.broker_host = broker_host
         self.broker_port = broker_port
-        self.topic = topic
         self.prefix = prefix
-        print(f">>> [{self.prefix}] Initializing on topic: {self.topic}")
-        
+        self.loop = loop
+        self.io_mode = io_mode
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self.backoff = backoff
+        self.routes = {}  # topic -> _Route
+        self.codecs = codecs or TopicCodecs()
+        if self.codecs.matcher is None:
+            self.codecs.matcher = mqtt.topic_matches_sub
+        self.reconnects = 0
+        self._sock = None
+        self._misc_task = None
+        self._started = False
+        self._stopping = False
+
         try:
             # Paho MQTT v2.0+ support
-            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id)
         except AttributeError:
             # Paho MQTT v1.x
-            self.client = mqtt.Client()
-            
+            self.client = mqtt.Client(client_id=client_id)
+
         if username and password:
             self.client.username_pw_set(username, password)
-            
+
+        self.client.reconnect_delay_set(min_delay=backoff[0], max_delay=backoff[1])
+        self.coalesce_topics = tuple(coalesce_topics)
+        self.outbox = None
+        if outbox is not None:
+            # Giới hạn bộ nhớ của paho: phần vượt quá nằm lại trong outbox (có spool)
+            self.client.max_queued_messages_set(max_inflight)
+            self.outbox = OutboundQueue(self._send, self.client.is_connected, **outbox)
         self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self._on_message
-        self.external_callback = None
+        if self.io_mode == IO_ASYNCIO:
+            self.client.on_socket_open = self._on_socket_open
+            self.client.on_socket_close = self._on_socket_close
+            self.client.on_socket_register_write = self._on_socket_register_write
+            self.client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def add_route(self, topic, handler, prefix=None, concurrency=None, queue_size=None, with_timestamp=False):
+        """
+        Đăng ký coroutine `handler` cho một topic. Gọi được cả khi đã kết nối.
+        `with_timestamp=True`: handler nhận thêm thời điểm message tới (`time.time()`).
+        """
+        route = _Route(
+            topic, handler, prefix or self.prefix,
+            concurrency or self.concurrency, queue_size or self.queue_size, with_timestamp
+        )
+        self.routes[topic] = route
+        if self._started:
+            self._start_workers(route)
+        if self.client.is_connected():
+            self.client.subscribe(topic, qos=1)
+
+    # --- Kết nối ---
 
     def _on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             print(f">>> [{self.prefix}] Đã kết nối tới {self.broker_host}", flush=True)
-            self.client.subscribe(self.topic, qos=1)
-            print(f">>> [{self.prefix}] Đã subscribe: {self.topic}", flush=True)
+            if self.routes:
+                self.client.subscribe([(topic, 1) for topic in self.routes])
+                print(f">>> [{self.prefix}] Đã subscribe {len(self.routes)} topic: {list(self.routes)}", flush=True)
+            if self.outbox:
+                self.outbox.notify()
         else:
             print(f">>> [{self.prefix}] Kết nối thất bại, mã lỗi: {rc}", flush=True)
 
-    def _on_message(self, client, userdata, msg):
-        try:
-            payload_str = msg.payload.decode("utf-8")
-            data = json.loads(payload_str)
-            print(f"[{self.prefix}] Received on {msg.topic}: {msg.payload}")
-            if self.external_callback:
-                self.external_callback(data)
-        except Exception as e:
-            print(f"[{self.prefix}] Lỗi parse dữ liệu: {e}")
+    def _on_disconnect(self, client, userdata, rc):
+        if rc != 0 and not self._stopping:
+            self.reconnects += 1
+            print(f">>> [{self.prefix}] Mất kết nối (mã {rc}), đang kết nối lại...", flush=True)
 
-    def set_callback(self, callback_func):
-        self.external_callback = callback_func
+    # --- Chế độ asyncio: event loop theo dõi socket của paho ---
 
-    def start(self):
-        self.client.connect(self.broker_host, self.broker_port, 60)
-        self.client.loop_start()
+    def _on_socket_open(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._watch_socket, sock)
 
-    def stop(self):
-        self.client.loop_stop()
-        self.client.disconnect()
+    def _on_socket_close(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._unwatch_socket, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._watch_write, sock)
 
-    def publish(self, topic, data):
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self._unwatch_write, sock)
+
+    def _watch_socket(self, sock):
+        self._sock = sock
+        self.loop.add_reader(sock, self.client.loop_read)
+
+    def _unwatch_socket(self, sock):
+        for remove in (self.loop.remove_reader, self.loop.remove_writer):
+            try:
+                remove(sock)
+            except (ValueError, OSError):
+                pass
+        if self._sock is sock:
+            self._sock = None
+
+    def _watch_write(self, sock):
+        if self._sock is sock:
+            self.loop.add_writer(sock, self.client.loop_write)
+
+    def _unwatch_write(self, sock):
         try:
-            payload = json.dumps(data, default=str)
-            self.client.publish(topic, payload, qos=1)
-            print(f">>> [{self.prefix}] Published to {topic}")
-        except Exception as e:
-            print(f"[{self.prefix}] Lỗi publish: {e}")
+            self.loop.remove_writer(sock)
+        except (ValueError, OSError):
+            pass
 
-class CounterService(BaseMQTTService):
-    def __init__(self, host, port, user, pw):
-        super().__init__(host, port, "topic/sensor/counter", user, pw, "MQTT COUNTER")
+    async def _misc_loop(self):
+        """Giữ keepalive (`loop_misc`) và tự kết nối lại với backoff lũy thừa khi socket bị đóng."""
+        delay = self.backoff[0]
+        while not self._stopping:
+            if self._sock is None:
+                try:
+                    # TCP connect là blocking: chạy ngoài event loop
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                    delay = self.backoff[0]
+                except Exception as e:
+                    print(f">>> [{self.prefix}] Không kết nối được broker: {e}. Thử lại sau {delay}s", flush=True)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.backoff[1])
+                    continue
+            else:
+                self.client.loop_misc()
+            await asyncio.sleep(1.0)
 
-class HMIDefectService(BaseMQTTService):
-    def __init__(self, host, port, user, pw):
-        super().__init__(host, port, "topic/defect/hmi", user, pw, "MQTT HMI")
+    # --- Dispatch ---
 
-class HMIChangeoverService(BaseMQTTService):
-    def __init__(self, host, port, user, pw):
-        super().__init__(host, port, "topic/changover/hmi", user, pw, "MQTT CHANGEOVER")
+    def _resolve(self, topic):
+        route = self.routes.get(topic)
+        if route:
+            return route
+        for pattern, candidate in self.routes.items():
+            if mqtt.topic_matches_sub(pattern, topic):
+                return candidate
+        return None
 
-class HMIDowntimeService(BaseMQTTService):
-    def __init__(self, host, port, user, pw):
-        super().__init__(host, port, "topic/downtimeinput", user, pw, "MQTT DOWNTIME")
+    def _on_message(self, client, userdata, msg):
+        received_at = time.time()
+        route = self._resolve(msg.topic)
+        prefix = route.prefix if route else self.prefix
+        try:
+            data = self.codecs.decode(msg.topic, msg.payload)
+            print(f"[{prefix}] Received on {msg.topic}: {msg.payload}")
+        except Exception as e:
+            print(f"[{prefix}] Lỗi parse dữ liệu: {e}")
+            return
+        if route is None:
+            return
+        if self.io_mode == IO_ASYNCIO:
+            self._enqueue(route, data, received_at)
+        else:
+            self.loop.call_soon_threadsafe(self._enqueue, route, data, received_at)
 
-class DefectMasterService(BaseMQTTService):
-    def __init__(self, host, port, user, pw):
-        super().__init__(host, port, "topic/get/defectmaster", user, pw, "MQTT DEFECT MASTER")
+    def _enqueue(self, route, data, received_at):
+        route.counters["received"] += 1
+        if route.queue.full():
+            # Burst vượt khả năng xử lý: bỏ message cũ nhất thay vì tích tụ vô hạn
+            route.queue.get_nowait()
+            route.queue.task_done()
+            route.counters["dropped"] += 1
+            print(f">>> [{route.prefix}] Hàng đợi đầy, bỏ message cũ nhất ({route.counters['dropped']} lần)", flush=True)
+        route.queue.put_nowait((data, received_at))
 
-class ProductionRecordService(BaseMQTTService):
-    def __init__(self, host, port, user, pw):
-        super().__init__(host, port, "topic/get/productionrecord", user, pw, "MQTT PRODUCTION")
+    async def _route_worker(self, route):
+        while True:
+            data, received_at = await route.queue.get()
+            route.inflight += 1
+            try:
+                if route.with_timestamp:
+                    await route.handler(data, received_at)
+                else:
+                    await route.handler(data)
+                route.counters["processed"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                route.counters["errors"] += 1
+                route.last_error = f"{type(e).__name__}: {e}"
+                print(f">>> [{route.prefix} ERROR] Lỗi xử lý message trên {route.topic}: {e}", flush=True)
+                traceback.print_exc()
+            finally:
+                route.inflight -= 1
+                route.queue.task_done()
 
-class ProductMasterService(BaseMQTTService):
-    def __init__(self, host, port, user, pw):
-        super().__init__(host, port, "topic/get/productcode", user, pw, "MQTT PRODUCT MASTER")
+    def _start_workers(self, route):
+        while len(route.workers) < route.concurrency:
+            route.workers.append(self.loop.create_task(self._route_worker(route)))
 
-class HMIGetDowntimeService(BaseMQTTService):
-    def __init__(self, host, port, user, pw):
-        super().__init__(host, port, "topic/get/downtime", user, pw, "MQTT GET DOWNTIME")
+    # --- Vòng đời ---
 
-class HMIGetDowntimeMasterService(BaseMQTTService):
-    def __init__(self, host, port, user, pw):
-        super().__init__(host, port, "topic/get/downtimecode", user, pw, "MQTT GET DOWNTIME MASTER")
+    def start(self):
+        """Gọi từ event loop (startup của FastAPI)."""
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self._started = True
+        for route in self.routes.values():
+            self._start_workers(route)
+        if self.outbox:
+            self.outbox.start(self.loop)
+        if self.io_mode == IO_ASYNCIO:
+            self.client.connect_async(self.broker_host, self.broker_port, self.keepalive)
+            self._misc_task = self.loop.create_task(self._misc_loop())
+        else:
+            self.client.connect(self.broker_host, self.broker_port, self.keepalive)
+            self.client.loop_start()
+
+    def stop(self):
+        self._stopping = True
+        if self.io_mode == IO_ASYNCIO:
+            if self._misc_task:
+                self._misc_task.cancel()
+        else:
+            self.client.loop_stop()
+        self.client.disconnect()
+        if self.outbox:
+            self.outbox.stop()
+        for route in self.routes.values():
+            for worker in route.workers:
+                worker.cancel()
+            route.workers.clear()
 
-class HMIDowntimeUpdateService(BaseMQTTService):
-    def __init__(self, host, port, user, pw):
-        super().__init__(host, port, "topic/pub/downtimereason", user, pw, "MQTT DOWNTIME UPDATE")
+    def _send(self, topic, payload, retain):
+        info = self.client.publish(topic, payload, qos=1, retain=retain)
+        # NO_CONN: paho vẫn giữ message QoS1 và tự gửi lại khi kết nối lại
+        return info.rc in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN)
 
+    def _coalesce_key(self, topic, data):
+        if not isinstance(data, dict) or data.get("delta"):
+            return None
+        if not any(mqtt.topic_matches_sub(pattern, topic) for pattern in self.coalesce_topics):
+            return None
+        return (topic, data.get("machinecode") or data.get("machine"))
 
+    def publish(self, topic, data, retain=False):
+        try:
+            payload = self.codecs.encode(topic, data)
+            if self.outbox:
+                self.outbox.put(topic, payload, retain, self._coalesce_key(topic, data))
+            else:
+                self.client.publish(topic, payload, qos=1, retain=retain)
+            print(f">>> [{self.prefix}] Published to {topic}")
+        except Exception as e:
+            print(f"[{self.prefix}] Lỗi publish: {e}")
 
+    def stats(self) -> dict:
+        return {
+            "io_mode": self.io_mode,
+            "connected": self.client.is_connected(),
+            "reconnects": self.reconnects,
+            "codec": self.codecs.stats(),
+            "outbox": self.outbox.stats() if self.outbox else None,
+            "routes": {topic: route.stats() for topic, route in self.routes.items()},
+        }
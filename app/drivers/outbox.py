@@ -0,0 +1,239 @@
+import os
+import time
+import struct
+import asyncio
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, Optional
+
+# Bản ghi spool: retain (1 byte) | độ dài topic (2 byte) | độ dài payload (4 byte) | topic | payload
+_HEADER = struct.Struct(">BHI")
+
+
+class _Entry:
+    __slots__ = ("topic", "payload", "retain", "key", "alive")
+
+    def __init__(self, topic, payload, retain, key=None):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+        self.key = key
+        self.alive = True
+
+
+class OutboundQueue:
+    """
+    Hàng đợi publish store-and-forward.
+    - Message được giữ trong ring bộ nhớ tối đa `max_memory` message; đầy thì ghi nối tiếp
+      (append-only) vào file spool, tối đa `max_spool_bytes` (vượt quá thì bỏ message mới).
+    - Khi broker kết nối lại, message được gửi lại đúng thứ tự: hết ring bộ nhớ rồi tới spool.
+    - Message có `key` (ví dụ (topic, machinecode)) thay thế message cùng key còn chờ trong bộ nhớ.
+    - `send(topic, payload, retain) -> bool`: False khi client chưa nhận thêm được (hàng đợi paho đầy).
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str, bytes, bool], bool],
+        is_connected: Callable[[], bool],
+        spool_path: Optional[str] = None,
+        max_memory: int = 1000,
+        max_spool_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.send = send
+        self.is_connected = is_connected
+        self.spool_path = spool_path
+        self.max_memory = max(1, int(max_memory))
+        self.max_spool_bytes = max_spool_bytes
+        self._memory: Deque[_Entry] = deque()
+        self._index: Dict[Hashable, _Entry] = {}
+        self._read_offset = 0
+        self._spool_size = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._counters = {"queued": 0, "sent": 0, "direct": 0, "coalesced": 0, "spooled": 0, "dropped": 0, "send_retries": 0}
+        self._rate_mark = (time.monotonic(), 0)
+        self._drain_rate = 0.0
+        self._open_spool()
+
+    # --- Spool ---
+
+    def _open_spool(self):
+        if not self.spool_path:
+            return
+        os.makedirs(os.path.dirname(self.spool_path) or ".", exist_ok=True)
+        if os.path.exists(self.spool_path):
+            self._spool_size = os.path.getsize(self.spool_path)
+            try:
+                with open(f"{self.spool_path}.offset") as f:
+                    self._read_offset = min(int(f.read().strip() or 0), self._spool_size)
+            except (FileNotFoundError, ValueError):
+                self._read_offset = 0
+            if self._spool_size > self._read_offset:
+                print(f">>> [OUTBOX] Còn {self._spool_size - self._read_offset} byte chưa gửi trong spool, sẽ gửi lại khi có kết nối", flush=True)
+
+    def _spool_pending(self) -> int:
+        return self._spool_size - self._read_offset
+
+    def _spool_append(self, entry: _Entry) -> bool:
+        if not self.spool_path:
+            return False
+        topic = entry.topic.encode("utf-8")
+        record = _HEADER.pack(1 if entry.retain else 0, len(topic), len(entry.payload)) + topic + entry.payload
+        if self._spool_size + len(record) > self.max_spool_bytes:
+            return False
+        with open(self.spool_path, "ab") as f:
+            f.write(record)
+        self._spool_size += len(record)
+        return True
+
+    def _spool_refill(self):
+        """Đọc tiếp các message trong spool vào ring bộ nhớ (giữ nguyên thứ tự)."""
+        if not self.spool_path or self._spool_pending() <= 0:
+            return
+        with open(self.spool_path, "rb") as f:
+            f.seek(self._read_offset)
+            while len(self._memory) < self.max_memory and self._read_offset < self._spool_size:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                retain, topic_len, payload_len = _HEADER.unpack(header)
+                body = f.read(topic_len + payload_len)
+                if len(body) < topic_len + payload_len:
+                    break
+                self._memory.append(_Entry(body[:topic_len].decode("utf-8"), body[topic_len:], bool(retain)))
+                self._read_offset += _HEADER.size + len(body)
+        if self._read_offset < self._spool_size and not self._memory:
+            # Bản ghi cuối bị ghi dở (mất điện): bỏ phần hỏng
+            print(f">>> [OUTBOX] Bỏ {self._spool_size - self._read_offset} byte hỏng ở cuối spool", flush=True)
+            self._read_offset = self._spool_size
+        if self._read_offset >= self._spool_size:
+            # Đã đọc hết: làm rỗng file để spool không phình mãi
+            with open(self.spool_path, "wb"):
+                pass
+            self._read_offset = self._spool_size = 0
+        with open(f"{self.spool_path}.offset", "w") as f:
+            f.write(str(self._read_offset))
+
+    # --- Publish ---
+
+    def put(self, topic: str, payload: bytes, retain: bool = False, key: Optional[Hashable] = None):
+        """Gọi trên event loop. Gửi ngay nếu hàng đợi rỗng và đang kết nối, ngược lại xếp hàng."""
+        if not self._memory and not self._spool_pending() and self.is_connected():
+            if self.send(topic, payload, retain):
+                self._counters["direct"] += 1
+                return
+        entry = _Entry(topic, payload, retain, key)
+        self._counters["queued"] += 1
+        if key is not None:
+            previous = self._index.get(key)
+            if previous is not None and previous.alive:
+                # Trạng thái mới thay thế trạng thái cũ chưa gửi của cùng máy/topic
+                previous.alive = False
+                self._counters["coalesced"] += 1
+        if not self._spool_pending() and len(self._memory) >= self.max_memory and self._counters["coalesced"]:
+            self._memory = deque(e for e in self._memory if e.alive)
+        if self._spool_pending() or len(self._memory) >= self.max_memory:
+            if self._spool_append(entry):
+                self._counters["spooled"] += 1
+            else:
+                self._counters["dropped"] += 1
+                print(f">>> [OUTBOX] Hàng đợi và spool đầy, bỏ message tới {topic}", flush=True)
+            return
+        self._memory.append(entry)
+        if key is not None:
+            self._index[key] = entry
+        self.notify()
+
+    def notify(self):
+        """Đánh thức vòng gửi (gọi được từ bất kỳ thread nào, ví dụ khi kết nối lại)."""
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _drain(self):
+        sent = 0
+        while self.is_connected():
+            if not self._memory:
+                self._spool_refill()
+                if not self._memory:
+                    return
+            entry = self._memory[0]
+            if entry.alive:
+                if not self.send(entry.topic, entry.payload, entry.retain):
+                    self._counters["send_retries"] += 1
+                    await asyncio.sleep(0.05)
+                    continue
+                self._counters["sent"] += 1
+                sent += 1
+            self._memory.popleft()
+            if entry.key is not None and self._index.get(entry.key) is entry:
+                del self._index[entry.key]
+            if sent and sent % 100 == 0:
+                await asyncio.sleep(0)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._drain()
+            except Exception as e:
+                print(f">>> [OUTBOX ERROR] Lỗi gửi hàng đợi: {e}", flush=True)
+            now, sent = time.monotonic(), self._counters["sent"] + self._counters["direct"]
+            mark_time, mark_sent = self._rate_mark
+            if now - mark_time >= 1.0:
+                self._drain_rate = (sent - mark_sent) / (now - mark_time)
+                self._rate_mark = (now, sent)
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._loop = loop or asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = self._loop.create_task(self._run())
+
+    def stop(self):
+        """Dừng vòng gửi; message còn trong bộ nhớ được ghi xuống spool để gửi ở lần chạy sau."""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        pending = [e for e in self._memory if e.alive]
+        self._memory.clear()
+        self._index.clear()
+        if pending and self.spool_path:
+            # Giữ thứ tự: các message trong bộ nhớ cũ hơn phần còn lại của spool
+            rest = b""
+            if self._spool_pending():
+                with open(self.spool_path, "rb") as f:
+                    f.seek(self._read_offset)
+                    rest = f.read()
+            self._read_offset = self._spool_size = 0
+            with open(self.spool_path, "wb"):
+                pass
+            saved = 0
+            for entry in pending:
+                if self._spool_append(entry):
+                    saved += 1
+            dropped = len(pending) - saved
+            with open(self.spool_path, "ab") as f:
+                f.write(rest)
+            self._spool_size += len(rest)
+            with open(f"{self.spool_path}.offset", "w") as f:
+                f.write("0")
+            print(f">>> [OUTBOX] Đã lưu {saved} message chưa gửi xuống spool", flush=True)
+            if dropped:
+                self._counters["dropped"] += dropped
+                print(f">>> [OUTBOX] Spool đầy, bỏ {dropped} message chưa gửi khi dừng", flush=True)
+        elif pending:
+            self._counters["dropped"] += len(pending)
+            print(f">>> [OUTBOX] Không cấu hình spool, bỏ {len(pending)} message chưa gửi khi dừng", flush=True)
+
+    def stats(self) -> dict:
+        return {
+            "depth": sum(1 for e in self._memory if e.alive),
+            "max_memory": self.max_memory,
+            "spool_bytes": self._spool_pending(),
+            "spool_max_bytes": self.max_spool_bytes,
+            **self._counters,
+            "drain_rate": round(self._drain_rate, 1),
+        }
@@ -0,0 +1,85 @@
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import cv2
+
+LETTERBOX_COLOR = (114, 114, 114)
+
+class FramePreprocessor:
+    """
+    Tiền xử lý frame của một máy trước khi đưa vào YOLO:
+    1. Cắt vùng ROI (`roi` = [x, y, w, h], là view của frame, không copy).
+    2. Thu nhỏ để cạnh dài nhất bằng `imgsz`.
+    3. (Tùy chọn) letterbox thành ảnh vuông `imgsz` x `imgsz`; tham số letterbox
+       được cache theo kích thước frame đầu vào.
+    `transform` trả về cho phép map tọa độ box về frame gốc.
+    """
+
+    def __init__(self, roi: Optional[Sequence[int]] = None, imgsz: Optional[int] = None, letterbox: bool = False):
+        self.roi = tuple(int(v) for v in roi) if roi else None
+        self.imgsz = int(imgsz) if imgsz else None
+        self.letterbox = bool(letterbox and self.imgsz)
+        self._geometry: Dict[Tuple[int, int], tuple] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings: Optional[dict]) -> Optional["FramePreprocessor"]:
+        if not settings:
+            return None
+        prep = cls(settings.get("roi"), settings.get("imgsz"), settings.get("letterbox", False))
+        return prep if (prep.roi or prep.imgsz) else None
+
+    def _crop_box(self, height: int, width: int) -> Tuple[int, int, int, int]:
+        if not self.roi:
+            return 0, 0, width, height
+        x, y, w, h = self.roi
+        x0, y0 = max(0, min(x, width - 1)), max(0, min(y, height - 1))
+        x1, y1 = max(x0 + 1, min(x + w, width)), max(y0 + 1, min(y + h, height))
+        return x0, y0, x1, y1
+
+    def _get_geometry(self, height: int, width: int) -> tuple:
+        """(x0, y0, x1, y1, scale, new_w, new_h, pad_left, pad_top, pad_right, pad_bottom) cho một kích thước frame."""
+        key = (height, width)
+        geometry = self._geometry.get(key)
+        if geometry is not None:
+            return geometry
+        x0, y0, x1, y1 = self._crop_box(height, width)
+        crop_w, crop_h = x1 - x0, y1 - y0
+        scale = 1.0
+        if self.imgsz and max(crop_w, crop_h) > self.imgsz:
+            scale = self.imgsz / max(crop_w, crop_h)
+        new_w, new_h = max(1, round(crop_w * scale)), max(1, round(crop_h * scale))
+        pad = (0, 0, 0, 0)
+        if self.letterbox:
+            dw, dh = self.imgsz - new_w, self.imgsz - new_h
+            pad = (dw // 2, dh // 2, dw - dw // 2, dh - dh // 2)
+        geometry = (x0, y0, x1, y1, scale, new_w, new_h, *pad)
+        with self._lock:
+            self._geometry[key] = geometry
+        return geometry
+
+    def apply(self, frame):
+        """Trả về (ảnh đưa vào model, transform)."""
+        h, w = frame.shape[:2]
+        x0, y0, x1, y1, scale, new_w, new_h, left, top, right, bottom = self._get_geometry(h, w)
+        image = frame[y0:y1, x0:x1]
+        if scale != 1.0:
+            image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_AREA)
+        if self.letterbox:
+            image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=LETTERBOX_COLOR)
+        return image, (scale, left, top, x0, y0)
+
+    @staticmethod
+    def map_boxes(boxes: List[list], transform) -> List[list]:
+        """Map box [x1, y1, x2, y2, conf, cls] từ ảnh đã tiền xử lý về tọa độ frame gốc."""
+        if not transform:
+            return boxes
+        scale, pad_x, pad_y, off_x, off_y = transform
+        mapped = []
+        for x1, y1, x2, y2, conf, cls_idx in boxes:
+            mapped.append([
+                (x1 - pad_x) / scale + off_x, (y1 - pad_y) / scale + off_y,
+                (x2 - pad_x) / scale + off_x, (y2 - pad_y) / scale + off_y,
+                conf, cls_idx
+            ])
+        return mapped
@@ -0,0 +1,104 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import cv2
+
+THUMB_SIZE = (32, 32)
+
+def _strip_frame(result: dict) -> dict:
+    return {k: v for k, v in result.items() if k != "frame"}
+
+class ResultReuse:
+    """
+    Tái sử dụng kết quả detect khi pulse đến nhanh hơn frame camera.
+    - Cache LRU theo (luồng, seq frame, cấu hình tiền xử lý): pulse trỏ tới frame đã detect dùng lại kết quả.
+    - Lấy mẫu thích ứng theo máy: chỉ detect mỗi `sample_every` pulse, và/hoặc chỉ khi ảnh
+      thu nhỏ 32x32 (grayscale) thay đổi trung bình hơn `diff_threshold` (thang 0-255).
+    Kết quả dùng lại được đánh dấu `reused` và `reuse_reason`.
+    """
+
+    def __init__(self, cache_size: int = 64, sample_every: int = 1, diff_threshold: float = 0.0):
+        self.cache_size = max(0, int(cache_size))
+        self.sample_every = max(1, int(sample_every))
+        self.diff_threshold = float(diff_threshold or 0.0)
+        self._cache: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._machines: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._counters = {"pulses": 0, "inferred": 0, "cache_hits": 0, "skipped_every_n": 0, "skipped_unchanged": 0}
+
+    @staticmethod
+    def _reuse(result: dict, reason: str) -> dict:
+        out = _strip_frame(result)
+        out["reused"] = True
+        out["reuse_reason"] = reason
+        return out
+
+    def lookup(self, key: tuple) -> Optional[dict]:
+        """Kết quả đã có của đúng frame này (nếu có)."""
+        with self._lock:
+            self._counters["pulses"] += 1
+            result = self._cache.get(key)
+            if result is None:
+                return None
+            self._cache.move_to_end(key)
+            self._counters["cache_hits"] += 1
+            return self._reuse(result, "same_frame")
+
+    def same_frame(self, result: dict) -> dict:
+        """Pulse khác của cùng máy trỏ tới frame vừa detect trong cùng lô: dùng lại như `lookup`."""
+        with self._lock:
+            self._counters["pulses"] += 1
+            self._counters["cache_hits"] += 1
+        return self._reuse(result, "same_frame")
+
+    def sample(self, machinecode: str, image) -> Tuple[Optional[dict], Optional[object]]:
+        """
+        Quyết định có cần detect frame mới của máy hay không.
+        Trả về (kết quả dùng lại hoặc None, thumbnail để lưu sau khi detect).
+        """
+        key = machinecode.strip().lower() if machinecode else ""
+        with self._lock:
+            state = self._machines.setdefault(key, {"pulses": 0, "last": None, "thumb": None})
+            state["pulses"] += 1
+            last, last_thumb, pulses = state["last"], state["thumb"], state["pulses"]
+            if last is not None and self.sample_every > 1 and pulses % self.sample_every != 0:
+                self._counters["skipped_every_n"] += 1
+                return self._reuse(last, "every_n"), None
+
+        if self.diff_threshold <= 0:
+            return None, None
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        thumb = cv2.resize(gray, THUMB_SIZE, interpolation=cv2.INTER_AREA)
+        if last is not None and last_thumb is not None:
+            if float(cv2.absdiff(thumb, last_thumb).mean()) < self.diff_threshold:
+                with self._lock:
+                    self._counters["skipped_unchanged"] += 1
+                return self._reuse(last, "unchanged"), None
+        return None, thumb
+
+    def store(self, key: tuple, machinecode: str, result: dict, thumb=None):
+        with self._lock:
+            self._counters["inferred"] += 1
+            stored = _strip_frame(result)
+            if self.cache_size:
+                self._cache[key] = stored
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            state = self._machines.setdefault(machinecode.strip().lower() if machinecode else "", {"pulses": 0, "last": None, "thumb": None})
+            state["last"] = stored
+            if thumb is not None:
+                state["thumb"] = thumb
+
+    def stats(self) -> dict:
+        with self._lock:
+            pulses = self._counters["pulses"]
+            reused = self._counters["cache_hits"] + self._counters["skipped_every_n"] + self._counters["skipped_unchanged"]
+            return {
+                **self._counters,
+                "sample_every": self.sample_every,
+                "diff_threshold": self.diff_threshold,
+                "reuse_rate": round(reused / pulses, 3) if pulses else 0.0,
+                "cache_hit_rate": round(self._counters["cache_hits"] / pulses, 3) if pulses else 0.0,
+            }
@@ -0,0 +1,243 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, Optional
+
+from app.storage.db import get_production_db
+from app.storage.schemas import DowntimeRecord
+from app.storage.master_cache import get_master_cache
+from app.storage.pulse_cache import get_last_pulse_cache
+from app.utils.messaging import mqtt_publish
+from app.engine.live_kpi import get_live_kpi
+
+DEFAULT_THRESHOLD = 300  # giây, khi workingparameter không có `downtimethreshold`
+
+IDLE = "idle"          # không có bản ghi running: không tự mở downtime
+RUNNING = "running"    # đang chờ pulse, hẹn giờ mở downtime tại last_pulse + threshold
+STOPPED = "stopped"    # đang có downtime active
+
+class MachineDowntimeState:
+    """Trạng thái downtime của một máy (giữ trong bộ nhớ)."""
+
+    __slots__ = (
+        "machinecode", "productcode", "threshold", "running", "since",
+        "active_id", "active_start", "active_code", "active_count", "last_opened_start", "timer", "closing",
+    )
+
+    def __init__(self, machinecode: str):
+        self.machinecode = machinecode
+        self.productcode = ""
+        self.threshold = DEFAULT_THRESHOLD
+        self.running = False
+        self.since: Optional[datetime] = None  # createtime bản ghi running, dùng khi máy chưa có pulse nào
+        self.active_id = None
+        self.active_start: Optional[datetime] = None
+        self.active_code = "default"
+        self.active_count = 0
+        self.last_opened_start: Optional[datetime] = None
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.closing = False  # đang ghi lệnh đóng downtime
+
+    @property
+    def status(self) -> str:
+        if self.active_count:
+            return STOPPED
+        return RUNNING if self.running else IDLE
+
+class DowntimeMonitor:
+    """
+    Máy trạng thái downtime theo sự kiện, thay cho polling `downtime_records` / `iot_records` mỗi 5s.
+    - Mỗi pulse đặt lại hẹn giờ (deadline) tại `last_pulse + downtimethreshold`; hết hạn mà không có
+      pulse mới thì mở downtime (start_time = pulse cuối) đúng lúc vượt ngưỡng.
+    - Pulse kế tiếp đóng downtime đang mở: trạng thái đã có trong bộ nhớ nên không cần đọc `downtime_records`.
+    - Chỉ các lần chuyển trạng thái (mở / đóng) được ghi DB và publish lên `topic/downtimeinput`.
+    - Chỉ máy có bản ghi `running` (`set_running`) mới được tự mở downtime, giống logic polling cũ.
+    - Pulse gần nhất đọc từ `LastPulseCache` (dùng chung với ingestion), không giữ bản sao riêng.
+    """
+
+    def __init__(self):
+        self._states: Dict[str, MachineDowntimeState] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks = set()
+        self._counters = {"pulses": 0, "opened": 0, "closed": 0, "timer_fired": 0, "errors": 0}
+
+    def _state(self, machinecode: str) -> MachineDowntimeState:
+        m_code = machinecode.strip()
+        state = self._states.get(m_code)
+        if state is None:
+            state = self._states[m_code] = MachineDowntimeState(m_code)
+        return state
+
+    @staticmethod
+    def _last_activity(state: MachineDowntimeState) -> Optional[datetime]:
+        return get_last_pulse_cache().get(state.machinecode) or state.since
+
+    # --- Hẹn giờ ---
+
+    def _arm(self, state: MachineDowntimeState):
+        """Đặt (lại) hẹn giờ mở downtime nếu máy đang chạy và chưa có downtime active."""
+        if state.timer:
+            state.timer.cancel()
+            state.timer = None
+        last_ts = self._last_activity(state)
+        if self._loop is None or not state.running or state.active_count or last_ts is None:
+            return
+        if state.last_opened_start == last_ts:
+            # Downtime bắt đầu từ pulse này đã được mở (và đóng không do pulse): không mở lại
+            return
+        delay = state.threshold - (datetime.utcnow() - last_ts).total_seconds()
+        state.timer = self._loop.call_later(max(0.0, delay), self._on_deadline, state)
+
+    def _on_deadline(self, state: MachineDowntimeState):
+        state.timer = None
+        self._counters["timer_fired"] += 1
+        self._spawn(self._open(state))
+
+    def _spawn(self, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # --- Chuyển trạng thái (ghi DB) ---
+
+    async def _open(self, state: MachineDowntimeState):
+        last_ts = self._last_activity(state)
+        if not state.running or state.active_count or last_ts is None:
+            return
+        if (datetime.utcnow() - last_ts).total_seconds() < state.threshold:
+            self._arm(state)  # pulse mới tới trong lúc chờ
+            return
+        try:
+            new_dt = DowntimeRecord(machinecode=state.machinecode, start_time=last_ts, status="active")
+            res = await get_production_db().downtime_records.insert_one(new_dt.model_dump(by_alias=True, exclude_none=True))
+        except Exception as e:
+            self._counters["errors"] += 1
+            print(f">>> [DOWNTIME ERROR] Lỗi mở downtime {state.machinecode}: {e}")
+            return
+        state.active_id, state.active_start, state.active_code, state.active_count = res.inserted_id, last_ts, "default", 1
+        state.last_opened_start = last_ts
+        self._counters["opened"] += 1
+        get_live_kpi().on_downtime_open(state.machinecode, last_ts)
+        mqtt_publish("topic/downtimeinput", {"id": str(res.inserted_id), "machine": state.machinecode, "status": "active", "downtimecode": "default", "createtime": last_ts, "endtime": "None", "duration": 0})
+        print(f">>> [DOWNTIME] Máy {state.machinecode} dừng từ {last_ts} (ngưỡng {state.threshold}s)")
+        resumed = self._last_activity(state)
+        if resumed > last_ts:
+            # Pulse tới trong lúc đang ghi: máy đã chạy lại
+            await self._close(state, resumed)
+            self._arm(state)
+
+    async def _close(self, state: MachineDowntimeState, end: datetime):
+        if state.active_count > 1:
+            # Nhiều downtime active (dữ liệu cũ): đóng tất cả theo cách cũ
+            from app.engine.logic import close_active_downtime
+            await close_active_downtime(state.machinecode)
+            return
+        if state.closing:
+            return
+        start, record_id = state.active_start, state.active_id
+        duration = max(0, int((end - start).total_seconds()))
+        state.closing = True
+        try:
+            await get_production_db().downtime_records.update_one({"_id": record_id}, {"$set": {"end_time": end, "duration_seconds": duration, "status": "closed"}})
+        except Exception as e:
+            # Giữ trạng thái active (DB vẫn active): pulse kế tiếp sẽ thử đóng lại, không mở downtime thứ hai
+            self._counters["errors"] += 1
+            print(f">>> [DOWNTIME ERROR] Lỗi đóng downtime {state.machinecode}: {e}")
+            return
+        finally:
+            state.closing = False
+        if state.active_id != record_id:
+            return  # đã được đóng bởi luồng khác (`on_closed`) trong lúc ghi
+        state.active_id, state.active_start, state.active_count = None, None, 0
+        self._counters["closed"] += 1
+        get_live_kpi().on_downtime_close(state.machinecode, start, end)
+        mqtt_publish("topic/downtimeinput", {"id": str(record_id), "machine": state.machinecode, "status": "closed", "downtimecode": state.active_code or "default", "createtime": start, "endtime": end, "duration": duration})
+
+    # --- Sự kiện ---
+
+    async def on_pulse(self, machinecode: str, timestamp: datetime):
+        """Pulse mới: đóng downtime đang mở (nếu có) và đặt lại hẹn giờ."""
+        state = self._state(machinecode)
+        self._counters["pulses"] += 1
+        get_last_pulse_cache().update(state.machinecode, timestamp)
+        if state.active_count:
+            await self._close(state, timestamp)
+        self._arm(state)
+
+    async def set_running(self, machinecode: str, productcode: str, since: Optional[datetime] = None):
+        """Máy có bản ghi running mới: lấy ngưỡng theo sản phẩm và bắt đầu hẹn giờ."""
+        state = self._state(machinecode)
+        state.productcode = (productcode or "").strip()
+        wp_doc = await get_master_cache().working_parameter(state.productcode)
+        state.threshold = wp_doc.get("downtimethreshold", DEFAULT_THRESHOLD) if wp_doc else DEFAULT_THRESHOLD
+        state.running = True
+        if since is not None:
+            state.since = since
+        self._arm(state)
+
+    def set_idle(self, machinecode: str):
+        """Bản ghi running của máy đã chốt: ngừng tự mở downtime."""
+        state = self._state(machinecode)
+        state.running = False
+        self._arm(state)
+
+    def on_closed(self, machinecode: str):
+        """Downtime của máy đã được đóng bởi luồng khác (`close_active_downtime`)."""
+        state = self._state(machinecode)
+        state.active_id, state.active_start, state.active_count = None, None, 0
+        self._arm(state)
+
+    def on_reason(self, machinecode: str, record_id, downtime_code: str):
+        state = self._states.get((machinecode or "").strip())
+        if state and state.active_id is not None and str(state.active_id) == str(record_id):
+            state.active_code = downtime_code
+
+    def on_master_change(self, collection: str):
+        """Listener của master cache: `downtimethreshold` có thể đã đổi."""
+        if collection == "workingparameter" and self._loop is not None:
+            for state in list(self._states.values()):
+                if state.running:
+                    self._spawn(self.set_running(state.machinecode, state.productcode))
+
+    # --- Vòng đời ---
+
+    async def start(self):
+        """Nạp trạng thái từ DB một lần: bản ghi running và downtime active (pulse gần nhất lấy từ `LastPulseCache`)."""
+        self._loop = asyncio.get_running_loop()
+        db = get_production_db()
+        for dt in await db.downtime_records.find({"status": "active"}).sort("start_time", 1).to_list(None):
+            state = self._state(dt["machinecode"])
+            state.active_id, state.active_start = dt["_id"], dt["start_time"]
+            state.active_code = dt.get("downtime_code") or "default"
+            state.active_count += 1
+            state.last_opened_start = dt["start_time"]
+        for prod in await db.production_records.find({"status": "running"}).to_list(None):
+            m_code = prod["machinecode"].strip()
+            await get_last_pulse_cache().load(m_code)
+            await self.set_running(m_code, prod.get("productcode", ""), prod["createtime"])
+        print(f">>> [DOWNTIME] Theo dõi downtime theo sự kiện cho {len(self._states)} máy ({sum(1 for s in self._states.values() if s.active_count)} đang dừng)")
+
+    def stop(self):
+        for state in self._states.values():
+            if state.timer:
+                state.timer.cancel()
+                state.timer = None
+        for task in list(self._tasks):
+            task.cancel()
+
+    def stats(self) -> dict:
+        states = list(self._states.values())
+        return {
+            "machines": len(states),
+            "running": sum(1 for s in states if s.status == RUNNING),
+            "stopped": sum(1 for s in states if s.status == STOPPED),
+            "armed": sum(1 for s in states if s.timer),
+            **self._counters,
+        }
+
+_monitor = None
+
+def get_downtime_monitor() -> DowntimeMonitor:
+    global _monitor
+    if _monitor is None:
+        _monitor = DowntimeMonitor()
+    return _monitor
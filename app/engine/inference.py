@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+DROP_OLDEST = "drop_oldest"
+COALESCE = "coalesce"
+
+
+@dataclass
+class InferenceJob:
+    """Yêu cầu "detect cho máy X tại thời điểm pulse T"."""
+    machinecode: str
+    pulse_time: float
+    enqueued_at: float = field(default_factory=time.monotonic)
+    coalesced: int = 0
+
+    @property
+    def pulse_datetime(self) -> datetime:
+        return datetime.utcfromtimestamp(self.pulse_time)
+
+
+class InferenceExecutor:
+    """
+    Pool worker chạy AI Inference tách khỏi thread network của MQTT.
+    - Hàng đợi có giới hạn (`max_queue`), đầy thì bỏ job cũ nhất.
+    - Policy `coalesce`: mỗi máy chỉ giữ 1 job đang chờ, pulse mới ghi đè pulse cũ.
+    - Mỗi worker gom tối đa `batch_size` job đang chờ (có thể của nhiều máy) vào một lần predict.
+    - Kết quả được đẩy về event loop qua `result_handler` (coroutine).
+    - `keep_frame(result)`: chỉ các kết quả thỏa điều kiện mới giữ lại bản copy frame (để annotate).
+    """
+
+    def __init__(
+        self,
+        camera_sys,
+        loop: asyncio.AbstractEventLoop,
+        result_handler: Callable[..., Awaitable[Any]],
+        workers: int = 1,
+        max_queue: int = 8,
+        policy: str = COALESCE,
+        batch_size: int = 1,
+        keep_frame: Optional[Callable[[dict], bool]] = None,
+    ):
+        if policy not in (DROP_OLDEST, COALESCE):
+            raise ValueError(f"Policy inference không hợp lệ: {policy}")
+        self.camera_sys = camera_sys
+        self.loop = loop
+        self.result_handler = result_handler
+        self.max_queue = max(1, int(max_queue))
+        self.policy = policy
+        self.batch_size = max(1, int(batch_size))
+        self.keep_frame = keep_frame
+
+        self._queue: Deque[InferenceJob] = deque()
+        self._pending: Dict[str, InferenceJob] = {}
+        self._cond = threading.Condition()
+        self._running = True
+
+        self._counters = {"submitted": 0, "processed": 0, "batches": 0, "dropped": 0, "coalesced": 0, "empty": 0, "errors": 0}
+        self._wait_total = 0.0
+        self._infer_total = 0.0
+
+        self._threads: List[threading.Thread] = []
+        for i in range(max(1, int(workers))):
+            t = threading.Thread(target=self._worker, name=f"inference-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        print(f">>> [INFERENCE] Khởi tạo {len(self._threads)} worker (queue={self.max_queue}, policy={self.policy}, batch={self.batch_size})", flush=True)
+
+    def submit(self, machinecode: str, pulse_time: Optional[float] = None) -> bool:
+        """Đưa job vào hàng đợi và trả về ngay (gọi được từ bất kỳ thread nào)."""
+        if not machinecode:
+            return False
+        pulse_time = pulse_time if pulse_time is not None else time.time()
+        with self._cond:
+            if not self._running:
+                return False
+            self._counters["submitted"] += 1
+
+            if self.policy == COALESCE:
+                pending = self._pending.get(machinecode)
+                if pending is not None:
+                    pending.pulse_time = pulse_time
+                    pending.coalesced += 1
+                    self._counters["coalesced"] += 1
+                    return True
+
+            if len(self._queue) >= self.max_queue:
+                dropped = self._queue.popleft()
+                self._pending.pop(dropped.machinecode, None)
+                self._counters["dropped"] += 1
+                print(f">>> [INFERENCE] Hàng đợi đầy, bỏ job cũ của {dropped.machinecode}")
+
+            job = InferenceJob(machinecode=machinecode, pulse_time=pulse_time)
+            self._queue.append(job)
+            if self.policy == COALESCE:
+                self._pending[machinecode] = job
+            self._cond.notify()
+        return True
+
+    def _next_batch(self) -> List[InferenceJob]:
+        with self._cond:
+            while self._running and not self._queue:
+                self._cond.wait()
+            if not self._running:
+                return []
+            jobs = []
+            while self._queue and len(jobs) < self.batch_size:
+                job = self._queue.popleft()
+                if self._pending.get(job.machinecode) is job:
+                    del self._pending[job.machinecode]
+                jobs.append(job)
+            return jobs
+
+    def _worker(self):
+        while True:
+            jobs = self._next_batch()
+            if not jobs:
+                return
+            started = time.monotonic()
+            try:
+                results = self.camera_sys.detect_batch(
+                    [job.machinecode for job in jobs],
+                    pulse_times=[job.pulse_time for job in jobs],
+                    keep_frame=self.keep_frame
+                )
+            except Exception as e:
+                results = [None] * len(jobs)
+                with self._cond:
+                    self._counters["errors"] += 1
+                print(f">>> [INFERENCE ERROR] Lỗi detect cho {[job.machinecode for job in jobs]}: {e}")
+            finished = time.monotonic()
+
+            with self._cond:
+                self._counters["batches"] += 1
+                self._counters["processed"] += len(jobs)
+                self._infer_total += finished - started
+                for job, ai_res in zip(jobs, results):
+                    self._wait_total += started - job.enqueued_at
+                    if not ai_res:
+                        self._counters["empty"] += 1
+
+            for job, ai_res in zip(jobs, results):
+                if ai_res:
+                    self.loop.call_soon_threadsafe(self._dispatch_result, ai_res, job)
+
+    def _dispatch_result(self, ai_res: dict, job: InferenceJob):
+        task = self.loop.create_task(
+            self.result_handler(ai_res, machinecode=job.machinecode, timestamp=job.pulse_datetime)
+        )
+        task.add_done_callback(self._log_result_error)
+
+    def _log_result_error(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            print(f">>> [INFERENCE ERROR] Lỗi xử lý kết quả AI: {task.exception()}")
+
+    def stats(self) -> dict:
+        with self._cond:
+            processed = self._counters["processed"]
+            batches = self._counters["batches"]
+            return {
+                "workers": len(self._threads),
+                "policy": self.policy,
+                "queue_depth": len(self._queue),
+                "max_queue": self.max_queue,
+                "batch_size": self.batch_size,
+                **self._counters,
+                "avg_wait_ms": round(self._wait_total / processed * 1000, 2) if processed else 0.0,
+                "avg_batch": round(processed / batches, 2) if batches else 0.0,
+                "avg_infer_ms": round(self._infer_total / batches * 1000, 2) if batches else 0.0,
+            }
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._queue.clear()
+            self._pending.clear()
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout=2.0)
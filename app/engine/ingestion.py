@@ -0,0 +1,171 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from pymongo.errors import BulkWriteError
+
+from app.storage.db import get_production_db
+from app.storage.pulse_cache import get_last_pulse_cache
+from app.engine.logic import update_current_production_stats
+from app.engine.downtime import get_downtime_monitor
+from app.engine.live_kpi import get_live_kpi
+
+
+class CounterIngestor:
+    """
+    Gom pulse counter thành từng lô trước khi ghi `iot_records`.
+    - Lô được ghi khi đủ `max_batch` pulse hoặc sau `flush_interval` giây, bằng một lệnh
+      `insert_many(ordered=False)`.
+    - `actual_cycle_time` tính trong bộ nhớ từ pulse trước của cùng máy (`LastPulseCache`, dùng chung với DowntimeMonitor).
+    - `DowntimeMonitor.on_pulse` được gọi một lần cho mỗi máy trong lô (đóng downtime đang mở, đặt lại hẹn giờ).
+    - KPI (`update_current_production_stats`) của các máy có pulse mới được gộp lại,
+      mỗi máy cập nhật tối đa một lần mỗi `kpi_interval` giây (dashboard trễ không quá ngưỡng này).
+    """
+
+    def __init__(self, flush_interval: float = 0.2, max_batch: int = 500, kpi_interval: float = 1.0):
+        self.flush_interval = max(0.0, float(flush_interval))
+        self.max_batch = max(1, int(max_batch))
+        self.kpi_interval = max(0.0, float(kpi_interval))
+        self._buffer: List[dict] = []
+        self._dirty: Set[str] = set()
+        self._last_kpi: Dict[str, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._counters = {"pulses": 0, "flushes": 0, "inserted": 0, "errors": 0, "kpi_updates": 0, "downtime_checks": 0}
+        self._flush_total = 0.0
+        self._last_flush_ms = 0.0
+
+    def submit(self, counter_msg: dict, received_at: Optional[float] = None) -> bool:
+        """
+        Standard Payload: { "machinecode": "m002", "timestamp": "...", "shootcountnumber": 1439 }
+        Chỉ đưa pulse vào lô (không I/O); thời điểm pulse là lúc message tới.
+        """
+        if not counter_msg:
+            return False
+        machinecode = str(counter_msg.get("machinecode", "")).strip()
+        if not machinecode:
+            print(f">>> [PROCESSOR ERROR] Counter thiếu machinecode: {counter_msg}")
+            return False
+        timestamp = datetime.utcfromtimestamp(received_at) if received_at else datetime.utcnow()
+        self._buffer.append({
+            "timestamp": timestamp,
+            "machinecode": machinecode,
+            "raw_value": counter_msg.get("shootcountnumber", 0),
+        })
+        self._counters["pulses"] += 1
+        if len(self._buffer) >= self.max_batch:
+            self._wakeup.set()
+        return True
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        started = time.perf_counter()
+        db = get_production_db()
+        machinecodes = list(dict.fromkeys(p["machinecode"] for p in batch))
+
+        # 0. Tính actual_cycle_time từ pulse trước của cùng máy (cache, chỉ đọc DB với máy chưa biết)
+        pulses = get_last_pulse_cache()
+        prev: Dict[str, Optional[datetime]] = {}
+        for m_code in machinecodes:
+            prev[m_code] = await pulses.load(m_code)
+        records = []
+        for pulse in batch:
+            m_code, ts = pulse["machinecode"], pulse["timestamp"]
+            prev_ts = prev[m_code]
+            actual_cycle_time = round((ts - prev_ts).total_seconds(), 2) if prev_ts else 0.0
+            prev[m_code] = ts
+            pulses.update(m_code, ts)
+            records.append({
+                "timestamp": ts,
+                "machinecode": m_code,
+                "data": {
+                    "raw_value": pulse["raw_value"],
+                    "actual_cycle_time": actual_cycle_time
+                }
+            })
+
+        # 1. Pulse mới nghĩa là máy đang chạy: đóng downtime đang mở và đặt lại hẹn giờ (không đọc DB)
+        monitor = get_downtime_monitor()
+        for m_code in machinecodes:
+            await monitor.on_pulse(m_code, pulses.get(m_code))
+            self._counters["downtime_checks"] += 1
+
+        # 2. Lưu IoT record theo lô, cộng vào KPI trong bộ nhớ các pulse đã ghi
+        live = get_live_kpi()
+        try:
+            result = await db.iot_records.insert_many(records, ordered=False)
+            self._counters["inserted"] += len(result.inserted_ids)
+            for r in records:
+                live.on_pulse(r["machinecode"], r["timestamp"], r["data"]["actual_cycle_time"])
+        except BulkWriteError as e:
+            # Không biết chính xác record nào lỗi: để vòng đối chiếu của LiveKPIRegistry sửa tổng
+            inserted = e.details.get("nInserted", 0)
+            self._counters["inserted"] += inserted
+            self._counters["errors"] += len(records) - inserted
+            print(f">>> [DB ERROR] IoTRecord bulk insert lỗi {len(records) - inserted}/{len(records)} record: {e.details.get('writeErrors', [])[:1]}")
+        except Exception as e:
+            self._counters["errors"] += len(records)
+            print(f">>> [DB ERROR] IoTRecord save failed: {e}")
+        else:
+            print(f">>> [DB] Saved {len(records)} IoTRecord cho {len(machinecodes)} máy")
+
+        self._dirty.update(machinecodes)
+        self._counters["flushes"] += 1
+        self._last_flush_ms = (time.perf_counter() - started) * 1000
+        self._flush_total += self._last_flush_ms
+
+    async def refresh_kpi(self, force: bool = False):
+        """Cập nhật OEE/KPI cho các máy có pulse mới, mỗi máy tối đa một lần mỗi `kpi_interval`."""
+        now = time.monotonic()
+        for m_code in list(self._dirty):
+            if not force and now - self._last_kpi.get(m_code, 0.0) < self.kpi_interval:
+                continue
+            self._dirty.discard(m_code)
+            self._last_kpi[m_code] = now
+            await update_current_production_stats(m_code, do_publish=False)
+            self._counters["kpi_updates"] += 1
+
+    async def _run(self):
+        wait = min(self.flush_interval, self.kpi_interval) or 0.05
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                await self.refresh_kpi()
+            except Exception as e:
+                print(f">>> [INGEST ERROR] Lỗi ghi lô counter: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+            print(f">>> [INGEST] Gom counter theo lô (flush={self.flush_interval}s, batch={self.max_batch}, kpi={self.kpi_interval}s)", flush=True)
+
+    async def stop(self):
+        """Dừng task nền và ghi nốt các pulse còn trong bộ đệm."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        await self.refresh_kpi(force=True)
+
+    def stats(self) -> dict:
+        flushes = self._counters["flushes"]
+        return {
+            **self._counters,
+            "buffered": len(self._buffer),
+            "pending_kpi": len(self._dirty),
+            "avg_batch": round(self._counters["inserted"] / flushes, 2) if flushes else 0.0,
+            "avg_flush_ms": round(self._flush_total / flushes, 2) if flushes else 0.0,
+            "last_flush_ms": round(self._last_flush_ms, 2),
+        }
@@ -0,0 +1,117 @@
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from app.utils.messaging import mqtt_publish
+
+FULL = "full"
+DELTA = "delta"
+
+# Trường thay đổi theo đồng hồ (mỗi giây): không tự kích hoạt publish, chỉ đi kèm khi có thay đổi khác
+DEFAULT_IGNORE_FIELDS = (
+    "timestamp",
+    "stats.run_seconds",
+    "stats.actual_run_seconds",
+    "stats.downtime_seconds",
+)
+IDENTITY_FIELDS = ("_id", "machinecode", "shiftcode", "timestamp")
+
+def _flatten(data: dict, prefix: str = "") -> Dict[str, Any]:
+    flat = {}
+    for key, value in data.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{path}."))
+        else:
+            flat[path] = value
+    return flat
+
+def _unflatten(flat: Dict[str, Any]) -> dict:
+    data: dict = {}
+    for path, value in flat.items():
+        node = data
+        *parents, leaf = path.split(".")
+        for key in parents:
+            node = node.setdefault(key, {})
+        node[leaf] = value
+    return data
+
+class KPIPublisher:
+    """
+    Publish shift summary theo thay đổi thay vì gửi toàn bộ mỗi giây.
+    - Chỉ publish khi KPI/stats thay đổi (bỏ qua các trường chỉ tăng theo đồng hồ, `ignore_fields`).
+    - Mode `delta`: chỉ gửi các trường khác với lần publish trước (kèm `_id`, `machinecode`, `shiftcode`,
+      `timestamp` và `"delta": true`); cứ `keyframe_interval` giây (hoặc khi sang ca mới) gửi bản đầy đủ
+      `"keyframe": true`. Mode `full`: luôn gửi bản đầy đủ.
+    - `retained_prefix`: bản đầy đủ mới nhất của từng máy được publish retained lên `{prefix}/{machinecode}`,
+      HMI kết nối sau nhận ngay trạng thái hiện tại.
+    """
+
+    def __init__(
+        self,
+        topic: str = "topic/get/productionrecord",
+        mode: str = FULL,
+        keyframe_interval: float = 30.0,
+        retained_prefix: Optional[str] = None,
+        ignore_fields: Iterable[str] = DEFAULT_IGNORE_FIELDS,
+    ):
+        if mode not in (FULL, DELTA):
+            raise ValueError(f"Mode publish KPI không hợp lệ: {mode}")
+        self.topic = topic
+        self.mode = mode
+        self.keyframe_interval = keyframe_interval
+        self.retained_prefix = retained_prefix
+        self.ignore_fields = set(ignore_fields)
+        self._last: Dict[str, Dict[str, Any]] = {}  # machinecode -> summary (flatten) đã publish
+        self._last_keyframe: Dict[str, float] = {}
+        self._counters = {"evaluated": 0, "suppressed": 0, "published_full": 0, "published_delta": 0}
+
+    def publish(self, summary: dict, force: bool = False) -> bool:
+        """Publish `summary` của một máy nếu có thay đổi. Trả về True nếu đã gửi."""
+        if not summary:
+            return False
+        m_code = summary.get("machinecode")
+        self._counters["evaluated"] += 1
+        flat = _flatten(summary)
+        prev = self._last.get(m_code)
+        now = time.monotonic()
+
+        keyframe = (
+            force or prev is None
+            or prev.get("_id") != flat.get("_id")
+            or now - self._last_keyframe.get(m_code, 0.0) >= self.keyframe_interval
+        )
+        changed = {k: v for k, v in flat.items() if prev is None or prev.get(k) != v}
+        if not keyframe and not any(k not in self.ignore_fields for k in changed):
+            self._counters["suppressed"] += 1
+            return False
+
+        self._last[m_code] = flat
+        if keyframe or self.mode == FULL:
+            if keyframe:
+                self._last_keyframe[m_code] = now
+            payload = dict(summary, keyframe=True) if self.mode == DELTA else summary
+            mqtt_publish(self.topic, payload)
+            self._counters["published_full"] += 1
+        else:
+            delta = {k: flat[k] for k in IDENTITY_FIELDS if k in flat}
+            delta.update(changed)
+            mqtt_publish(self.topic, dict(_unflatten(delta), delta=True))
+            self._counters["published_delta"] += 1
+
+        if self.retained_prefix and m_code:
+            mqtt_publish(f"{self.retained_prefix}/{m_code}", summary, retain=True)
+        return True
+
+    def forget(self, machinecode: str):
+        """Lần publish kế tiếp của máy sẽ là bản đầy đủ."""
+        self._last.pop(machinecode, None)
+        self._last_keyframe.pop(machinecode, None)
+
+    def stats(self) -> dict:
+        evaluated = self._counters["evaluated"]
+        return {
+            "mode": self.mode,
+            "machines": len(self._last),
+            **self._counters,
+            "suppress_rate": round(self._counters["suppressed"] / evaluated, 3) if evaluated else 0.0,
+        }
@@ -0,0 +1,267 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from app.config import KPI_RECONCILE_INTERVAL_S
+from app.storage.db import get_production_db
+from app.storage.master_cache import get_master_cache
+
+
+def _overlap(start: datetime, end: datetime, range_start: datetime, range_end: datetime) -> float:
+    """Số giây giao nhau giữa [start, end] và [range_start, range_end]."""
+    actual_start, actual_end = max(start, range_start), min(end, range_end)
+    return (actual_end - actual_start).total_seconds() if actual_start < actual_end else 0.0
+
+
+class MachineKPIState:
+    """
+    Trạng thái KPI đang chạy của bản ghi sản xuất `running` của một máy.
+    Tổng sản lượng, lỗi, downtime và cycle time được cộng dồn theo từng sự kiện (O(1)),
+    KPI được tính từ các tổng này thay vì aggregate lại từ `createtime`.
+    """
+
+    __slots__ = (
+        "machinecode", "record_id", "productcode", "start_time",
+        "total_count", "defect_count", "downtime_closed", "active_downtime_start",
+        "last_pulse", "last_cycle", "cycle_sum", "cycle_count",
+        "idealcyclesec", "plannedqty", "productname", "machinename",
+    )
+
+    def __init__(self, machinecode: str, record_doc: dict):
+        self.machinecode = machinecode
+        self.record_id = record_doc["_id"]
+        self.productcode = record_doc.get("productcode", "").strip()
+        self.start_time = record_doc["createtime"]
+        self.total_count = 0
+        self.defect_count = 0
+        self.downtime_closed = 0.0
+        self.active_downtime_start: Optional[datetime] = None
+        self.last_pulse: Optional[datetime] = None
+        self.last_cycle = 0.0
+        self.cycle_sum = 0.0
+        self.cycle_count = 0
+        self.idealcyclesec = 1.0
+        self.plannedqty = 0
+        self.productname = None
+        self.machinename = None
+
+    def add_pulse(self, timestamp: datetime, cycle_time: float = 0.0):
+        if timestamp < self.start_time:
+            return
+        self.total_count += 1
+        self.last_pulse = timestamp if self.last_pulse is None else max(self.last_pulse, timestamp)
+        if cycle_time > 0:
+            self.last_cycle = cycle_time
+            self.cycle_sum += cycle_time
+            self.cycle_count += 1
+
+    def add_defect(self, timestamp: datetime):
+        if timestamp >= self.start_time:
+            self.defect_count += 1
+
+    def open_downtime(self, start: datetime):
+        self.active_downtime_start = start
+
+    def close_downtime(self, start: datetime, end: datetime):
+        self.downtime_closed += _overlap(start, end, self.start_time, end)
+        if self.active_downtime_start == start:
+            self.active_downtime_start = None
+
+    def downtime_seconds(self, now: datetime) -> int:
+        active = _overlap(self.active_downtime_start, now, self.start_time, now) if self.active_downtime_start else 0.0
+        return int(self.downtime_closed + active)
+
+    def document(self, now: datetime) -> dict:
+        """Các trường `$set` của production_records (cùng công thức với trước đây)."""
+        total_count, defect_count = self.total_count, self.defect_count
+        run_seconds = int((now - self.start_time).total_seconds())
+        downtime_seconds = self.downtime_seconds(now)
+        actual_run_seconds = max(0, run_seconds - downtime_seconds)
+        availability = actual_run_seconds / run_seconds if run_seconds > 0 else 0.0
+        if total_count > 0:
+            performance = (self.idealcyclesec * total_count) / actual_run_seconds if actual_run_seconds > 0 else 0.0
+            quality = (total_count - defect_count) / total_count
+            oee = availability * performance * quality
+            avg_cycle = actual_run_seconds / total_count
+        else: performance = quality = oee = avg_cycle = 0.0
+        return {
+            "machinestatus": "stopped" if self.active_downtime_start else "running",
+            "productname": self.productname,
+            "machinename": self.machinename,
+            "kpis": {"availability": round(availability, 2), "performance": round(performance, 2), "quality": round(quality, 2), "oee": round(oee, 2)},
+            "stats": {"total_count": total_count, "defect_count": defect_count, "good_product": int(total_count - defect_count), "avg_cycle": round(avg_cycle, 2), "run_seconds": run_seconds, "actual_run_seconds": actual_run_seconds, "downtime_seconds": downtime_seconds, "idealcyclesec": round(float(self.idealcyclesec), 2), "PlannedQty": self.plannedqty}
+        }
+
+
+class LiveKPIRegistry:
+    """
+    Trạng thái KPI trong bộ nhớ của các máy đang có bản ghi `running`.
+    - Nạp từ DB (aggregate một lần) khi máy được hỏi tới lần đầu hoặc sau khi bản ghi đổi (`discard`).
+    - Pulse, defect, downtime mở/đóng cập nhật tổng trong bộ nhớ; `update_current_production_stats`
+      chỉ còn một lệnh ghi `production_records` (publisher ghi định kỳ mỗi giây).
+    - Sự kiện tới khi máy chưa được nạp bị bỏ qua (lần nạp sẽ đọc từ DB). Mỗi `reconcile_interval`
+      giây, tổng trong bộ nhớ được đối chiếu lại với DB để sửa sai lệch (ghi lỗi, sự kiện lọt lúc đang nạp).
+    """
+
+    def __init__(self, reconcile_interval: float = 300.0):
+        self.reconcile_interval = reconcile_interval
+        self._states: Dict[str, MachineKPIState] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._generation: Dict[str, int] = {}
+        self._master_stale = False
+        self._task: Optional[asyncio.Task] = None
+        self._counters = {"loads": 0, "events": 0, "ignored": 0, "reconciles": 0, "drift_corrections": 0}
+        self._last_reconcile_ms = 0.0
+
+    # --- Nạp / đối chiếu với DB ---
+
+    async def _aggregate(self, state: MachineKPIState, now: datetime) -> Tuple[int, int, float, Optional[datetime]]:
+        """Tổng pulse, lỗi, downtime đã đóng và downtime đang mở của bản ghi tính từ DB."""
+        db, m_code, start_time = get_production_db(), state.machinecode, state.start_time
+        iot_result = await db.iot_records.aggregate([{"$match": {"machinecode": m_code, "timestamp": {"$gte": start_time, "$lte": now}}}, {"$group": {"_id": None, "total_count": {"$sum": 1}}}]).to_list(1)
+        total_count = iot_result[0]["total_count"] if iot_result else 0
+        defect_result = await db.defect_records.aggregate([{"$match": {"machinecode": m_code, "timestamp": {"$gte": start_time, "$lte": now}}}, {"$group": {"_id": None, "defect_count": {"$sum": 1}}}]).to_list(1)
+        defect_count = defect_result[0]["defect_count"] if defect_result else 0
+        dts = await db.downtime_records.find({"machinecode": m_code, "start_time": {"$lt": now}, "$or": [{"end_time": {"$gt": start_time}}, {"status": "active"}]}).to_list(None)
+        closed, active_start = 0.0, None
+        for dt in dts:
+            if dt.get("status") == "active":
+                active_start = dt["start_time"] if active_start is None else max(active_start, dt["start_time"])
+            elif dt.get("end_time"):
+                closed += _overlap(dt["start_time"], dt["end_time"], start_time, now)
+        return total_count, defect_count, closed, active_start
+
+    async def _apply_master(self, state: MachineKPIState):
+        """Thông số từ master data (cache): idealcyclesec, PlannedQty, tên sản phẩm / máy."""
+        master = get_master_cache()
+        wp_doc = await master.working_parameter(state.productcode)
+        state.idealcyclesec = wp_doc["idealcyclesec"] if wp_doc and "idealcyclesec" in wp_doc else 1.0
+        product_doc = await master.product(state.productcode)
+        state.plannedqty = product_doc.get("plannedqty", 0) if product_doc else 0
+        state.productname = product_doc.get("productname") if product_doc else None
+        machine_doc = await master.machine(state.machinecode)
+        state.machinename = machine_doc.get("machinename") if machine_doc else None
+
+    def on_master_change(self, collection: str):
+        """Listener của master cache: thông số của các máy đã nạp được lấy lại ở lần hỏi kế tiếp."""
+        if collection in ("workingparameter", "product", "machine"):
+            self._master_stale = True
+
+    async def _load(self, m_code: str) -> Optional[MachineKPIState]:
+        db, now = get_production_db(), datetime.utcnow()
+        record_doc = await db.production_records.find_one({"machinecode": m_code, "status": "running"}, sort=[("createtime", -1)])
+        if not record_doc:
+            return None
+        state = MachineKPIState(m_code, record_doc)
+        state.total_count, state.defect_count, state.downtime_closed, state.active_downtime_start = await self._aggregate(state, now)
+        await self._apply_master(state)
+        self._counters["loads"] += 1
+        print(f">>> [LIVE KPI] Nạp trạng thái {record_doc['_id']}: count={state.total_count}, defect={state.defect_count}")
+        return state
+
+    async def get(self, machinecode: str) -> Optional[MachineKPIState]:
+        m_code = machinecode.strip()
+        if self._master_stale:
+            self._master_stale = False
+            for loaded in list(self._states.values()):
+                await self._apply_master(loaded)
+        state = self._states.get(m_code)
+        if state is not None:
+            return state
+        async with self._locks.setdefault(m_code, asyncio.Lock()):
+            state = self._states.get(m_code)
+            if state is None:
+                generation = self._generation.get(m_code, 0)
+                state = await self._load(m_code)
+                # Bản ghi đổi trong lúc đang nạp: không giữ trạng thái của bản ghi cũ
+                if state is not None and self._generation.get(m_code, 0) == generation:
+                    self._states[m_code] = state
+            return state
+
+    def peek(self, machinecode: str) -> Optional[MachineKPIState]:
+        """Trạng thái đã nạp của máy (không nạp từ DB)."""
+        return self._states.get(machinecode.strip()) if machinecode else None
+
+    def discard(self, machinecode: str):
+        """Bản ghi `running` của máy thay đổi (chốt / khởi tạo): lần hỏi sau nạp lại từ DB."""
+        m_code = machinecode.strip()
+        self._generation[m_code] = self._generation.get(m_code, 0) + 1
+        self._states.pop(m_code, None)
+
+    async def reconcile(self):
+        """Đối chiếu tổng trong bộ nhớ với DB, sửa các máy bị lệch."""
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        for m_code, state in list(self._states.items()):
+            try:
+                total_count, defect_count, closed, active_start = await self._aggregate(state, now)
+            except Exception as e:
+                print(f">>> [LIVE KPI ERROR] Lỗi đối chiếu {m_code}: {e}")
+                continue
+            if self._states.get(m_code) is not state:
+                continue
+            if (total_count, defect_count, int(closed), active_start) != (state.total_count, state.defect_count, int(state.downtime_closed), state.active_downtime_start):
+                print(f">>> [LIVE KPI] Sửa lệch {m_code}: count {state.total_count}->{total_count}, defect {state.defect_count}->{defect_count}, downtime {int(state.downtime_closed)}->{int(closed)}s")
+                state.total_count, state.defect_count, state.downtime_closed, state.active_downtime_start = total_count, defect_count, closed, active_start
+                self._counters["drift_corrections"] += 1
+        self._counters["reconciles"] += 1
+        self._last_reconcile_ms = (time.perf_counter() - started) * 1000
+
+    # --- Sự kiện (đồng bộ, không I/O) ---
+
+    def _event_state(self, machinecode: str) -> Optional[MachineKPIState]:
+        state = self._states.get(machinecode.strip()) if machinecode else None
+        self._counters["events" if state else "ignored"] += 1
+        return state
+
+    def on_pulse(self, machinecode: str, timestamp: datetime, cycle_time: float = 0.0):
+        state = self._event_state(machinecode)
+        if state: state.add_pulse(timestamp, cycle_time)
+
+    def on_defect(self, machinecode: str, timestamp: datetime):
+        state = self._event_state(machinecode)
+        if state: state.add_defect(timestamp)
+
+    def on_downtime_open(self, machinecode: str, start: datetime):
+        state = self._event_state(machinecode)
+        if state: state.open_downtime(start)
+
+    def on_downtime_close(self, machinecode: str, start: datetime, end: datetime):
+        state = self._event_state(machinecode)
+        if state: state.close_downtime(start, end)
+
+    # --- Vòng đời ---
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                print(f">>> [LIVE KPI ERROR] Lỗi vòng đối chiếu: {e}")
+
+    def start(self):
+        if self._task is None and self.reconcile_interval > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "machines": len(self._states),
+            **self._counters,
+            "last_reconcile_ms": round(self._last_reconcile_ms, 2),
+        }
+
+
+_live_kpi = None
+
+def get_live_kpi() -> LiveKPIRegistry:
+    global _live_kpi
+    if _live_kpi is None:
+        _live_kpi = LiveKPIRegistry(KPI_RECONCILE_INTERVAL_S)
+    return _live_kpi
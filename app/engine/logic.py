@@ -1,9 +1,15 @@
-from app.storage.schemas import ProductionRecord, DowntimeRecord
-from app.storage.db import get_production_db, get_database
-from datetime import datetime, timedelta
+from app.storage.schemas import ProductionRecord
+from app.storage.db import get_production_db
+from datetime import datetime
 from typing import Optional
 import sys
+import asyncio
+from pymongo import UpdateOne, ReplaceOne
 from app.utils.messaging import mqtt_publish
+from app.engine.live_kpi import get_live_kpi
+from app.storage.master_cache import get_master_cache
+from app.engine.shift_calendar import get_shift_calendar
+from app.engine.downtime import get_downtime_monitor
 
 async def finalize_production_record_on_shift_change(machinecode: str, old_shift_info: dict, timestamp: datetime, target_record_id: Optional[str] = None):
     """Chốt bản ghi khi hết ca và chuẩn bị cho ca mới."""
@@ -70,7 +76,6 @@ async def create_production_record_on_changeover(
         old_p = old_productcode.strip() if old_productcode else ""
         sys.stdout.flush()
         db = get_production_db()
-        db_master = get_database()
         now_utc = datetime.utcnow()
         
         query = {"machinecode": m_code, "status": "running"}
@@ -104,17 +109,19 @@ async def create_production_record_on_changeover(
         defect_count = defect_result[0]["defect_count"] if defect_result else 0
         
         run_seconds = int((changeover_timestamp - start_time).total_seconds())
-        downtime_seconds = await calculate_downtime_in_range(m_code, start_time, changeover_timestamp)
+        # Bản ghi đang được theo dõi trong bộ nhớ: downtime đã cộng dồn theo sự kiện, không đọc downtime_records
+        live_state = get_live_kpi().peek(m_code)
+        if live_state is not None and live_state.record_id == target_id:
+            downtime_seconds = live_state.downtime_seconds(changeover_timestamp)
+        else:
+            downtime_seconds = await calculate_downtime_in_range(m_code, start_time, changeover_timestamp)
         
         p_code = actual_productcode.strip() if actual_productcode else ""
-        wp_doc = await db_master["workingparameter"].find_one({"productcode": p_code})
-        if not wp_doc:
-            wp_doc = await db_master["workingparameter"].find_one({"productcode": {"$regex": f"^{p_code}$", "$options": "i"}})
+        master = get_master_cache()
+        wp_doc = await master.working_parameter(p_code)
         idealcyclesec = wp_doc["idealcyclesec"] if wp_doc and "idealcyclesec" in wp_doc else 1.0
         
-        product_doc = await db_master["product"].find_one({"productcode": p_code})
-        if not product_doc:
-            product_doc = await db_master["product"].find_one({"productcode": {"$regex": f"^{p_code}$", "$options": "i"}})
+        product_doc = await master.product(p_code)
         plannedqty = product_doc.get("plannedqty", 0) if product_doc else 0
         
         actual_run_seconds = max(0, run_seconds - downtime_seconds)
@@ -151,6 +158,8 @@ async def create_production_record_on_changeover(
             }
         )
         await db.production_records.replace_one({"_id": target_id}, record.model_dump(by_alias=True, exclude_none=True), upsert=True)
+        get_live_kpi().discard(m_code)
+        get_downtime_monitor().set_idle(m_code)
         final_doc = record.model_dump(by_alias=True, exclude_none=True)
         if "_id" in final_doc: final_doc["_id"] = str(final_doc["_id"])
         mqtt_publish("topic/get/productionrecord", final_doc)
@@ -161,75 +170,23 @@ async def create_production_record_on_changeover(
         return None
 
 async def get_current_shift():
-    now = datetime.now()
-    current_seconds = now.hour * 3600 + now.minute * 60 + now.second
-    db_master = get_database()
-    all_shifts = await db_master["shift"].find().to_list(100)
-    
-    active_shift = None
-    for s in all_shifts:
-        def to_sec(val):
-            if isinstance(val, (int, float)): return int(val)
-            if isinstance(val, datetime): return val.hour * 3600 + val.minute * 60 + val.second
-            return 0
-        s_start, s_end = to_sec(s.get("shiftstarttime")), to_sec(s.get("shiftendtime"))
-        is_in_shift = False
-        if s_start <= s_end:
-            if s_start <= current_seconds <= s_end: is_in_shift = True
-        else:
-            if current_seconds >= s_start or current_seconds <= s_end: is_in_shift = True
-        if is_in_shift:
-            active_shift = s
-            active_shift["_start_sec"], active_shift["_end_sec"] = s_start, s_end
-            break
-
-    if not active_shift: active_shift = {"shiftcode": "SHIFT_01", "_start_sec": 21600, "_end_sec": 50400}
-    start_dt = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(seconds=active_shift["_start_sec"])
-    end_dt = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(seconds=active_shift["_end_sec"])
-    if active_shift["_start_sec"] > active_shift["_end_sec"]:
-        if current_seconds >= active_shift["_start_sec"]: end_dt += timedelta(days=1)
-        else: start_dt -= timedelta(days=1)
-
-    break_info = active_shift.get("breaktime", {})
-    b_start_sec, b_end_sec = break_info.get("breakstart"), break_info.get("breakend")
-    breakstart_dt = breakend_dt = None
-    if b_start_sec is not None and b_end_sec is not None:
-        breakstart_dt = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(seconds=b_start_sec)
-        breakend_dt = now.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(seconds=b_end_sec)
-        if active_shift["_start_sec"] > active_shift["_end_sec"]:
-            if current_seconds >= active_shift["_start_sec"]:
-                if b_start_sec < active_shift["_start_sec"]: breakstart_dt += timedelta(days=1); breakend_dt += timedelta(days=1)
-            else:
-                if b_start_sec > active_shift["_end_sec"]: breakstart_dt -= timedelta(days=1); breakend_dt -= timedelta(days=1)
-    
-    utc_now, local_now = datetime.utcnow(), datetime.now()
-    offset = local_now - utc_now
-    return {
-        "shiftcode": active_shift["shiftcode"],
-        "startshift": start_dt - offset, "endshift": end_dt - offset,
-        "breakstart": (breakstart_dt - offset) if breakstart_dt else None,
-        "breakend": (breakend_dt - offset) if breakend_dt else None
-    }
-
-async def get_current_shift_code() -> str:
-    info = await get_current_shift()
-    return info["shiftcode"]
+    """Ca hiện tại (giờ UTC) tra từ lịch ca biên dịch sẵn (`shift_calendar.py`)."""
+    now = datetime.utcnow()
+    calendar = await get_shift_calendar(now)
+    return calendar.shift_at(now)
 
 async def initialize_production_record(machinecode: str, productcode: str):
     try:
         m_code, p_code = machinecode.strip(), productcode.strip() if productcode else ""
-        db_master = get_database()
+        master = get_master_cache()
         shift_info = await get_current_shift()
-        wp_doc = await db_master["workingparameter"].find_one({"productcode": p_code})
-        if not wp_doc: wp_doc = await db_master["workingparameter"].find_one({"productcode": {"$regex": f"^{p_code}$", "$options": "i"}})
+        wp_doc = await master.working_parameter(p_code)
         idealcyclesec = wp_doc["idealcyclesec"] if wp_doc and "idealcyclesec" in wp_doc else 1.0
-        product_doc = await db_master["product"].find_one({"productcode": p_code})
-        if not product_doc: product_doc = await db_master["product"].find_one({"productcode": {"$regex": f"^{p_code}$", "$options": "i"}})
+        product_doc = await master.product(p_code)
         plannedqty = product_doc.get("plannedqty", 0) if product_doc else 0
         p_name = product_doc.get("productname") if product_doc else None
 
-        machine_doc = await db_master["machine"].find_one({"machinecode": m_code})
-        if not machine_doc: machine_doc = await db_master["machine"].find_one({"machinecode": {"$regex": f"^{m_code}$", "$options": "i"}})
+        machine_doc = await master.machine(m_code)
         m_name = machine_doc.get("machinename") if machine_doc else None
 
         now = datetime.utcnow()
@@ -246,6 +203,8 @@ async def initialize_production_record(machinecode: str, productcode: str):
             is_synced=False, stats={"idealcyclesec": round(float(idealcyclesec), 2), "PlannedQty": plannedqty}
         )
         await db.production_records.insert_one(record.model_dump(by_alias=True, exclude_none=True))
+        get_live_kpi().discard(m_code)
+        await get_downtime_monitor().set_running(m_code, p_code, record.createtime)
         init_doc = record.model_dump(by_alias=True, exclude_none=True)
         if "_id" in init_doc: init_doc["_id"] = str(init_doc["_id"])
         mqtt_publish("topic/get/productionrecord", init_doc)
@@ -256,51 +215,13 @@ async def initialize_production_record(machinecode: str, productcode: str):
         return None
 
 async def update_current_production_stats(machinecode: str, do_publish: bool = True):
+    """Ghi KPI của bản ghi đang chạy từ trạng thái trong bộ nhớ (`LiveKPIRegistry`), không aggregate lại."""
     try:
         db, now, m_code = get_production_db(), datetime.utcnow(), machinecode.strip()
-        record_doc = await db.production_records.find_one({"machinecode": m_code, "status": "running"}, sort=[("createtime", -1)])
-        if not record_doc: return
-        start_time, record_id = record_doc["createtime"], record_doc["_id"]
-        iot_result = await db.iot_records.aggregate([{"$match": {"machinecode": m_code, "timestamp": {"$gte": start_time, "$lte": now}}}, {"$group": {"_id": None, "total_count": {"$sum": 1}}}]).to_list(1)
-        total_count = iot_result[0]["total_count"] if iot_result else 0
-        defect_result = await db.defect_records.aggregate([{"$match": {"machinecode": m_code, "timestamp": {"$gte": start_time, "$lte": now}}}, {"$group": {"_id": None, "defect_count": {"$sum": 1}}}]).to_list(1)
-        defect_count = defect_result[0]["defect_count"] if defect_result else 0
-        run_seconds = int((now - start_time).total_seconds())
-        downtime_seconds = await calculate_downtime_in_range(m_code, start_time, now)
-        
-        db_master = get_database()
-        p_code = record_doc.get("productcode", "").strip()
-        wp_doc = await db_master["workingparameter"].find_one({"productcode": p_code})
-        if not wp_doc: wp_doc = await db_master["workingparameter"].find_one({"productcode": {"$regex": f"^{p_code}$", "$options": "i"}})
-        idealcyclesec = wp_doc["idealcyclesec"] if wp_doc and "idealcyclesec" in wp_doc else 1.0
-        product_doc = await db_master["product"].find_one({"productcode": p_code})
-        if not product_doc: product_doc = await db_master["product"].find_one({"productcode": {"$regex": f"^{p_code}$", "$options": "i"}})
-        plannedqty = product_doc.get("plannedqty", 0) if product_doc else 0
-        active_dt = await db.downtime_records.find_one({"machinecode": m_code, "status": "active"})
-        
-        actual_run_seconds = max(0, run_seconds - downtime_seconds)
-        availability = actual_run_seconds / run_seconds if run_seconds > 0 else 0.0
-        if total_count > 0:
-            performance = (idealcyclesec * total_count) / actual_run_seconds if actual_run_seconds > 0 else 0.0
-            quality = (total_count - defect_count) / total_count
-            oee = availability * performance * quality
-            avg_cycle = actual_run_seconds / total_count
-        else: performance = quality = oee = avg_cycle = 0.0
-        machine_status_now = "stopped" if active_dt else "running"
-        
-        # Lấy tên sản phẩm và tên máy để cập nhật (nếu chưa có hoặc để đảm bảo đồng bộ)
-        p_name = product_doc.get("productname") if product_doc else None
-        machine_doc = await db_master["machine"].find_one({"machinecode": m_code})
-        if not machine_doc: machine_doc = await db_master["machine"].find_one({"machinecode": {"$regex": f"^{m_code}$", "$options": "i"}})
-        m_name = machine_doc.get("machinename") if machine_doc else None
-
-        update_data = {"$set": {
-            "machinestatus": machine_status_now,
-            "productname": p_name,
-            "machinename": m_name,
-            "kpis": {"availability": round(availability, 2), "performance": round(performance, 2), "quality": round(quality, 2), "oee": round(oee, 2)},
-            "stats": {"total_count": total_count, "defect_count": defect_count, "good_product": int(total_count - defect_count), "avg_cycle": round(avg_cycle, 2), "run_seconds": run_seconds, "actual_run_seconds": actual_run_seconds, "downtime_seconds": downtime_seconds, "idealcyclesec": round(float(idealcyclesec), 2), "PlannedQty": plannedqty}
-        }}
+        state = await get_live_kpi().get(m_code)
+        if not state: return
+        record_id = state.record_id
+        update_data = {"$set": state.document(now)}
         await db.production_records.update_one({"_id": record_id}, update_data)
         if do_publish:
             updated_doc = await db.production_records.find_one({"_id": record_id})
@@ -309,27 +230,6 @@ async def update_current_production_stats(machinecode: str, do_publish: bool = T
                 mqtt_publish("topic/get/productionrecord", updated_doc)
     except Exception as e: print(f">>> [LOGIC ERROR] Lỗi update_current_production_stats: {e}")
 
-async def check_and_create_downtime():
-    try:
-        db, db_master, now = get_production_db(), get_database(), datetime.utcnow()
-        active_prods = await db.production_records.find({"status": "running"}).to_list(None)
-        for prod in active_prods:
-            m_code, p_code = prod["machinecode"].strip(), prod.get("productcode", "").strip()
-            wp_doc = await db_master["workingparameter"].find_one({"productcode": p_code})
-            threshold = wp_doc.get("downtimethreshold", 300) if wp_doc else 300
-            if await db.downtime_records.find_one({"machinecode": m_code, "status": "active"}): continue
-            last_iot = await db.iot_records.find_one({"machinecode": m_code}, sort=[("timestamp", -1)])
-            last_ts = last_iot["timestamp"] if last_iot else prod["createtime"]
-            
-            # Kiểm tra xem đã có bản ghi downtime nào với start_time này chưa (tránh trùng lặp do polling)
-            if await db.downtime_records.find_one({"machinecode": m_code, "start_time": last_ts}): continue
-            if (now - last_ts).total_seconds() > threshold:
-                new_dt = DowntimeRecord(machinecode=m_code, start_time=last_ts, status="active")
-                res = await db.downtime_records.insert_one(new_dt.model_dump(by_alias=True, exclude_none=True))
-                new_id = res.inserted_id
-                mqtt_publish("topic/downtimeinput", {"id": str(new_id), "machine": m_code, "status": "active", "downtimecode": "default", "createtime": last_ts, "endtime": "None", "duration": 0})
-    except Exception as e: print(f">>> [DOWNTIME ERROR] Lỗi check_and_create_downtime: {e}")
-
 async def close_active_downtime(machinecode: str):
     try:
         db, now, m_code = get_production_db(), datetime.utcnow(), machinecode.strip()
@@ -338,93 +238,133 @@ async def close_active_downtime(machinecode: str):
             for dt in active_dts:
                 duration = int((now - dt["start_time"]).total_seconds())
                 await db.downtime_records.update_one({"_id": dt["_id"]}, {"$set": {"end_time": now, "duration_seconds": max(0, duration), "status": "closed"}})
+                get_live_kpi().on_downtime_close(m_code, dt["start_time"], now)
             last_dt = active_dts[-1]
             last_duration = int((now - last_dt["start_time"]).total_seconds())
             d_code = last_dt.get("downtime_code") or "default"
             mqtt_publish("topic/downtimeinput", {"id": str(last_dt["_id"]), "machine": m_code, "status": "closed", "downtimecode": d_code, "createtime": last_dt["start_time"], "endtime": now, "duration": max(0, last_duration)})
+            get_downtime_monitor().on_closed(m_code)
             return True
         return False
     except Exception as e: print(f">>> [DOWNTIME ERROR] Lỗi close_active_downtime: {e}"); return False
 
-async def get_current_shift_stats(machinecode: str):
-    try:
-        db, shift_info, m_code = get_production_db(), await get_current_shift(), machinecode.strip()
-        records = await db.production_records.find({"machinecode": m_code, "shiftcode": shift_info["shiftcode"], "createtime": {"$gte": shift_info["startshift"]}}).to_list(None)
-        total_count = defect_count = run_seconds = actual_run_seconds = downtime_seconds = 0
-        total_standard_time = weighted_avg_cycle_sum = 0.0
-        product_plans, db_master = {}, get_database()
-        for r in records:
-            stats = r.get("stats", {})
-            dur = stats.get("run_seconds", 0)
-            total_count += stats.get("total_count", 0)
-            defect_count += stats.get("defect_count", 0)
-            run_seconds += dur
-            actual_run_seconds += stats.get("actual_run_seconds", 0)
-            downtime_seconds += stats.get("downtime_seconds", 0)
-            ideal, avg, p_code = stats.get("idealcyclesec", 1.0), stats.get("avg_cycle", 0.0), r.get("productcode", "").strip()
-            p_qty = stats.get("PlannedQty", stats.get("plannedqty", 0))
-            if p_code:
-                if p_qty == 0:
-                    p_doc = await db_master["product"].find_one({"productcode": p_code}) or await db_master["product"].find_one({"productcode": {"$regex": f"^{p_code}$", "$options": "i"}})
-                    p_qty = p_doc.get("plannedqty", 0) if p_doc else 0
-                product_plans[p_code] = max(product_plans.get(p_code, 0), p_qty)
-            total_standard_time += ideal * stats.get("total_count", 0)
-            weighted_avg_cycle_sum += avg * dur
-            
-        availability = actual_run_seconds / run_seconds if run_seconds > 0 else 0.0
-        performance = total_standard_time / actual_run_seconds if actual_run_seconds > 0 else 0.0
-        quality = (total_count - defect_count) / total_count if total_count > 0 else 0.0
-        oee = availability * performance * quality
-        shift_ideal = total_standard_time / total_count if total_count > 0 else 0.0
-        # Fix: Tính vận tốc trung bình thực tế bằng tổng thời gian chạy / tổng sản phẩm
-        shift_avg = actual_run_seconds / total_count if total_count > 0 else 0.0
+async def _shift_summary(m_code: str, shift_info: dict, records: list) -> dict:
+    """KPI tổng của ca cho một máy từ các bản ghi sản xuất của ca đó."""
+    total_count = defect_count = run_seconds = actual_run_seconds = downtime_seconds = 0
+    total_standard_time = weighted_avg_cycle_sum = 0.0
+    product_plans, master = {}, get_master_cache()
+    for r in records:
+        stats = r.get("stats", {})
+        dur = stats.get("run_seconds", 0)
+        total_count += stats.get("total_count", 0)
+        defect_count += stats.get("defect_count", 0)
+        run_seconds += dur
+        actual_run_seconds += stats.get("actual_run_seconds", 0)
+        downtime_seconds += stats.get("downtime_seconds", 0)
+        ideal, avg, p_code = stats.get("idealcyclesec", 1.0), stats.get("avg_cycle", 0.0), r.get("productcode", "").strip()
+        p_qty = stats.get("PlannedQty", stats.get("plannedqty", 0))
+        if p_code:
+            if p_qty == 0:
+                p_doc = await master.product(p_code)
+                p_qty = p_doc.get("plannedqty", 0) if p_doc else 0
+            product_plans[p_code] = max(product_plans.get(p_code, 0), p_qty)
+        total_standard_time += ideal * stats.get("total_count", 0)
+        weighted_avg_cycle_sum += avg * dur
         
-        current_machine_status = "running"
-        current_product_code = None
-        current_product_name = None
+    availability = actual_run_seconds / run_seconds if run_seconds > 0 else 0.0
+    performance = total_standard_time / actual_run_seconds if actual_run_seconds > 0 else 0.0
+    quality = (total_count - defect_count) / total_count if total_count > 0 else 0.0
+    oee = availability * performance * quality
+    shift_ideal = total_standard_time / total_count if total_count > 0 else 0.0
+    # Fix: Tính vận tốc trung bình thực tế bằng tổng thời gian chạy / tổng sản phẩm
+    shift_avg = actual_run_seconds / total_count if total_count > 0 else 0.0
+    
+    current_machine_status = "running"
+    current_product_code = None
+    current_product_name = None
 
-        for r in records:
-            if r.get("status") == "running":
-                current_machine_status = r.get("machinestatus", "running")
-                current_product_code = r.get("productcode")
-                break
-        
-        if current_product_code:
-            p_doc = await db_master["product"].find_one({"productcode": current_product_code})
-            if not p_doc:
-                p_doc = await db_master["product"].find_one({"productcode": {"$regex": f"^{current_product_code}$", "$options": "i"}})
-            if p_doc:
-                current_product_name = p_doc.get("productname")
-        
-        m_doc = await db_master["machine"].find_one({"machinecode": m_code})
-        if not m_doc:
-            m_doc = await db_master["machine"].find_one({"machinecode": {"$regex": f"^{m_code}$", "$options": "i"}})
-        current_machine_name = m_doc.get("machinename") if m_doc else None
+    for r in records:
+        if r.get("status") == "running":
+            current_machine_status = r.get("machinestatus", "running")
+            current_product_code = r.get("productcode")
+            break
+    
+    if current_product_code:
+        p_doc = await master.product(current_product_code)
+        if p_doc:
+            current_product_name = p_doc.get("productname")
+    
+    m_doc = await master.machine(m_code)
+    current_machine_name = m_doc.get("machinename") if m_doc else None
 
-        summary = {
-            "_id": f"{shift_info['shiftcode']}-{shift_info['startshift'].strftime('%d%m%Y')}-{m_code}",
-            "machinecode": m_code, "shiftcode": shift_info["shiftcode"], "startshift": shift_info["startshift"], 
-            "endshift": shift_info["endshift"], "timestamp": datetime.utcnow(),
-            "machinestatus": current_machine_status,
-            "productcode": current_product_code,
-            "productname": current_product_name,
-            "machinename": current_machine_name,
-            "kpis": {"availability": round(availability, 2), "performance": round(performance, 2), "quality": round(quality, 2), "oee": round(oee, 2)},
-            "stats": {
-                "total_count": total_count, "defect_count": defect_count, "good_product": int(total_count - defect_count), "run_seconds": run_seconds, 
-                "actual_run_seconds": actual_run_seconds, "downtime_seconds": downtime_seconds, 
-                "idealcyclesec": round(shift_ideal, 2), "avg_cycle": round(shift_avg, 2), 
-                "PlannedQty": sum(product_plans.values()), "StandardTime": round(total_standard_time, 2)
-            }
+    summary = {
+        "_id": f"{shift_info['shiftcode']}-{shift_info['startshift'].strftime('%d%m%Y')}-{m_code}",
+        "machinecode": m_code, "shiftcode": shift_info["shiftcode"], "startshift": shift_info["startshift"], 
+        "endshift": shift_info["endshift"], "timestamp": datetime.utcnow(),
+        "machinestatus": current_machine_status,
+        "productcode": current_product_code,
+        "productname": current_product_name,
+        "machinename": current_machine_name,
+        "kpis": {"availability": round(availability, 2), "performance": round(performance, 2), "quality": round(quality, 2), "oee": round(oee, 2)},
+        "stats": {
+            "total_count": total_count, "defect_count": defect_count, "good_product": int(total_count - defect_count), "run_seconds": run_seconds, 
+            "actual_run_seconds": actual_run_seconds, "downtime_seconds": downtime_seconds, 
+            "idealcyclesec": round(shift_ideal, 2), "avg_cycle": round(shift_avg, 2), 
+            "PlannedQty": sum(product_plans.values()), "StandardTime": round(total_standard_time, 2)
         }
-        await db.shift_stats.replace_one({"_id": summary["_id"]}, summary, upsert=True)
-        return summary
-    except Exception as e: print(f">>> [LOGIC ERROR] Lỗi get_current_shift_stats: {e}"); return None
+    }
+    return summary
+
+async def refresh_running_kpis(concurrency: int = 8) -> list:
+    """
+    Cập nhật KPI của mọi máy đang chạy trong một lượt (vòng publish mỗi giây), không lặp tuần tự từng máy:
+    - KPI bản ghi running lấy từ `LiveKPIRegistry` (máy chưa nạp được nạp song song, tối đa `concurrency`),
+      ghi bằng một `bulk_write` vào `production_records`.
+    - Bản ghi của ca hiện tại được đọc một lần cho mọi máy rồi nhóm theo `machinecode`;
+      KPI ca ghi bằng một `bulk_write` vào `shift_stats`.
+    Trả về danh sách KPI ca (mỗi máy một bản) để publish.
+    """
+    db, live = get_production_db(), get_live_kpi()
+    running = await db.production_records.find({"status": "running"}, {"machinecode": 1}).to_list(None)
+    machinecodes = list(dict.fromkeys(p["machinecode"].strip() for p in running if p.get("machinecode")))
+    if not machinecodes:
+        return []
+
+    # 1. KPI bản ghi running (trạng thái trong bộ nhớ)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    async def load(m_code):
+        async with semaphore:
+            try:
+                return await live.get(m_code)
+            except Exception as e:
+                print(f">>> [LOGIC ERROR] Lỗi nạp KPI {m_code}: {e}")
+                return None
+    states = await asyncio.gather(*(load(m_code) for m_code in machinecodes))
+    now = datetime.utcnow()
+    record_ops = [UpdateOne({"_id": state.record_id}, {"$set": state.document(now)}) for state in states if state]
+    if record_ops:
+        await db.production_records.bulk_write(record_ops, ordered=False)
+
+    # 2. KPI ca: một truy vấn cho mọi máy, nhóm theo machinecode
+    shift_info = await get_current_shift()
+    records = await db.production_records.find({"shiftcode": shift_info["shiftcode"], "createtime": {"$gte": shift_info["startshift"]}}).to_list(None)
+    by_machine = {}
+    for r in records:
+        by_machine.setdefault(r.get("machinecode", "").strip(), []).append(r)
+    summaries = []
+    for m_code in machinecodes:
+        try:
+            summaries.append(await _shift_summary(m_code, shift_info, by_machine.get(m_code, [])))
+        except Exception as e:
+            print(f">>> [LOGIC ERROR] Lỗi tính KPI ca {m_code}: {e}")
+    if summaries:
+        await db.shift_stats.bulk_write([ReplaceOne({"_id": summary["_id"]}, summary, upsert=True) for summary in summaries], ordered=False)
+    return summaries
 
 async def ensure_active_production_records():
     try:
-        db_master, db_prod, shift_info = get_database(), get_production_db(), await get_current_shift()
-        machines = await db_master["machine"].find().to_list(None)
+        db_prod, shift_info = get_production_db(), await get_current_shift()
+        machines = await get_master_cache().machines()
         for m in machines:
             m_code = m.get("machinecode", "").strip()
             if m_code and not await db_prod.production_records.find_one({"machinecode": m_code, "shiftcode": shift_info["shiftcode"], "createtime": {"$gte": shift_info["startshift"]}}):
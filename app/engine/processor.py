@@ -1,52 +1,81 @@
 from datetime import datetime
 from bson import ObjectId
-from app.storage.db import db_production, get_database
+from app.storage.db import db_production
 from app.storage.schemas import IoTRecord
 from app.engine.logic import (
     create_production_record_on_changeover, 
     initialize_production_record,
-    update_current_production_stats,
-    close_active_downtime
+    update_current_production_stats
 )
-from app.config import THRESHOLD, NODE_ID
+from app.config import THRESHOLD, NODE_ID, MASTER_SNAPSHOT_COMPRESS, MASTER_SNAPSHOT_CHUNK_SIZE
 from app.utils.messaging import mqtt_publish
+from app.drivers.camera import render_detection_images
+from app.storage.images import get_image_store
+from app.storage.master_cache import get_master_cache
+from app.engine.live_kpi import get_live_kpi
+from app.engine.downtime import get_downtime_monitor
 
-async def process_and_save_defect(ai_data, machinecode=None):
+def classify_camera_defect(count: int, ng_pill: int):
+    """Mã lỗi của kết quả AI: d1 (thiếu viên), d3 (viên lỗi) hoặc None nếu đạt."""
+    if count < THRESHOLD:
+        return "d1"
+    if ng_pill > 0:
+        return "d3"
+    return None
+
+async def _save_camera_defect(machinecode, defectcode, ai_data, timestamp):
+    """Lưu DefectRecord từ AI Camera; ảnh gốc nằm ở image store, record chỉ giữ tham chiếu + thumbnail."""
+    defect_doc = {
+        "timestamp": timestamp,
+        "node_id": NODE_ID,
+        "machinecode": machinecode,
+        "defectcode": defectcode,
+        "source": "CAM"
+    }
+    if ai_data.get("stale"):
+        # Ảnh lấy từ luồng camera bị trễ, có thể không khớp sản phẩm của pulse
+        defect_doc["stale_frame"] = True
+    try:
+        images = await render_detection_images(ai_data)
+        if images:
+            defect_doc["image_ref"] = await get_image_store().put(images["image"])
+            if images.get("thumbnail"):
+                defect_doc["thumbnail"] = images["thumbnail"]
+    except Exception as e:
+        print(f">>> [AI ERROR] Lưu ảnh defect thất bại, chỉ lưu record: {e}")
+
+    await db_production["defect_records"].insert_one(defect_doc)
+    get_live_kpi().on_defect(machinecode, timestamp)
+    await update_current_production_stats(machinecode, do_publish=False)
+
+async def process_and_save_defect(ai_data, machinecode=None, timestamp=None):
     if ai_data is None:
         return None
 
     count = ai_data.get("count", 0)
     ng_pill = ai_data.get("ng_pill", 0)
     machinecode = machinecode.strip() if machinecode else None
+    # Ưu tiên thời điểm pulse kích hoạt camera (job inference có thể xử lý trễ)
+    defect_ts = timestamp or datetime.utcnow()
     
+    defectcode = classify_camera_defect(count, ng_pill)
+
+    # Kết quả dùng lại (cùng frame / bỏ qua do lấy mẫu) không phải bằng chứng mới: không ghi trùng defect
+    if ai_data.get("reused"):
+        if defectcode:
+            print(f">>> [AI] Bỏ qua {defectcode} cho {machinecode}: kết quả dùng lại ({ai_data.get('reuse_reason')})")
+        return False
+
     # 1. Xử lý lỗi thiếu số lượng (d1)
-    if count < THRESHOLD:
+    if defectcode == "d1":
         print(f">>> [AI] Phát hiện lỗi thiếu viên: {count} < {THRESHOLD}. Đang lưu DefectRecord d1...")
-        defect_doc = {
-            "timestamp": datetime.utcnow(),
-            "node_id": NODE_ID,
-            "machinecode": machinecode,
-            "defectcode": "d1",
-            "source": "CAM",
-            "raw_image": ai_data.get("image_bytes")
-        }
-        await db_production["defect_records"].insert_one(defect_doc)
-        await update_current_production_stats(machinecode, do_publish=False)
+        await _save_camera_defect(machinecode, "d1", ai_data, defect_ts)
         return True
 
     # 2. Xử lý lỗi viên nén không đạt (ng_pill -> d3)
-    if ng_pill > 0:
+    if defectcode == "d3":
         print(f">>> [AI] Phát hiện viên lỗi (ng_pill): {ng_pill}. Đang lưu DefectRecord d3...")
-        defect_doc = {
-            "timestamp": datetime.utcnow(),
-            "node_id": NODE_ID,
-            "machinecode": machinecode,
-            "defectcode": "d3",
-            "source": "CAM",
-            "raw_image": ai_data.get("image_bytes")
-        }
-        await db_production["defect_records"].insert_one(defect_doc)
-        await update_current_production_stats(machinecode, do_publish=False)
+        await _save_camera_defect(machinecode, "d3", ai_data, defect_ts)
         return True
     
     print(f">>> [AI] OK: Số lượng {count} đạt yêu cầu.")
@@ -74,6 +103,7 @@ async def process_and_save_hmi_defect(hmi_data):
             "source": "HMI"
         }
         await db_production["defect_records"].insert_one(defect_doc)
+        get_live_kpi().on_defect(machinecode, defect_doc["timestamp"])
         print(f">>> [DB] Đã lưu Defect từ HMI: {defectcode} cho {machinecode}")
         await update_current_production_stats(machinecode, do_publish=False)
         return True
@@ -81,59 +111,6 @@ async def process_and_save_hmi_defect(hmi_data):
         print(f">>> [DB ERROR] Lưu HMI Defect thất bại: {e}")
         return False
 
-async def process_and_save_counter(counter_msg):
-    """
-    Standard Payload: { "machinecode": "m002", "timestamp": "...", "shootcountnumber": 1439 }
-    """
-    if not counter_msg:
-        return False
-
-    try:
-        machinecode = str(counter_msg.get("machinecode", "")).strip()
-        raw_value = counter_msg.get("shootcountnumber", 0)
-        now = datetime.utcnow()
-        
-        if not machinecode:
-            print(f">>> [PROCESSOR ERROR] Counter thiếu machinecode: {counter_msg}")
-            return False
-        
-        # 0. Nếu đang có downtime active thì đóng lại
-        await close_active_downtime(machinecode)
-
-        # 1. Tìm bản ghi gần nhất để tính actual_cycle_time
-        actual_cycle_time = 0.0
-        last_record = await db_production["iot_records"].find_one(
-            {"machinecode": machinecode},
-            sort=[("timestamp", -1)]
-        )
-        
-        if last_record and "timestamp" in last_record:
-            prev_ts = last_record["timestamp"]
-            diff = (now - prev_ts).total_seconds()
-            actual_cycle_time = round(diff, 2)
-            
-        # 2. Lưu IoT record
-        record = {
-            "timestamp": now,
-            "machinecode": machinecode,
-            "data": {
-                "raw_value": raw_value,
-                "actual_cycle_time": actual_cycle_time
-            }
-        }
-        await db_production["iot_records"].insert_one(record)
-        print(f">>> [DB] Saved IoTRecord for {machinecode}: val={raw_value}, cycle={actual_cycle_time}s")
-        
-        # 3. Cập nhật OEE/KPI
-        await update_current_production_stats(machinecode, do_publish=False)
-        
-
-            
-        return True
-    except Exception as e:
-        print(f">>> [DB ERROR] IoTRecord save failed: {e}")
-        return False
-
 async def process_hmi_changeover(data):
     """
     Standard Payload: { "machinecode": "m002", "product": "pd002", "oldproduct": "pd001" }
@@ -195,10 +172,7 @@ async def process_hmi_downtime_reason(data):
             print(f">>> [PROCESSOR ERROR] Downtime Reason thiếu thông tin: {data}")
             return False
 
-        db_master = get_database()
-        master_entry = await db_master["downtime"].find_one({
-            "downtimecode": {"$regex": f"^{downtime_code}$", "$options": "i"}
-        })
+        master_entry = await get_master_cache().downtime(downtime_code)
         
         if not master_entry:
             print(f">>> [DOWNTIME ERROR] Mã lỗi '{downtime_code}' không tồn tại trong danh mục 'downtime'")
@@ -235,6 +209,7 @@ async def process_hmi_downtime_reason(data):
                 "duration": target.get("duration_seconds", 0)
             })
             
+            get_downtime_monitor().on_reason(machinecode or target.get("machinecode"), target["_id"], downtime_code)
             await update_current_production_stats(machinecode or target.get("machinecode"), do_publish=False)
             return True
         return False
@@ -242,24 +217,42 @@ async def process_hmi_downtime_reason(data):
         print(f">>> [DOWNTIME ERROR] Lỗi update lý do: {e}")
         return False
 
+def _snapshot_options(data):
+    """Tùy chọn nén/chia phần của request danh mục, mặc định theo config."""
+    compress = data.get("compress", MASTER_SNAPSHOT_COMPRESS)
+    if isinstance(compress, str):
+        compress = compress.lower().strip() in ("1", "true", "zlib")
+    try:
+        chunk_size = max(0, int(data.get("chunksize", MASTER_SNAPSHOT_CHUNK_SIZE) or 0))
+    except (TypeError, ValueError):
+        chunk_size = MASTER_SNAPSHOT_CHUNK_SIZE
+    return bool(compress), chunk_size
+
+async def _publish_snapshot(topic, collection, data, items_key=None, extra=()):
+    """Trả danh mục từ snapshot trong bộ nhớ (payload đã encode sẵn), không truy vấn Mongo."""
+    cache = get_master_cache()
+    snapshot = await cache.get(collection)
+    compress, chunk_size = _snapshot_options(data)
+    payloads = snapshot.response(cache.codec_for(topic), items_key=items_key, extra=extra, compress=compress, chunk_size=chunk_size)
+    for payload in payloads:
+        mqtt_publish(topic, payload)
+    return snapshot
+
 async def process_get_defect_master(data):
     """
     Standard Payload: { "machinecode": "m001" }
+    Tùy chọn: "compress": true (nén zlib), "chunksize": N (chia thành nhiều message)
     """
     try:
         machinecode = str(data.get("machinecode", "Unknown")).strip()
         print(f">>> [PROCESSOR] Nhận yêu cầu defect master cho máy: {machinecode}")
         
-        db_master = get_database()
-        # Lấy tất cả defect từ bảng 'defect'
-        defects = await db_master["defect"].find({}, {"_id": 0}).to_list(None)
-        
-        mqtt_publish("topic/get/defectmaster/res", {
-            "machinecode": machinecode,
-            "defects": defects,
-            "timestamp": datetime.utcnow()
-        })
-        print(f">>> [DB] Đã gửi {len(defects)} defect records cho {machinecode}")
+        snapshot = await _publish_snapshot(
+            "topic/get/defectmaster/res", "defect", data,
+            items_key="defects",
+            extra=[("machinecode", machinecode), ("timestamp", datetime.utcnow())],
+        )
+        print(f">>> [DB] Đã gửi {len(snapshot.docs)} defect records cho {machinecode}")
         return True
     except Exception as e:
         print(f">>> [ERROR] Lỗi lấy defect master: {e}")
@@ -275,13 +268,9 @@ async def process_get_product_master(data):
         print(f">>> [PROCESSOR] Nhận yêu cầu product master cho máy: {machinecode} (type={req_type})")
         
         if req_type == "changover":
-            db_master = get_database()
-            # Lấy tất cả product từ bảng 'product'
-            products = await db_master["product"].find({}, {"_id": 0}).to_list(None)
-            
             # Publish kết quả trả về topic/get/productcode/res khi nhận request là "changover"
-            mqtt_publish("topic/get/productcode/res", products)
-            print(f">>> [DB] Đã gửi {len(products)} product records cho {machinecode}")
+            snapshot = await _publish_snapshot("topic/get/productcode/res", "product", data)
+            print(f">>> [DB] Đã gửi {len(snapshot.docs)} product records cho {machinecode}")
             return True
         else:
             print(f">>> [PROCESSOR] Bỏ qua yêu cầu product master không hợp lệ: {req_type}")
@@ -346,15 +335,10 @@ async def process_get_downtime_master(data):
             return False
 
         print(f">>> [PROCESSOR] Nhận yêu cầu fetch downtime master")
-        from app.storage.db import get_database
-        db_master = get_database()
-        
-        # Lấy tất cả bản ghi từ bảng downtime (Master)
-        downtime_masters = await db_master["downtime"].find({}, {"_id": 0}).to_list(None)
         
         # Publish kết quả xuống topic/get/downtimecode/res
-        mqtt_publish("topic/get/downtimecode/res", downtime_masters)
-        print(f">>> [DB] Đã gửi {len(downtime_masters)} bản ghi downtime master")
+        snapshot = await _publish_snapshot("topic/get/downtimecode/res", "downtime", data)
+        print(f">>> [DB] Đã gửi {len(snapshot.docs)} bản ghi downtime master")
         return True
     except Exception as e:
         print(f">>> [ERROR] Lỗi process_get_downtime_master: {e}")
@@ -375,10 +359,7 @@ async def process_update_downtime_reason(data):
             return False
 
         # 1. Tìm thông tin trong master
-        db_master = get_database()
-        master_entry = await db_master["downtime"].find_one({
-            "downtimecode": {"$regex": f"^{downtime_code}$", "$options": "i"}
-        })
+        master_entry = await get_master_cache().downtime(downtime_code)
         
         if master_entry:
             downtime_code = master_entry.get("downtimecode")
@@ -413,6 +394,7 @@ async def process_update_downtime_reason(data):
             })
             
             if m_code:
+                get_downtime_monitor().on_reason(m_code, target["_id"], downtime_code)
                 await update_current_production_stats(m_code, do_publish=False)
             return True
         else:
@@ -0,0 +1,144 @@
+import asyncio
+import heapq
+import itertools
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.engine.shift_calendar import SHIFT_CHANGE, BREAK_START, BREAK_END, get_shift_calendar
+
+CATCH_UP = "catch_up"          # lúc khởi động: xử lý các mốc đã lỡ khi hệ thống tắt
+AUTO_RECORD = "auto_record"    # đảm bảo mỗi máy có bản ghi trong ca
+CALENDAR_REFRESH = "calendar_refresh"  # nội bộ: nạp thêm mốc khi sắp hết khoảng lịch đã biên dịch
+
+CALENDAR_KINDS = (SHIFT_CHANGE, BREAK_START, BREAK_END)
+
+Event = Tuple[datetime, str, Optional[str]]  # (thời điểm UTC, loại, shiftcode)
+Handler = Callable[[Event], Awaitable[None]]
+
+class ShiftScheduler:
+    """
+    Bộ hẹn giờ (timer heap) cho các mốc của lịch ca thay cho polling ca hiện tại mỗi 5s.
+    - Các mốc đổi ca / bắt đầu-kết thúc giờ nghỉ lấy từ `ShiftCalendar`, được xếp vào một heap và
+      gọi handler đúng thời điểm (một task duy nhất ngủ tới mốc gần nhất).
+    - Sau mỗi lần đổi ca (và khi danh mục máy đổi), sự kiện `auto_record` được phát ngay sau `shift_change`.
+    - Khi master data `shift` đổi: xóa các mốc cũ, nạp lại từ lịch mới; nếu ca hiện tại khác ca đang
+      theo dõi thì phát `shift_change` ngay.
+    - Lúc khởi động phát `catch_up` (xử lý bản ghi của ca đã kết thúc trong lúc tắt) rồi `auto_record`.
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[datetime, int, str, Optional[str]]] = []
+        self._seq = itertools.count()
+        self._handlers: Dict[str, List[Handler]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.current_shift: Optional[str] = None
+        self._counters = {"scheduled": 0, "fired": 0, "errors": 0, "resyncs": 0}
+        self._max_lateness = 0.0
+
+    def on(self, kind: str, handler: Handler):
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def schedule(self, when: datetime, kind: str, shiftcode: Optional[str] = None):
+        heapq.heappush(self._heap, (when, next(self._seq), kind, shiftcode))
+        self._counters["scheduled"] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _clear(self, kinds):
+        self._heap = [item for item in self._heap if item[2] not in kinds]
+        heapq.heapify(self._heap)
+
+    async def sync(self):
+        """Nạp (lại) các mốc từ lịch ca, từ hiện tại tới gần hết khoảng đã biên dịch."""
+        now = datetime.utcnow()
+        calendar = await get_shift_calendar(now)
+        self._clear(CALENDAR_KINDS + (CALENDAR_REFRESH,))
+        refresh_at = calendar.valid_to - timedelta(days=1)
+        for when, kind, shiftcode in calendar.events_between(now, refresh_at):
+            self.schedule(when, kind, shiftcode)
+            if kind == SHIFT_CHANGE:
+                self.schedule(when, AUTO_RECORD, shiftcode)
+        self.schedule(refresh_at, CALENDAR_REFRESH)
+        self._counters["resyncs"] += 1
+
+        current = calendar.shift_at(now)["shiftcode"]
+        if self.current_shift is not None and current != self.current_shift:
+            # Lịch ca đổi làm ca hiện tại đổi ngay lập tức
+            self.schedule(now, SHIFT_CHANGE, current)
+            self.schedule(now, AUTO_RECORD, current)
+        elif self.current_shift is None:
+            self.current_shift = current
+        nxt = calendar.next_boundary(now, [SHIFT_CHANGE])
+        print(f">>> [SCHEDULER] Ca hiện tại {current}, đổi ca kế tiếp: {nxt[0] if nxt else 'N/A'} ({len(self._heap)} mốc đã hẹn)")
+
+    def on_master_change(self, collection: str):
+        """Listener của master cache: lịch ca đổi thì hẹn lại các mốc; danh mục máy đổi thì kiểm tra bản ghi."""
+        if self._loop is None:
+            return
+        if collection == "shift":
+            self._loop.create_task(self.sync())
+        elif collection == "machine":
+            self.schedule(datetime.utcnow(), AUTO_RECORD, self.current_shift)
+
+    async def _dispatch(self, event: Event):
+        when, kind, shiftcode = event
+        if kind == CALENDAR_REFRESH:
+            await self.sync()
+            return
+        if kind == SHIFT_CHANGE:
+            print(f">>> [SHIFT] Đổi ca: {self.current_shift} -> {shiftcode} lúc {when}")
+            self.current_shift = shiftcode
+        self._counters["fired"] += 1
+        for handler in self._handlers.get(kind, []):
+            try:
+                await handler(event)
+            except Exception as e:
+                self._counters["errors"] += 1
+                print(f">>> [SCHEDULER ERROR] Lỗi xử lý sự kiện {kind}: {e}")
+
+    async def _run(self):
+        while True:
+            timeout = None
+            if self._heap:
+                timeout = (self._heap[0][0] - datetime.utcnow()).total_seconds()
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            when, _, kind, shiftcode = heapq.heappop(self._heap)
+            self._max_lateness = max(self._max_lateness, (datetime.utcnow() - when).total_seconds())
+            try:
+                await self._dispatch((when, kind, shiftcode))
+            except Exception as e:
+                self._counters["errors"] += 1
+                print(f">>> [SCHEDULER ERROR] Lỗi sự kiện {kind}: {e}")
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        await self.sync()
+        # Chạy trước mọi mốc khác trong heap
+        now = datetime.utcnow()
+        self.schedule(now, CATCH_UP, self.current_shift)
+        self.schedule(now, AUTO_RECORD, self.current_shift)
+        self._task = self._loop.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        upcoming = heapq.nsmallest(3, self._heap)
+        return {
+            "current_shift": self.current_shift,
+            "pending": len(self._heap),
+            "next": [{"at": when, "kind": kind, "shiftcode": code} for when, _, kind, code in upcoming],
+            **self._counters,
+            "max_lateness_ms": round(self._max_lateness * 1000, 1),
+        }
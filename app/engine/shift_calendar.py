@@ -0,0 +1,176 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional, Tuple
+
+from app.config import SHIFT_CALENDAR_DAYS
+from app.storage.master_cache import get_master_cache
+
+# Lịch ca biên dịch sẵn: các khoảng ca (kể cả ca qua đêm, giờ nghỉ) của nhiều ngày quanh thời điểm hiện tại,
+# đã đổi sang UTC. "Ca tại thời điểm T" là một lần bisect, lịch chỉ dựng lại khi master data `shift` đổi
+# hoặc T ra ngoài khoảng đã biên dịch.
+
+SHIFT_CHANGE = "shift_change"
+BREAK_START = "break_start"
+BREAK_END = "break_end"
+
+DEFAULT_SHIFT = {"shiftcode": "SHIFT_01", "_start_sec": 21600, "_end_sec": 50400}
+
+def _to_sec(val) -> int:
+    if isinstance(val, (int, float)): return int(val)
+    if isinstance(val, datetime): return val.hour * 3600 + val.minute * 60 + val.second
+    return 0
+
+def _local_to_utc(local_dt: datetime) -> datetime:
+    # datetime naive được hiểu là giờ địa phương (xử lý cả DST)
+    return local_dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+def _utc_to_local(utc_dt: datetime) -> datetime:
+    return utc_dt.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+class ShiftOccurrence:
+    """Một lần diễn ra của ca (giờ UTC), cùng dạng với kết quả `get_current_shift()` trước đây."""
+
+    __slots__ = ("shiftcode", "startshift", "endshift", "breakstart", "breakend", "priority")
+
+    def __init__(self, shiftcode, startshift, endshift, breakstart=None, breakend=None, priority=0):
+        self.shiftcode = shiftcode
+        self.startshift = startshift
+        self.endshift = endshift
+        self.breakstart = breakstart
+        self.breakend = breakend
+        self.priority = priority
+
+    def as_dict(self) -> dict:
+        return {
+            "shiftcode": self.shiftcode,
+            "startshift": self.startshift, "endshift": self.endshift,
+            "breakstart": self.breakstart, "breakend": self.breakend
+        }
+
+class ShiftCalendar:
+    """
+    Lịch ca đã biên dịch cho các ngày địa phương [around - days, around + days].
+    - Mỗi ca có khoảng phủ [start, end + 1s) theo giờ địa phương (giờ kết thúc tính cả giây cuối như trước),
+      ca qua đêm kéo sang ngày hôm sau. Khi các ca chồng nhau, ca đứng trước trong master data được ưu tiên.
+    - Khoảng không thuộc ca nào trả về ca mặc định `SHIFT_01` (06:00-14:00 của ngày đó) như trước.
+    - `shift_at(T)`: bisect trên các đoạn liên tiếp không chồng nhau.
+    - `events`: các mốc đổi ca (khi mã ca đổi) và bắt đầu/kết thúc giờ nghỉ, sắp theo thời gian.
+    """
+
+    def __init__(self, shifts: Iterable[dict], around: datetime, days: int = 3, version: Optional[str] = None):
+        self.version = version
+        self.days = days
+        self.shifts = [dict(s) for s in shifts]
+        local_day = _utc_to_local(around).replace(hour=0, minute=0, second=0, microsecond=0)
+        self.valid_from = _local_to_utc(local_day - timedelta(days=days))
+        self.valid_to = _local_to_utc(local_day + timedelta(days=days))
+        self.built_at = datetime.utcnow()
+
+        # 1. Các lần diễn ra của từng ca (thêm một ngày trước để phủ ca qua đêm)
+        covers: List[Tuple[datetime, datetime, ShiftOccurrence]] = []
+        for offset in range(-days - 1, days + 1):
+            anchor = local_day + timedelta(days=offset)
+            for priority, s in enumerate(self.shifts):
+                covers.append(self._occurrence(s, anchor, priority))
+
+        # 2. Tách thành các đoạn không chồng nhau, mỗi đoạn thuộc ca có ưu tiên cao nhất phủ nó
+        points = sorted({p for start, end, _ in covers for p in (start, end)} | {self.valid_from, self.valid_to})
+        points = [p for p in points if self.valid_from <= p <= self.valid_to]
+        segments: List[Tuple[datetime, datetime, Optional[ShiftOccurrence]]] = []
+        for seg_start, seg_end in zip(points, points[1:]):
+            owner = None
+            for start, end, occ in covers:
+                if start <= seg_start and seg_end <= end and (owner is None or occ.priority < owner.priority):
+                    owner = occ
+            if segments and segments[-1][2] is owner:
+                segments[-1] = (segments[-1][0], seg_end, owner)
+            else:
+                segments.append((seg_start, seg_end, owner))
+        self._segments = segments
+        self._starts = [seg[0] for seg in segments]
+
+        # 3. Các mốc sự kiện
+        events = []
+        previous_code = None
+        for index, (seg_start, _, occ) in enumerate(segments):
+            code = occ.shiftcode if occ else DEFAULT_SHIFT["shiftcode"]
+            if index and code != previous_code:
+                events.append((seg_start, SHIFT_CHANGE, code))
+            previous_code = code
+        seen = set()
+        for _, _, occ in segments:
+            if occ is None or id(occ) in seen or occ.breakstart is None:
+                continue
+            seen.add(id(occ))
+            events.append((occ.breakstart, BREAK_START, occ.shiftcode))
+            events.append((occ.breakend, BREAK_END, occ.shiftcode))
+        self.events = sorted(e for e in events if self.valid_from <= e[0] < self.valid_to)
+        self._event_times = [e[0] for e in self.events]
+
+    @staticmethod
+    def _occurrence(s: dict, anchor: datetime, priority: int) -> Tuple[datetime, datetime, ShiftOccurrence]:
+        """Khoảng phủ (UTC) và thông tin ca `s` bắt đầu trong ngày địa phương `anchor`."""
+        s_start, s_end = _to_sec(s.get("shiftstarttime")), _to_sec(s.get("shiftendtime"))
+        overnight = s_start > s_end
+        start_dt = anchor + timedelta(seconds=s_start)
+        end_dt = anchor + timedelta(days=1 if overnight else 0, seconds=s_end)
+
+        breakstart_dt = breakend_dt = None
+        break_info = s.get("breaktime") or {}
+        b_start_sec, b_end_sec = break_info.get("breakstart"), break_info.get("breakend")
+        if b_start_sec is not None and b_end_sec is not None:
+            # Ca qua đêm: giờ nghỉ trước giờ bắt đầu ca thuộc ngày hôm sau
+            day_shift = timedelta(days=1) if overnight and b_start_sec < s_start else timedelta(0)
+            breakstart_dt = _local_to_utc(anchor + timedelta(seconds=b_start_sec) + day_shift)
+            breakend_dt = _local_to_utc(anchor + timedelta(seconds=b_end_sec) + day_shift)
+
+        occ = ShiftOccurrence(
+            s.get("shiftcode"), _local_to_utc(start_dt), _local_to_utc(end_dt),
+            breakstart_dt, breakend_dt, priority
+        )
+        return occ.startshift, _local_to_utc(end_dt + timedelta(seconds=1)), occ
+
+    def covers(self, at: datetime, margin: timedelta = timedelta(days=1)) -> bool:
+        return self.valid_from <= at < self.valid_to - margin
+
+    def shift_at(self, at: datetime) -> dict:
+        """Ca tại thời điểm `at` (UTC naive)."""
+        index = bisect_right(self._starts, at) - 1
+        occ = self._segments[index][2] if 0 <= index < len(self._segments) and at < self._segments[index][1] else None
+        if occ is not None:
+            return occ.as_dict()
+        local_day = _utc_to_local(at).replace(hour=0, minute=0, second=0, microsecond=0)
+        return {
+            "shiftcode": DEFAULT_SHIFT["shiftcode"],
+            "startshift": _local_to_utc(local_day + timedelta(seconds=DEFAULT_SHIFT["_start_sec"])),
+            "endshift": _local_to_utc(local_day + timedelta(seconds=DEFAULT_SHIFT["_end_sec"])),
+            "breakstart": None, "breakend": None
+        }
+
+    def next_boundary(self, after: datetime, kinds: Optional[Iterable[str]] = None) -> Optional[Tuple[datetime, str, str]]:
+        """Mốc kế tiếp sau `after`: `(thời điểm UTC, loại, shiftcode)`; None nếu không có trong lịch."""
+        kinds = set(kinds) if kinds else None
+        for event in self.events[bisect_right(self._event_times, after):]:
+            if kinds is None or event[1] in kinds:
+                return event
+        return None
+
+    def events_between(self, start: datetime, end: datetime) -> List[Tuple[datetime, str, str]]:
+        """Các mốc trong khoảng (start, end]."""
+        return self.events[bisect_right(self._event_times, start):bisect_right(self._event_times, end)]
+
+_calendar: Optional[ShiftCalendar] = None
+
+async def get_shift_calendar(at: Optional[datetime] = None) -> ShiftCalendar:
+    """
+    Lịch ca hiện hành. Được dựng lại khi snapshot `shift` trong master cache đổi phiên bản
+    hoặc `at` ra ngoài khoảng đã biên dịch.
+    """
+    global _calendar
+    at = at or datetime.utcnow()
+    snapshot = await get_master_cache().get("shift")
+    calendar = _calendar
+    if calendar is None or calendar.version != snapshot.version or not calendar.covers(at):
+        calendar = _calendar = ShiftCalendar(snapshot.docs, at, SHIFT_CALENDAR_DAYS, snapshot.version)
+        print(f">>> [SHIFT] Biên dịch lịch ca ({len(snapshot.docs)} ca, {len(calendar.events)} mốc, version {snapshot.version})")
+    return calendar
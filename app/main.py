@@ -1,5 +1,6 @@
 import os
 import sys
+import time
 import asyncio
 from typing import Optional
 from fastapi import FastAPI, Request
@@ -12,30 +13,52 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 os.environ["TORCH_NNPACK"] = "0"
 os.environ["TORCH_CPP_LOG_LEVEL"] = "ERROR"
 
-from app.config import MODEL_PATH, RTSP_URL, MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS
-from app.drivers.camera import CameraSystem
+from app.config import (
+    MODEL_PATH, CAMERAS, MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS,
+    MQTT_IO_MODE, MQTT_ROUTE_CONCURRENCY, MQTT_ROUTE_QUEUE_SIZE, MQTT_TOPIC_CONCURRENCY,
+    MQTT_DEFAULT_CODEC, MQTT_TOPIC_CODECS,
+    OUTBOX_MEMORY_SIZE, OUTBOX_SPOOL_PATH, OUTBOX_SPOOL_MAX_MB, OUTBOX_MAX_INFLIGHT, OUTBOX_COALESCE_TOPICS,
+    COUNTER_FLUSH_INTERVAL_MS, COUNTER_BATCH_SIZE, KPI_UPDATE_INTERVAL_MS,
+    KPI_PUBLISH_MODE, KPI_KEYFRAME_INTERVAL_S, KPI_RETAINED_PREFIX,
+    KPI_PUBLISH_INTERVAL_S, KPI_REFRESH_CONCURRENCY,
+    INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE, INFERENCE_QUEUE_POLICY, INFERENCE_BATCH_SIZE,
+    INFERENCE_BACKEND, INFERENCE_IMGSZ, INFERENCE_WARMUP_RUNS, MODEL_CACHE_DIR, MODEL_INT8_DATA,
+    INFERENCE_RESULT_CACHE_SIZE, INFERENCE_SAMPLE_EVERY_N, INFERENCE_DIFF_THRESHOLD,
+    ANNOTATION_WORKERS, ANNOTATION_JPEG_QUALITY, ANNOTATION_MAX_WIDTH, THUMBNAIL_WIDTH,
+    FRAME_BUFFER_DEPTH, FRAME_PULSE_OFFSET_MS, FRAME_MATCH_TOLERANCE_MS, FRAME_WAIT_TIMEOUT_MS,
+    CAMERA_DECODE_MODE, CAMERA_IDLE_URLS, CAMERA_IDLE_AFTER_S, CAMERA_PREPROCESS,
+    CAMERA_STALL_TIMEOUT_S, CAMERA_MAX_READ_FAILURES, CAMERA_RECONNECT_BACKOFF_S,
+    CAMERA_OPEN_TIMEOUT_MS, CAMERA_READ_TIMEOUT_MS, CAMERA_MAX_FRAME_AGE_MS, CAMERA_STALE_POLICY
+)
+from app.drivers.camera import CameraSystem, configure_annotation
 from app.drivers.mqtt import (
-    CounterService, 
-    HMIDefectService, 
-    HMIChangeoverService,
-    DefectMasterService,
-    HMIDowntimeService, ProductionRecordService,
-    ProductMasterService, HMIGetDowntimeService,
-    HMIGetDowntimeMasterService, HMIDowntimeUpdateService
+    MQTTRouter,
+    TOPIC_COUNTER, TOPIC_HMI_DEFECT, TOPIC_CHANGEOVER, TOPIC_DOWNTIME_INPUT,
+    TOPIC_GET_DEFECT_MASTER, TOPIC_GET_PRODUCT_MASTER, TOPIC_GET_DOWNTIME,
+    TOPIC_GET_DOWNTIME_MASTER, TOPIC_DOWNTIME_UPDATE, TOPIC_PRODUCTION_RECORD
 )
 from app.storage.db import ensure_timeseries
+from app.storage.images import get_image_store
+from app.storage.master_cache import get_master_cache
+from app.storage.pulse_cache import get_last_pulse_cache
 from app.engine.logic import (
-    get_current_shift_code, 
     get_current_shift,
-    check_and_create_downtime, 
-    update_current_production_stats,
     finalize_production_record_on_shift_change,
-    initialize_production_record, ensure_active_production_records
+    initialize_production_record, ensure_active_production_records,
+    refresh_running_kpis,
+    close_active_downtime
 )
-from app.utils.messaging import set_mqtt_publish_func, mqtt_publish
+from app.utils.messaging import set_mqtt_publish_func
+from app.utils.codec import TopicCodecs
+from app.engine.inference import InferenceExecutor
+from app.engine.ingestion import CounterIngestor
+from app.engine.kpi_publisher import KPIPublisher
+from app.engine.live_kpi import get_live_kpi
+from app.engine.downtime import get_downtime_monitor
+from app.engine.shift_calendar import SHIFT_CHANGE, BREAK_START, BREAK_END
+from app.engine.scheduler import ShiftScheduler, CATCH_UP, AUTO_RECORD
 from app.engine.processor import (
     process_and_save_defect, 
-    process_and_save_counter, 
     process_and_save_hmi_defect,
     process_hmi_changeover,
     process_get_defect_master,
@@ -43,7 +66,8 @@ from app.engine.processor import (
     process_get_product_master,
     process_get_downtime_request,
     process_get_downtime_master,
-    process_update_downtime_reason
+    process_update_downtime_reason,
+    classify_camera_defect
 )
 
 app = FastAPI(title="Edge IoT AI Backend")
@@ -52,120 +76,132 @@ app = FastAPI(title="Edge IoT AI Backend")
 
 state = {
     "camera_sys": None,
-    "counter_service": None,
-    "hmi_service": None,
-    "changeover_service": None,
-    "downtime_service": None,
-    "defect_master_service": None,
-    "production_service": None,
-    "product_master_service": None,
-    "get_downtime_service": None,
-    "get_downtime_master_service": None,
-    "update_downtime_service": None,
+    "inference": None,
+    "ingestor": None,
+    "live_kpi": None,
+    "downtime": None,
+    "kpi_publisher": None,
+    "mqtt": None,
+    "master_cache": None,
+    "last_pulse": None,
+    "scheduler": None,
     "loop": None
 }
 
 # --- CALLBACKS ---
-
-def counter_callback(data):
-    try:
-        if not data or not isinstance(data, dict): return
-        machine_code = data.get("machinecode") or data.get("device")
-        if machine_code:
-            print(f">>> [MQTT] Nhận dữ liệu counter từ {machine_code}")
-            asyncio.run_coroutine_threadsafe(process_and_save_counter(data), state["loop"])
-            if state["camera_sys"]:
-                print(f">>> [AI] Kích hoạt camera cho {machine_code}...")
-                ai_res = state["camera_sys"].capture_and_detect()
-                if ai_res:
-                    asyncio.run_coroutine_threadsafe(process_and_save_defect(ai_res, machinecode=machine_code), state["loop"])
-    except Exception as e:
-        print(f">>> [ERROR] Lỗi counter_callback: {e}")
-
-def hmi_callback(data):
+# Handler chạy trực tiếp trên event loop (qua hàng đợi giới hạn của từng topic trong MQTTRouter)
+
+async def counter_callback(data, received_at):
+    if not data or not isinstance(data, dict): return
+    machine_code = data.get("machinecode") or data.get("device")
+    if machine_code:
+        print(f">>> [MQTT] Nhận dữ liệu counter từ {machine_code}")
+        if state["inference"]:
+            # Chỉ xếp job vào hàng đợi theo thời điểm nhận pulse, không chạy YOLO trên event loop
+            print(f">>> [AI] Kích hoạt camera cho {machine_code}...")
+            state["inference"].submit(machine_code, received_at)
+        state["ingestor"].submit(data, received_at)
+
+async def hmi_callback(data):
     if data: 
         print(f">>> [MQTT] Nhận dữ liệu Defect từ HMI: {data}")
-        asyncio.run_coroutine_threadsafe(process_and_save_hmi_defect(data), state["loop"])
+        await process_and_save_hmi_defect(data)
 
-def changeover_callback(data):
+async def changeover_callback(data):
     print(f">>> [MQTT] Nhận dữ liệu Changeover từ HMI: {data}")
-    if data: asyncio.run_coroutine_threadsafe(process_hmi_changeover(data), state["loop"])
+    if data: await process_hmi_changeover(data)
 
-def defect_master_callback(data):
+async def defect_master_callback(data):
     if data:
         print(f">>> [MQTT] Nhận yêu cầu Defect Master")
-        asyncio.run_coroutine_threadsafe(process_get_defect_master(data), state["loop"])
+        await process_get_defect_master(data)
 
-def downtime_callback(data):
-    if data: asyncio.run_coroutine_threadsafe(process_hmi_downtime_reason(data), state["loop"])
+async def downtime_callback(data):
+    if data: await process_hmi_downtime_reason(data)
 
-def product_master_callback(data):
+async def product_master_callback(data):
     if data:
         print(f">>> [MQTT] Nhận yêu cầu Product Master: {data}")
-        asyncio.run_coroutine_threadsafe(process_get_product_master(data), state["loop"])
+        await process_get_product_master(data)
 
-def get_downtime_callback(data):
+async def get_downtime_callback(data):
     if data:
         print(f">>> [MQTT] Nhận yêu cầu Get Downtime: {data}")
-        asyncio.run_coroutine_threadsafe(process_get_downtime_request(data), state["loop"])
+        await process_get_downtime_request(data)
 
-def get_downtime_master_callback(data):
+async def get_downtime_master_callback(data):
     if data:
         print(f">>> [MQTT] Nhận yêu cầu Get Downtime Master: {data}")
-        asyncio.run_coroutine_threadsafe(process_get_downtime_master(data), state["loop"])
+        await process_get_downtime_master(data)
 
-def update_downtime_callback(data):
+async def update_downtime_callback(data):
     if data:
         print(f">>> [MQTT] Nhận yêu cầu Update Downtime Reason: {data}")
-        asyncio.run_coroutine_threadsafe(process_update_downtime_reason(data), state["loop"])
+        await process_update_downtime_reason(data)
 
 # --- TASKS ---
 
 
 
-async def auto_record_ensurer_task():
-    """Task chạy ngầm: Tự động sinh bản ghi sản xuất mỗi 5 phút nếu chưa có trong ca."""
-    print(">>> [AUTO-RECORD] Đã kích hoạt task tự động kiểm tra bản ghi mỗi 5 phút.")
+async def auto_record_handler(event):
+    """Sự kiện `auto_record` (sau đổi ca, lúc khởi động, khi danh mục máy đổi): sinh bản ghi nếu máy chưa có trong ca."""
+    try:
+        await ensure_active_production_records()
+    except Exception as e:
+        print(f">>> [AUTO-RECORD ERROR] Lỗi ensure_active_production_records: {e}")
+
+async def image_retention_task():
+    """Task chạy ngầm: Xóa ảnh defect quá hạn lưu trữ mỗi 1 giờ."""
     while True:
         try:
-            await ensure_active_production_records()
+            removed = await get_image_store().purge_expired()
+            if removed:
+                print(f">>> [IMAGE STORE] Đã xóa {removed} ảnh defect quá hạn")
         except Exception as e:
-            print(f">>> [AUTO-RECORD ERROR] Lỗi trong loop auto_record_ensurer: {e}")
-        
-        await asyncio.sleep(300) # 5 phút
+            print(f">>> [IMAGE STORE ERROR] Lỗi dọn ảnh defect: {e}")
+
+        await asyncio.sleep(3600)
+
+publisher_stats = {"cycles": 0, "errors": 0, "overruns": 0, "machines": 0, "last_cycle_ms": 0.0, "max_cycle_ms": 0.0, "avg_cycle_ms": 0.0}
 
 async def production_record_publisher_task():
-    """Task chạy ngầm: Cập nhật KPI và Publish dữ liệu mỗi 1s."""
-    from app.storage.db import get_production_db
-    from app.engine.logic import get_current_shift_stats
-    db = get_production_db()
+    """Task chạy ngầm: Cập nhật KPI mỗi `KPI_PUBLISH_INTERVAL_S`, chỉ publish khi KPI/stats thay đổi (KPIPublisher)."""
+    total_ms = 0.0
+    published = set()
     while True:
+        started = time.perf_counter()
         try:
-            # 1. Cập nhật record đang chạy (vẫn cần để tính OEE cá nhân)
-            active_prods = await db.production_records.find({"status": "running"}).to_list(None)
-            for p in active_prods:
-                m_code = p["machinecode"]
-                await update_current_production_stats(m_code, do_publish=False) # Tắt publish record lẻ
-                
-                # 2. Lấy stats tổng hợp của cả ca và publish
-                shift_stats = await get_current_shift_stats(m_code)
-                if shift_stats:
-                    mqtt_publish("topic/get/productionrecord", shift_stats)
-                
-
+            # Cập nhật KPI bản ghi đang chạy và KPI ca của mọi máy trong một lượt (bulk_write), publish nếu có thay đổi
+            summaries = await refresh_running_kpis(KPI_REFRESH_CONCURRENCY)
+            for shift_stats in summaries:
+                state["kpi_publisher"].publish(shift_stats)
+            # Máy không còn bản ghi running: bỏ trạng thái đã publish, lần chạy lại gửi bản đầy đủ
+            running = {shift_stats["machinecode"] for shift_stats in summaries}
+            for m_code in published - running:
+                state["kpi_publisher"].forget(m_code)
+            published = running
+            publisher_stats["machines"] = len(summaries)
         except Exception as e:
+            publisher_stats["errors"] += 1
             print(f">>> [PUBLISHER ERROR] Lỗi trong loop publish production record: {e}")
-        
-        await asyncio.sleep(1.0)
 
-async def main_monitor_task():
-    """Task chạy ngầm: Giám sát đổi ca, Phát hiện downtime và Cập nhật KPI định kỳ."""
-    # Khởi tạo ca hiện tại
-    last_shift = await get_current_shift_code()
+        elapsed = time.perf_counter() - started
+        cycle_ms = elapsed * 1000
+        total_ms += cycle_ms
+        publisher_stats["cycles"] += 1
+        publisher_stats["last_cycle_ms"] = round(cycle_ms, 2)
+        publisher_stats["max_cycle_ms"] = round(max(publisher_stats["max_cycle_ms"], cycle_ms), 2)
+        publisher_stats["avg_cycle_ms"] = round(total_ms / publisher_stats["cycles"], 2)
+        if elapsed > KPI_PUBLISH_INTERVAL_S:
+            publisher_stats["overruns"] += 1
+            print(f">>> [PUBLISHER] Vòng cập nhật KPI mất {int(cycle_ms)}ms cho {publisher_stats['machines']} máy (vượt chu kỳ {KPI_PUBLISH_INTERVAL_S}s)")
+        await asyncio.sleep(max(0.0, KPI_PUBLISH_INTERVAL_S - elapsed))
+
+async def catch_up_handler(event):
+    """Sự kiện `catch_up` lúc khởi động: chốt bản ghi tồn đọng của ca đã kết thúc, dọn downtime 'ma'."""
+    _, _, last_shift = event
     now_utc = datetime.utcnow()
-    print(f">>> [MONITOR] Bắt đầu monitor task. Ca hiện tại: {last_shift}")
-    
-    # --- NEW: Kiểm tra và chốt bản ghi tồn đọng khi khởi động ---
+    print(f">>> [STARTUP] Ca hiện tại: {last_shift}")
     try:
         from app.storage.db import get_production_db
         db = get_production_db()
@@ -185,7 +221,7 @@ async def main_monitor_task():
             if p.get("shiftcode") != last_shift:
                 print(f">>> [STARTUP] Phát hiện bản ghi tồn đọng từ ca khác (Record: {p.get('shiftcode')} != Current: {last_shift}) cho máy {m_code}. Đang chốt...")
                 await finalize_production_record_on_shift_change(m_code, {}, now_utc, target_record_id=p.get("_id"))
-                # Không tự động mở ở đây, để ensure_active_production_records xử lý hoặc logic bên dưới
+                # Không tự động mở ở đây, sự kiện auto_record ngay sau sẽ xử lý
             else:
                 print(f">>> [STARTUP] Bản ghi máy {m_code} đang cùng ca {last_shift}. Giữ nguyên.")
                 # Nếu vẫn cùng ca, đảm bảo machinecode đã được strip trong DB
@@ -209,34 +245,55 @@ async def main_monitor_task():
     except Exception as e:
         print(f">>> [STARTUP ERROR] Lỗi dọn dẹp bản ghi: {e}")
 
-    while True:
-        try:
-            # 1. Kiểm tra đổi ca (logic chuyển giao bình thường)
-            current_shift = await get_current_shift_code()
-            if current_shift != last_shift:
-                print(f">>> [SHIFT] Phát hiện đổi ca: {last_shift} -> {current_shift}")
-                now_utc = datetime.utcnow()
-                
-                db = get_production_db()
-                active_prods = await db.production_records.find({"status": "running"}).to_list(None)
-                
-                for p in active_prods:
-                    m_code = p["machinecode"]
-                    p_code = p["productcode"]
-                    await finalize_production_record_on_shift_change(m_code, {}, now_utc)
-                    await initialize_production_record(m_code, p_code)
-                
-                last_shift = current_shift
-            
-            # 2. Kiểm tra downtime tự động (quá ngưỡng cấu hình)
-            await check_and_create_downtime()
-            
-            # 3. Cập nhật OEE/KPI đã được chuyển sang production_record_publisher_task (1s/lần)
-                
-        except Exception as e:
-            print(f">>> [MONITOR ERROR] Lỗi trong loop monitor: {e}")
-            
-        await asyncio.sleep(5)
+async def shift_change_handler(event):
+    """Sự kiện `shift_change` (đúng thời điểm hết ca theo lịch): chốt bản ghi ca cũ, mở bản ghi ca mới."""
+    from app.storage.db import get_production_db
+    now_utc = datetime.utcnow()
+    db = get_production_db()
+    active_prods = await db.production_records.find({"status": "running"}).to_list(None)
+    
+    for p in active_prods:
+        m_code = p["machinecode"]
+        p_code = p["productcode"]
+        await finalize_production_record_on_shift_change(m_code, {}, now_utc)
+        await initialize_production_record(m_code, p_code)
+
+async def break_handler(event):
+    when, kind, shiftcode = event
+    print(f">>> [SHIFT] {'Bắt đầu' if kind == BREAK_START else 'Kết thúc'} giờ nghỉ ca {shiftcode} ({when})")
+
+async def load_camera_preprocess(camera_sys):
+    """Nạp cấu hình ROI theo máy từ master data (`machine.cameraroi`), ưu tiên hơn config."""
+    try:
+        machines = await get_master_cache().machines()
+        for m in machines:
+            if "cameraroi" not in m:
+                continue
+            m_code = m.get("machinecode", "").strip()
+            if m_code:
+                camera_sys.set_preprocess(m_code, m.get("cameraroi"))
+                print(f">>> [CAMERA] Nạp ROI cho máy {m_code}: {m.get('cameraroi')}")
+    except Exception as e:
+        print(f">>> [CAMERA ERROR] Lỗi nạp ROI từ master data: {e}")
+
+# --- STATUS ---
+
+@app.get("/stats")
+async def get_stats():
+    """Thông số vận hành của các thành phần chạy ngầm."""
+    return {
+        "camera": state["camera_sys"].stats() if state["camera_sys"] else None,
+        "inference": state["inference"].stats() if state["inference"] else None,
+        "ingestion": state["ingestor"].stats() if state["ingestor"] else None,
+        "live_kpi": state["live_kpi"].stats() if state["live_kpi"] else None,
+        "downtime": state["downtime"].stats() if state["downtime"] else None,
+        "kpi_publish": state["kpi_publisher"].stats() if state["kpi_publisher"] else None,
+        "kpi_refresh": publisher_stats,
+        "mqtt": state["mqtt"].stats() if state["mqtt"] else None,
+        "master_cache": state["master_cache"].stats() if state["master_cache"] else None,
+        "last_pulse": state["last_pulse"].stats() if state["last_pulse"] else None,
+        "scheduler": state["scheduler"].stats() if state["scheduler"] else None
+    }
 
 # --- LIFECYCLE ---
 
@@ -247,48 +304,111 @@ async def startup():
     state["loop"] = asyncio.get_running_loop()
     
     try:
+        # Master data (danh mục HMI, workingparameter / product / machine / shift) nạp sẵn vào bộ nhớ
+        state["master_cache"] = get_master_cache()
+        await state["master_cache"].preload()
+        state["master_cache"].start()
+
         # Drivers
-        state["camera_sys"] = CameraSystem(RTSP_URL, MODEL_PATH)
-        state["counter_service"] = CounterService(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS)
-        state["hmi_service"] = HMIDefectService(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS)
-        state["changeover_service"] = HMIChangeoverService(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS)
-        state["downtime_service"] = HMIDowntimeService(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS)
-        state["defect_master_service"] = DefectMasterService(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS)
-        state["production_service"] = ProductionRecordService(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS)
-        state["product_master_service"] = ProductMasterService(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS)
-        state["get_downtime_service"] = HMIGetDowntimeService(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS)
-        state["get_downtime_master_service"] = HMIGetDowntimeMasterService(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS)
-        state["update_downtime_service"] = HMIDowntimeUpdateService(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS)
-
-        # Callbacks
-        state["counter_service"].set_callback(counter_callback)
-        state["hmi_service"].set_callback(hmi_callback)
-        state["changeover_service"].set_callback(changeover_callback)
-        state["downtime_service"].set_callback(downtime_callback)
-        state["defect_master_service"].set_callback(defect_master_callback)
-        state["product_master_service"].set_callback(product_master_callback)
-        state["get_downtime_service"].set_callback(get_downtime_callback)
-        state["get_downtime_master_service"].set_callback(get_downtime_master_callback)
-        state["update_downtime_service"].set_callback(update_downtime_callback)
-
-        # Start Services
-        state["counter_service"].start()
-        state["hmi_service"].start()
-        state["changeover_service"].start()
-        state["downtime_service"].start()
-        state["defect_master_service"].start()
-        state["production_service"].start()
-        state["product_master_service"].start()
-        state["get_downtime_service"].start()
-        state["get_downtime_master_service"].start()
-        state["update_downtime_service"].start()
-        
+        configure_annotation(ANNOTATION_WORKERS, ANNOTATION_JPEG_QUALITY, ANNOTATION_MAX_WIDTH, THUMBNAIL_WIDTH)
+        state["camera_sys"] = CameraSystem(
+            CAMERAS, MODEL_PATH, backend=INFERENCE_BACKEND, cache_dir=MODEL_CACHE_DIR,
+            imgsz=INFERENCE_IMGSZ, warmup_runs=INFERENCE_WARMUP_RUNS,
+            batch_size=INFERENCE_BATCH_SIZE, int8_data=MODEL_INT8_DATA,
+            stream_options={
+                "buffer_depth": FRAME_BUFFER_DEPTH,
+                "pulse_offset": FRAME_PULSE_OFFSET_MS / 1000.0,
+                "match_tolerance": FRAME_MATCH_TOLERANCE_MS / 1000.0,
+                "wait_timeout": FRAME_WAIT_TIMEOUT_MS / 1000.0,
+                "decode_mode": CAMERA_DECODE_MODE,
+                "idle_after": CAMERA_IDLE_AFTER_S,
+                "max_failures": CAMERA_MAX_READ_FAILURES,
+                "backoff": CAMERA_RECONNECT_BACKOFF_S,
+                "open_timeout_ms": CAMERA_OPEN_TIMEOUT_MS,
+                "read_timeout_ms": CAMERA_READ_TIMEOUT_MS
+            },
+            idle_urls=CAMERA_IDLE_URLS,
+            preprocess=CAMERA_PREPROCESS,
+            stall_timeout=CAMERA_STALL_TIMEOUT_S,
+            max_frame_age=CAMERA_MAX_FRAME_AGE_MS / 1000.0,
+            stale_policy=CAMERA_STALE_POLICY,
+            result_cache_size=INFERENCE_RESULT_CACHE_SIZE,
+            sample_every=INFERENCE_SAMPLE_EVERY_N,
+            diff_threshold=INFERENCE_DIFF_THRESHOLD
+        )
+        await load_camera_preprocess(state["camera_sys"])
+        state["inference"] = InferenceExecutor(
+            state["camera_sys"], state["loop"], process_and_save_defect,
+            workers=INFERENCE_WORKERS, max_queue=INFERENCE_QUEUE_SIZE, policy=INFERENCE_QUEUE_POLICY,
+            batch_size=INFERENCE_BATCH_SIZE,
+            # Chỉ giữ bản copy frame cho kết quả sẽ trở thành defect record
+            keep_frame=lambda res: classify_camera_defect(res["count"], res["ng_pill"]) is not None
+        )
+        # KPI bản ghi đang chạy cộng dồn trong bộ nhớ, đối chiếu định kỳ với DB
+        # Pulse gần nhất của từng máy (cycle time + phát hiện dừng), nạp một lần từ iot_records
+        state["last_pulse"] = get_last_pulse_cache()
+        await state["last_pulse"].seed()
+        state["live_kpi"] = get_live_kpi()
+        state["master_cache"].listeners.append(state["live_kpi"].on_master_change)
+        state["live_kpi"].start()
+        # Downtime theo sự kiện: hẹn giờ theo pulse thay cho polling
+        state["downtime"] = get_downtime_monitor()
+        state["master_cache"].listeners.append(state["downtime"].on_master_change)
+        await state["downtime"].start()
+        state["ingestor"] = CounterIngestor(
+            flush_interval=COUNTER_FLUSH_INTERVAL_MS / 1000.0, max_batch=COUNTER_BATCH_SIZE,
+            kpi_interval=KPI_UPDATE_INTERVAL_MS / 1000.0
+        )
+        state["ingestor"].start()
+        state["kpi_publisher"] = KPIPublisher(
+            TOPIC_PRODUCTION_RECORD, mode=KPI_PUBLISH_MODE,
+            keyframe_interval=KPI_KEYFRAME_INTERVAL_S, retained_prefix=KPI_RETAINED_PREFIX
+        )
+
+        # Một kết nối MQTT dùng chung, mỗi topic được chuyển tới callback tương ứng
+        state["mqtt"] = MQTTRouter(
+            MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASS, loop=state["loop"], io_mode=MQTT_IO_MODE,
+            concurrency=MQTT_ROUTE_CONCURRENCY, queue_size=MQTT_ROUTE_QUEUE_SIZE,
+            codecs=TopicCodecs(MQTT_TOPIC_CODECS, default=MQTT_DEFAULT_CODEC),
+            outbox={
+                "spool_path": OUTBOX_SPOOL_PATH,
+                "max_memory": OUTBOX_MEMORY_SIZE,
+                "max_spool_bytes": OUTBOX_SPOOL_MAX_MB * 1024 * 1024
+            },
+            coalesce_topics=OUTBOX_COALESCE_TOPICS, max_inflight=OUTBOX_MAX_INFLIGHT
+        )
+        # Payload danh mục encode theo codec của topic response
+        state["master_cache"].codec_for = state["mqtt"].codecs.codec_for
+
+        state["mqtt"].add_route(
+            TOPIC_COUNTER, counter_callback, "MQTT COUNTER",
+            concurrency=MQTT_TOPIC_CONCURRENCY.get(TOPIC_COUNTER), with_timestamp=True
+        )
+        state["mqtt"].add_route(TOPIC_HMI_DEFECT, hmi_callback, "MQTT HMI")
+        state["mqtt"].add_route(TOPIC_CHANGEOVER, changeover_callback, "MQTT CHANGEOVER")
+        state["mqtt"].add_route(TOPIC_DOWNTIME_INPUT, downtime_callback, "MQTT DOWNTIME")
+        state["mqtt"].add_route(TOPIC_GET_DEFECT_MASTER, defect_master_callback, "MQTT DEFECT MASTER")
+        state["mqtt"].add_route(TOPIC_GET_PRODUCT_MASTER, product_master_callback, "MQTT PRODUCT MASTER")
+        state["mqtt"].add_route(TOPIC_GET_DOWNTIME, get_downtime_callback, "MQTT GET DOWNTIME")
+        state["mqtt"].add_route(TOPIC_GET_DOWNTIME_MASTER, get_downtime_master_callback, "MQTT GET DOWNTIME MASTER")
+        state["mqtt"].add_route(TOPIC_DOWNTIME_UPDATE, update_downtime_callback, "MQTT DOWNTIME UPDATE")
+        state["mqtt"].start()
+
         # Thiết lập callback cho messaging util
-        set_mqtt_publish_func(state["production_service"].publish)
+        set_mqtt_publish_func(state["mqtt"].publish)
         
-        asyncio.create_task(auto_record_ensurer_task())
+        # Mốc ca (đổi ca, giờ nghỉ, đảm bảo bản ghi) theo hẹn giờ, thay cho polling
+        state["scheduler"] = ShiftScheduler()
+        state["scheduler"].on(CATCH_UP, catch_up_handler)
+        state["scheduler"].on(SHIFT_CHANGE, shift_change_handler)
+        state["scheduler"].on(AUTO_RECORD, auto_record_handler)
+        state["scheduler"].on(BREAK_START, break_handler)
+        state["scheduler"].on(BREAK_END, break_handler)
+        state["master_cache"].listeners.append(state["scheduler"].on_master_change)
+        await state["scheduler"].start()
+
+        asyncio.create_task(image_retention_task())
         asyncio.create_task(production_record_publisher_task())
-        asyncio.create_task(main_monitor_task())
         print("--- Hệ thống đã sẵn sàng ---")
     except Exception as e:
         print(f">>> [ERROR] Khởi động thất bại: {e}")
@@ -296,13 +416,12 @@ async def startup():
 @app.on_event("shutdown")
 async def shutdown():
     print("--- Đang dừng hệ thống ---")
-    if state["counter_service"]: state["counter_service"].stop()
-    if state["hmi_service"]: state["hmi_service"].stop()
-    if state["changeover_service"]: state["changeover_service"].stop()
-    if state["downtime_service"]: state["downtime_service"].stop()
-    if state["defect_master_service"]: state["defect_master_service"].stop()
-    if state["product_master_service"]: state["product_master_service"].stop()
-    if state["get_downtime_service"]: state["get_downtime_service"].stop()
-    if state["get_downtime_master_service"]: state["get_downtime_master_service"].stop()
-    if state["update_downtime_service"]: state["update_downtime_service"].stop()
+    # Dừng các nguồn phát message trước, MQTT router (outbox -> spool) dừng sau cùng
+    if state["scheduler"]: state["scheduler"].stop()
+    if state["inference"]: state["inference"].stop()
     if state["camera_sys"]: state["camera_sys"].stop()
+    if state["ingestor"]: await state["ingestor"].stop()
+    if state["downtime"]: state["downtime"].stop()
+    if state["live_kpi"]: state["live_kpi"].stop()
+    if state["master_cache"]: state["master_cache"].stop()
+    if state["mqtt"]: state["mqtt"].stop()
@@ -27,6 +27,9 @@ async def ensure_collections():
         if "shift_stats" not in existing_collections:
             await db_production.create_collection("shift_stats")
             print(">>> [DB] Đã tạo bảng shift_stats")
+
+        # Tra pulse gần nhất của máy (LastPulseCache) không phải quét toàn bộ lịch sử
+        await db_production.iot_records.create_index([("machinecode", 1), ("timestamp", -1)])
             
     except Exception as e:
         print(f">>> [DB ERROR] Lỗi khởi tạo collection: {e}")
@@ -0,0 +1,116 @@
+import os
+import time
+import asyncio
+import hashlib
+from datetime import datetime, timedelta
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from app.config import IMAGE_STORE, IMAGE_STORE_DIR, IMAGE_RETENTION_DAYS
+from app.storage.db import get_production_db
+
+# Lưu ảnh defect tách khỏi `defect_records`, định danh theo SHA-256 của nội dung.
+# Defect record chỉ giữ `image_ref` ({"store", "key", "size"}) và một thumbnail nhỏ.
+
+def content_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+class LocalImageStore:
+    """Lưu ảnh trên filesystem: {root}/{key[:2]}/{key[2:4]}/{key}.jpg"""
+    name = "local"
+
+    def __init__(self, root: str, retention_days: int = IMAGE_RETENTION_DAYS):
+        self.root = root
+        self.retention_days = retention_days
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], f"{key}.jpg")
+
+    def _write(self, data: bytes) -> dict:
+        key = content_key(data)
+        path = self._path(key)
+        if os.path.exists(path):
+            # Ảnh trùng nội dung: chỉ làm mới mtime để không bị retention xóa
+            os.utime(path, None)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return {"store": self.name, "key": key, "size": len(data)}
+
+    def _read(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _purge(self, cutoff: float) -> int:
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    async def put(self, data: bytes) -> dict:
+        return await asyncio.get_running_loop().run_in_executor(None, self._write, data)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await asyncio.get_running_loop().run_in_executor(None, self._read, key)
+
+    async def purge_expired(self) -> int:
+        cutoff = time.time() - self.retention_days * 86400
+        return await asyncio.get_running_loop().run_in_executor(None, self._purge, cutoff)
+
+class GridFSImageStore:
+    """Lưu ảnh trong GridFS của database `production` (bucket `defect_images`), filename = key."""
+    name = "gridfs"
+
+    def __init__(self, db, retention_days: int = IMAGE_RETENTION_DAYS, bucket_name: str = "defect_images"):
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket_name)
+        self.files = db[f"{bucket_name}.files"]
+        self.retention_days = retention_days
+
+    async def put(self, data: bytes) -> dict:
+        key = await asyncio.get_running_loop().run_in_executor(None, content_key, data)
+        existing = await self.files.find_one({"filename": key}, {"_id": 1})
+        if existing:
+            await self.files.update_one({"_id": existing["_id"]}, {"$set": {"metadata.lastused": datetime.utcnow()}})
+        else:
+            await self.bucket.upload_from_stream(key, data, metadata={"lastused": datetime.utcnow()})
+        return {"store": self.name, "key": key, "size": len(data)}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        try:
+            stream = await self.bucket.open_download_stream_by_name(key)
+            return await stream.read()
+        except Exception:
+            return None
+
+    async def purge_expired(self) -> int:
+        cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+        removed = 0
+        async for f in self.files.find({"metadata.lastused": {"$lt": cutoff}}, {"_id": 1}):
+            await self.bucket.delete(f["_id"])
+            removed += 1
+        return removed
+
+_image_store = None
+
+def get_image_store():
+    global _image_store
+    if _image_store is None:
+        if IMAGE_STORE == "gridfs":
+            _image_store = GridFSImageStore(get_production_db())
+        else:
+            _image_store = LocalImageStore(IMAGE_STORE_DIR)
+    return _image_store
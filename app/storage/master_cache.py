@@ -0,0 +1,259 @@
+import time
+import zlib
+import asyncio
+import hashlib
+from typing import Callable, Dict, List, Optional
+
+from app.config import MASTER_CACHE_CHECK_S, MASTER_CACHE_TTL_S
+from app.storage.db import get_database
+from app.utils.codec import JSON, encode, encode_object
+
+# Snapshot master data trong bộ nhớ: phục vụ các request danh mục của HMI và các tra cứu trên
+# đường xử lý sự kiện (workingparameter / product / machine / shift) mà không truy vấn Mongo.
+# Payload trả về được encode sẵn (theo codec của topic), chỉ encode lại khi dữ liệu thay đổi.
+
+SNAPSHOT_COLLECTIONS = {
+    "defect": {"_id": 0},
+    "product": {"_id": 0},
+    "downtime": {"_id": 0},
+    "workingparameter": {"_id": 0},
+    "machine": {"_id": 0},
+    "shift": {"_id": 0},
+}
+
+def normalize_code(code) -> str:
+    """Key tra cứu không phân biệt hoa thường và khoảng trắng hai đầu."""
+    return str(code or "").strip().casefold()
+
+class CollectionSnapshot:
+    """Toàn bộ document của một collection tại một phiên bản, kèm payload đã encode."""
+
+    def __init__(self, name: str, docs: List[dict], version: str):
+        self.name = name
+        self.docs = docs
+        self.version = version
+        self.loaded_at = time.time()
+        self._encoded: Dict[tuple, List[bytes]] = {}
+        self._indexes: Dict[str, tuple] = {}
+
+    def find(self, field: str, code) -> Optional[dict]:
+        """
+        Document có `field` bằng `code`: ưu tiên khớp chính xác (sau khi strip), sau đó không phân biệt
+        hoa thường (thay cho `find_one` + `$regex ... $options: "i"`). Index được dựng một lần mỗi snapshot.
+        """
+        index = self._indexes.get(field)
+        if index is None:
+            exact, folded = {}, {}
+            for doc in self.docs:
+                value = doc.get(field)
+                if value is None:
+                    continue
+                exact.setdefault(str(value).strip(), doc)
+                folded.setdefault(normalize_code(value), doc)
+            index = self._indexes[field] = (exact, folded)
+        exact, folded = index
+        key = str(code or "").strip()
+        return exact.get(key) or folded.get(key.casefold())
+
+    def encoded_items(self, codec: str = JSON, chunk_size: int = 0) -> List[bytes]:
+        """Danh sách document đã encode, chia thành các phần `chunk_size` phần tử (0 = một phần)."""
+        key = (codec, chunk_size)
+        encoded = self._encoded.get(key)
+        if encoded is None:
+            if chunk_size > 0:
+                chunks = [self.docs[i:i + chunk_size] for i in range(0, len(self.docs), chunk_size)] or [[]]
+            else:
+                chunks = [self.docs]
+            encoded = self._encoded[key] = [encode(chunk, codec) for chunk in chunks]
+        return encoded
+
+    def response(self, codec: str = JSON, items_key: Optional[str] = None, extra=(), compress: bool = False, chunk_size: int = 0) -> List[bytes]:
+        """
+        Payload trả lời request danh mục.
+        - Không chia phần và không có `items_key`: payload là danh sách document (giữ định dạng cũ).
+        - Ngược lại: object gồm các trường `extra`, (khi chia phần) `version`/`chunk`/`chunks`
+          và danh sách document ở key `items_key` (mặc định `items`).
+        - `compress`: nén zlib từng payload.
+        """
+        plain = items_key is None and not extra and not chunk_size
+        cache_key = (codec, chunk_size, "zlib")
+        if plain and compress and cache_key in self._encoded:
+            return self._encoded[cache_key]
+
+        chunks = self.encoded_items(codec, chunk_size)
+        if plain:
+            payloads = chunks
+        else:
+            payloads = []
+            for idx, items in enumerate(chunks):
+                fields = [(key, encode(value, codec)) for key, value in extra]
+                if chunk_size:
+                    fields += [("version", encode(self.version, codec)), ("chunk", encode(idx, codec)), ("chunks", encode(len(chunks), codec))]
+                fields.append((items_key or "items", items))
+                payloads.append(encode_object(fields, codec))
+
+        if compress:
+            payloads = [zlib.compress(p, 6) for p in payloads]
+            if plain:
+                self._encoded[cache_key] = payloads
+        return payloads
+
+class MasterSnapshotCache:
+    """
+    Cache snapshot các collection master data.
+    - Nạp lần đầu khi được yêu cầu (hoặc `preload()` lúc khởi động).
+    - Vô hiệu hóa qua change stream của database `masterdata`; nếu Mongo không hỗ trợ
+      (không phải replica set), kiểm tra phiên bản bằng lệnh `dbHash` mỗi `check_interval` giây.
+    - `ttl` > 0: snapshot cũ hơn `ttl` giây được nạp lại khi được hỏi (lưới an toàn nếu lỡ sự kiện thay đổi).
+    - `listeners`: hàm `callback(collection)` được gọi khi một collection thay đổi.
+    """
+
+    def __init__(self, db, collections: Dict[str, dict], check_interval: float = 30.0, codec_for: Optional[Callable[[str], str]] = None, ttl: float = 0.0):
+        self.db = db
+        self.collections = dict(collections)
+        self.check_interval = check_interval
+        self.ttl = ttl
+        self.codec_for = codec_for or (lambda topic: JSON)
+        self.listeners: List[Callable[[str], None]] = []
+        self.mode = None
+        self._snapshots: Dict[str, CollectionSnapshot] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._hashes: Dict[str, str] = {}
+        self._generation: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._counters = {"hits": 0, "loads": 0, "invalidations": 0}
+
+    async def _load(self, name: str) -> CollectionSnapshot:
+        docs = await self.db[name].find({}, self.collections.get(name)).to_list(None)
+        version = hashlib.sha1(encode(docs)).hexdigest()[:12]
+        self._counters["loads"] += 1
+        return CollectionSnapshot(name, docs, version)
+
+    async def get(self, name: str) -> CollectionSnapshot:
+        snapshot = self._snapshots.get(name)
+        if snapshot is not None and not self._expired(snapshot):
+            self._counters["hits"] += 1
+            return snapshot
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            snapshot = self._snapshots.get(name)
+            if snapshot is None or self._expired(snapshot):
+                generation = self._generation.get(name, 0)
+                snapshot = await self._load(name)
+                if self._generation.get(name, 0) != generation:
+                    # Dữ liệu thay đổi trong lúc đang nạp: dùng tạm cho request này, không cache
+                    return snapshot
+                self._snapshots[name] = snapshot
+                print(f">>> [MASTER CACHE] Nạp {len(snapshot.docs)} bản ghi {name} (version {snapshot.version})")
+            return snapshot
+
+    def _expired(self, snapshot: CollectionSnapshot) -> bool:
+        return self.ttl > 0 and time.time() - snapshot.loaded_at > self.ttl
+
+    # --- Tra cứu theo key (không phân biệt hoa thường) ---
+
+    async def working_parameter(self, productcode: str) -> Optional[dict]:
+        return (await self.get("workingparameter")).find("productcode", productcode)
+
+    async def product(self, productcode: str) -> Optional[dict]:
+        return (await self.get("product")).find("productcode", productcode)
+
+    async def machine(self, machinecode: str) -> Optional[dict]:
+        return (await self.get("machine")).find("machinecode", machinecode)
+
+    async def downtime(self, downtimecode: str) -> Optional[dict]:
+        return (await self.get("downtime")).find("downtimecode", downtimecode)
+
+    async def machines(self) -> List[dict]:
+        return (await self.get("machine")).docs
+
+    async def shifts(self) -> List[dict]:
+        return (await self.get("shift")).docs
+
+    async def preload(self):
+        for name in self.collections:
+            try:
+                await self.get(name)
+            except Exception as e:
+                print(f">>> [MASTER CACHE ERROR] Lỗi nạp {name}: {e}")
+
+    def invalidate(self, name: str):
+        self._generation[name] = self._generation.get(name, 0) + 1
+        if self._snapshots.pop(name, None) is not None:
+            self._counters["invalidations"] += 1
+            print(f">>> [MASTER CACHE] {name} thay đổi, snapshot sẽ được nạp lại")
+        for callback in self.listeners:
+            try:
+                callback(name)
+            except Exception as e:
+                print(f">>> [MASTER CACHE ERROR] Lỗi listener khi {name} thay đổi: {e}")
+
+    async def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(self.collections)}}}]
+        try:
+            async with self.db.watch(pipeline) as stream:
+                self.mode = "change_stream"
+                print(">>> [MASTER CACHE] Theo dõi master data bằng change stream")
+                async for change in stream:
+                    self.invalidate(change["ns"]["coll"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f">>> [MASTER CACHE] Không dùng được change stream ({e}), kiểm tra phiên bản mỗi {self.check_interval}s")
+        await self._poll()
+
+    async def _check_versions(self):
+        try:
+            res = await self.db.command("dbHash", collections=list(self.collections))
+            hashes = res.get("collections", {})
+        except Exception:
+            hashes = None
+        if hashes is not None:
+            for name, digest in hashes.items():
+                if self._hashes.get(name) not in (None, digest):
+                    self.invalidate(name)
+                self._hashes[name] = digest
+            return
+        # Không có quyền dbHash: nạp lại và so sánh nội dung các snapshot đang dùng
+        for name, snapshot in list(self._snapshots.items()):
+            fresh = await self._load(name)
+            if fresh.version != snapshot.version:
+                self.invalidate(name)
+                self._snapshots[name] = fresh
+
+    async def _poll(self):
+        self.mode = "version_check"
+        while True:
+            try:
+                await self._check_versions()
+            except Exception as e:
+                print(f">>> [MASTER CACHE ERROR] Lỗi kiểm tra phiên bản master data: {e}")
+            await asyncio.sleep(self.check_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        now = time.time()
+        return {
+            "mode": self.mode,
+            **self._counters,
+            "collections": {
+                name: {"docs": len(s.docs), "version": s.version, "age_s": round(now - s.loaded_at, 1)}
+                for name, s in self._snapshots.items()
+            },
+        }
+
+_master_cache = None
+
+def get_master_cache() -> MasterSnapshotCache:
+    global _master_cache
+    if _master_cache is None:
+        _master_cache = MasterSnapshotCache(get_database(), SNAPSHOT_COLLECTIONS, MASTER_CACHE_CHECK_S, ttl=MASTER_CACHE_TTL_S)
+    return _master_cache
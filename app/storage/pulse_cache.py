@@ -0,0 +1,81 @@
+from datetime import datetime
+from typing import Dict, Optional, Set
+
+from app.storage.db import get_production_db
+
+# Thời điểm pulse gần nhất của từng máy, dùng chung cho tính `actual_cycle_time` (CounterIngestor)
+# và phát hiện máy dừng (DowntimeMonitor). Thay cho
+# `iot_records.find_one(..., sort=[("timestamp", -1)])` trên mỗi pulse.
+
+class LastPulseCache:
+    """
+    Cache pulse gần nhất theo máy.
+    - `seed()` lúc khởi động: một aggregation `$sort` + `$group` (dùng index `machinecode, timestamp`).
+    - Máy chưa có trong cache: `load()` đọc DB một lần; máy chưa từng có pulse cũng được nhớ, không đọc lại.
+    - `update()` khi nhận pulse, chỉ giữ thời điểm mới nhất.
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self._last: Dict[str, datetime] = {}
+        self._missing: Set[str] = set()
+        self._counters = {"hits": 0, "loads": 0, "updates": 0}
+
+    def _db(self):
+        return self.db if self.db is not None else get_production_db()
+
+    async def seed(self):
+        pipeline = [
+            {"$sort": {"machinecode": 1, "timestamp": -1}},
+            {"$group": {"_id": "$machinecode", "timestamp": {"$first": "$timestamp"}}},
+        ]
+        try:
+            rows = await self._db().iot_records.aggregate(pipeline, allowDiskUse=True).to_list(None)
+        except Exception as e:
+            print(f">>> [PULSE CACHE ERROR] Lỗi nạp pulse gần nhất: {e}")
+            return
+        for row in rows:
+            m_code = str(row["_id"] or "").strip()
+            if m_code and row.get("timestamp"):
+                self.update(m_code, row["timestamp"])
+        print(f">>> [PULSE CACHE] Nạp pulse gần nhất của {len(self._last)} máy")
+
+    def get(self, machinecode: str) -> Optional[datetime]:
+        """Pulse gần nhất đã biết (không I/O)."""
+        return self._last.get(machinecode.strip())
+
+    async def load(self, machinecode: str) -> Optional[datetime]:
+        """Pulse gần nhất; đọc DB một lần nếu máy chưa có trong cache."""
+        m_code = machinecode.strip()
+        ts = self._last.get(m_code)
+        if ts is not None or m_code in self._missing:
+            self._counters["hits"] += 1
+            return ts
+        self._counters["loads"] += 1
+        last_record = await self._db().iot_records.find_one({"machinecode": m_code}, {"timestamp": 1}, sort=[("timestamp", -1)])
+        if last_record and last_record.get("timestamp"):
+            return self.update(m_code, last_record["timestamp"])
+        if m_code not in self._last:
+            self._missing.add(m_code)
+        return self._last.get(m_code)
+
+    def update(self, machinecode: str, timestamp: datetime) -> datetime:
+        """Ghi nhận pulse, trả về pulse mới nhất của máy."""
+        m_code = machinecode.strip()
+        self._missing.discard(m_code)
+        current = self._last.get(m_code)
+        if current is None or timestamp > current:
+            self._last[m_code] = current = timestamp
+            self._counters["updates"] += 1
+        return current
+
+    def stats(self) -> dict:
+        return {"machines": len(self._last), **self._counters}
+
+_pulse_cache = None
+
+def get_last_pulse_cache() -> LastPulseCache:
+    global _pulse_cache
+    if _pulse_cache is None:
+        _pulse_cache = LastPulseCache()
+    return _pulse_cache
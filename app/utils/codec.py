@@ -0,0 +1,152 @@
+import json
+import time
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Optional
+
+from bson import ObjectId
+
+try:
+    import orjson
+except ImportError:  # Fallback: json chuẩn (chậm hơn)
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+CODECS = (JSON, MSGPACK)
+
+# datetime luôn là UTC (naive, theo `datetime.utcnow()`), encode ISO-8601 không kèm múi giờ
+# để giữ nguyên ý nghĩa so với `default=str` trước đây.
+
+def _default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    return str(obj)
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime):
+        # msgpack Timestamp (ext -1) yêu cầu datetime có tzinfo
+        return obj if obj.tzinfo else obj.replace(tzinfo=timezone.utc)
+    return _default(obj)
+
+def encode(data: Any, codec: str = JSON) -> bytes:
+    if codec == MSGPACK:
+        if msgpack is None:
+            raise RuntimeError("Chưa cài msgpack (pip install msgpack)")
+        return msgpack.packb(data, default=_msgpack_default, datetime=True, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def encode_object(fields, codec: str = JSON) -> bytes:
+    """
+    Ghép một object từ các giá trị đã encode sẵn: `fields` = [(key, encoded_value), ...].
+    Dùng để gửi danh sách lớn đã serialize trước kèm vài trường thay đổi theo request.
+    """
+    if codec == MSGPACK:
+        count = len(fields)
+        header = bytes([0x80 | count]) if count < 16 else b"\xde" + count.to_bytes(2, "big")
+        return header + b"".join(encode(key, MSGPACK) + value for key, value in fields)
+    return b"{" + b",".join(encode(key) + b":" + value for key, value in fields) + b"}"
+
+def decode(payload: bytes, codec: str = JSON) -> Any:
+    """Giải mã payload; topic cấu hình msgpack vẫn nhận được JSON (client cũ) nhờ nhận diện byte đầu."""
+    if codec == MSGPACK and msgpack is not None and payload[:1] not in (b"{", b"["):
+        return msgpack.unpackb(payload, raw=False, timestamp=3)
+    if orjson is not None:
+        return orjson.loads(payload)
+    return json.loads(payload.decode("utf-8"))
+
+class TopicCodecs:
+    """
+    Chọn codec theo topic (`{topic_pattern: "json" | "msgpack"}`, hỗ trợ wildcard `+`/`#`),
+    các topic còn lại dùng `default`. Đếm số message, byte và thời gian encode/decode.
+    """
+
+    def __init__(self, mapping: Optional[Dict[str, str]] = None, default: str = JSON, matcher=None):
+        for topic, codec in (mapping or {}).items():
+            if codec not in CODECS:
+                raise ValueError(f"Codec không hợp lệ cho {topic}: {codec}")
+        if MSGPACK in (mapping or {}).values() or default == MSGPACK:
+            if msgpack is None:
+                print(">>> [CODEC] Chưa cài msgpack, các topic msgpack sẽ dùng JSON", flush=True)
+        self.mapping = dict(mapping or {})
+        self.default = default
+        self.matcher = matcher
+        self._cache: Dict[str, str] = {}
+        self._counters = {"encoded": 0, "decoded": 0, "bytes_out": 0, "bytes_in": 0}
+        self._encode_total = 0.0
+        self._decode_total = 0.0
+
+    def codec_for(self, topic: str) -> str:
+        codec = self._cache.get(topic)
+        if codec is None:
+            codec = self.mapping.get(topic)
+            if codec is None and self.matcher:
+                codec = next((c for pattern, c in self.mapping.items() if self.matcher(pattern, topic)), None)
+            codec = codec or self.default
+            if codec == MSGPACK and msgpack is None:
+                codec = JSON
+            self._cache[topic] = codec
+        return codec
+
+    def encode(self, topic: str, data: Any) -> bytes:
+        started = time.perf_counter()
+        # bytes: payload đã encode sẵn (ví dụ snapshot master data), gửi nguyên trạng
+        payload = bytes(data) if isinstance(data, (bytes, bytearray)) else encode(data, self.codec_for(topic))
+        self._encode_total += time.perf_counter() - started
+        self._counters["encoded"] += 1
+        self._counters["bytes_out"] += len(payload)
+        return payload
+
+    def decode(self, topic: str, payload: bytes) -> Any:
+        started = time.perf_counter()
+        data = decode(payload, self.codec_for(topic))
+        self._decode_total += time.perf_counter() - started
+        self._counters["decoded"] += 1
+        self._counters["bytes_in"] += len(payload)
+        return data
+
+    def stats(self) -> dict:
+        encoded, decoded = self._counters["encoded"], self._counters["decoded"]
+        return {
+            "json_impl": "orjson" if orjson is not None else "json",
+            "msgpack": msgpack is not None,
+            **self._counters,
+            "avg_encode_us": round(self._encode_total / encoded * 1e6, 1) if encoded else 0.0,
+            "avg_decode_us": round(self._decode_total / decoded * 1e6, 1) if decoded else 0.0,
+            "avg_bytes_out": round(self._counters["bytes_out"] / encoded, 1) if encoded else 0.0,
+        }
+
+def benchmark(data: Any, runs: int = 2000) -> Dict[str, dict]:
+    """So sánh `json.dumps(default=str)` cũ với các codec hiện có trên cùng một payload."""
+    candidates = {"json_default_str": lambda d: json.dumps(d, default=str).encode("utf-8"), JSON: encode}
+    if msgpack is not None:
+        candidates[MSGPACK] = lambda d: encode(d, MSGPACK)
+    results = {}
+    for name, fn in candidates.items():
+        payload = fn(data)
+        started = time.perf_counter()
+        for _ in range(runs):
+            fn(data)
+        results[name] = {"us": round((time.perf_counter() - started) / runs * 1e6, 2), "bytes": len(payload)}
+    return results
+
+if __name__ == "__main__":
+    # python3 -m app.utils.codec : đo trên payload giống danh sách downtime/shift summary
+    now = datetime.utcnow()
+    sample = [
+        {"id": str(ObjectId()), "machine": f"m{i:03d}", "status": "closed", "downtimecode": "default",
+         "createtime": now, "endtime": now, "duration": 120 + i, "oee": 0.8123, "availability": 0.93}
+        for i in range(200)
+    ]
+    for name, res in benchmark(sample).items():
+        print(f"{name:>18}: {res['us']:>9} us  {res['bytes']:>7} bytes")
@@ -1,14 +1,14 @@
 from typing import Callable, Any, Optional
 
 # Global callback variable to be set by main.py
-_mqtt_publish_func: Optional[Callable[[str, Any], None]] = None
+_mqtt_publish_func: Optional[Callable[..., None]] = None
 
-def set_mqtt_publish_func(func: Callable[[str, Any], None]):
+def set_mqtt_publish_func(func: Callable[..., None]):
     global _mqtt_publish_func
     _mqtt_publish_func = func
 
-def mqtt_publish(topic: str, data: Any):
+def mqtt_publish(topic: str, data: Any, retain: bool = False):
     if _mqtt_publish_func:
-        _mqtt_publish_func(topic, data)
+        _mqtt_publish_func(topic, data, retain=retain)
     else:
         print(f">>> [MESSAGING] Warning: MQTT publish function not set. Cannot send to {topic}")